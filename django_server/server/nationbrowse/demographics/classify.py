@@ -0,0 +1,217 @@
+# coding=utf-8
+"""
+Class breaks for choropleth maps, computed from the data instead of
+hand-tuned in mapfiles.
+
+Any PlacePopulation, CrimeData or DerivedMetrics field (or the pop_density
+and area_sq_mi columns of the places themselves) can be classified, at any
+place level, with one of:
+
+ * "quantile": about the same number of places in each class
+ * "equal_interval": classes of equal width between the min and max
+ * "jenks": Jenks natural breaks (Fisher's exact optimal classification,
+   minimizing the sum of squared deviations within classes)
+
+Everything is vectorized over the whole column. Jenks is an O(k*m^2)
+dynamic program over m <= JENKS_MAX_BINS weighted values (the distinct
+values, or quantile bins of them for big columns like ZIP codes), with each
+step done as numpy matrix operations, rather than the naive O(k*n^2) loop.
+
+Breaks are the upper bound of each class (a value belongs to the first class
+whose break it doesn't exceed), and are cached per (level, field, method, k).
+style() turns them into the [[min, "#color"], ...] definition that map
+layers use.
+"""
+from __future__ import division
+from django.conf import settings
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from cacheutil import safe_get_cache,safe_set_cache
+import numpy
+
+from nationbrowse.demographics.models import latest_source
+from nationbrowse.demographics.columnar import DATA_MODELS,data_fields,get_table
+
+METHODS = ('quantile','equal_interval','jenks')
+MAX_CLASSES = 12
+
+# Mappable values stored on the places themselves.
+PLACE_VALUE_FIELDS = ('pop_density','area_sq_mi')
+
+JENKS_MAX_BINS = 1000
+
+# Default color ramp, lowest class first (the greens of the old
+# state_pop_2000 Mapnik style).
+DEFAULT_COLORS = getattr(settings,"DEMOGRAPHICS_CLASS_COLORS",(
+    '#C9E8D6','#99D1B1','#6FB990','#4BA272','#008B57',
+))
+
+# Seconds to cache computed breaks.
+CACHE_SECONDS = 86400
+
+def data_model(field):
+    """ The model (PlacePopulation or CrimeData) that has this field, or None. """
+    for model in DATA_MODELS:
+        if field in data_fields(model):
+            return model
+    return None
+
+def is_classifiable(field):
+    return field in PLACE_VALUE_FIELDS or data_model(field) is not None
+
+def load_values(place_type, field):
+    """
+    Returns {place pk: value} of a field for every place of a type that has
+    it. Data model fields come from the most recent original source that has
+    data for the place type (or its most recent roll-up, if it has only
+    those), read from the columnar snapshot if there is one.
+    """
+    PlaceClass = get_model('places', place_type)
+    if field in PLACE_VALUE_FIELDS:
+        return dict(PlaceClass.objects.exclude(**{"%s__isnull" % field:True}).order_by().values_list('pk', field))
+    model = data_model(field)
+    table = get_table(model, place_type)
+    if table is not None:
+        source = table.latest_source()
+        if source is None:
+            return {}
+        rows = table.source_rows(source)
+        return dict(zip(table.place_ids[rows].tolist(), table.column(field)[rows].tolist()))
+    qs = model.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass))
+    source = latest_source(qs)
+    if source is None:
+        return {}
+    return dict(qs.filter(source=source).order_by().values_list('place_id', field))
+
+def column(place_type, field):
+    """ The non-missing values of a field for a place type, as a float array. """
+    values = [v for v in load_values(place_type, field).itervalues() if v is not None]
+    return numpy.asarray(values, dtype=float)
+
+# ----- Methods -----
+
+def quantile_breaks(values, k):
+    values = values[numpy.isfinite(values)]
+    if not len(values):
+        return []
+    breaks = numpy.percentile(values, numpy.linspace(0, 100, k + 1)[1:])
+    return sorted(set(breaks.tolist()))
+
+def equal_interval_breaks(values, k):
+    values = values[numpy.isfinite(values)]
+    if not len(values):
+        return []
+    low, high = values.min(), values.max()
+    breaks = low + (high - low) * numpy.arange(1, k + 1) / k
+    breaks[-1] = high
+    return sorted(set(breaks.tolist()))
+
+def weighted_bins(values, max_bins=JENKS_MAX_BINS):
+    """
+    Reduces sorted values to at most max_bins (mean, weight, max) bins: the
+    distinct values if there are few enough, else runs of about equal size.
+    """
+    values = numpy.sort(values)
+    distinct, first = numpy.unique(values, return_index=True)
+    if len(distinct) <= max_bins:
+        counts = numpy.diff(numpy.append(first, len(values)))
+        return distinct, counts.astype(float), distinct
+    # Cut on quantiles, but never in the middle of a run of equal values.
+    cuts = numpy.searchsorted(values, values[numpy.linspace(0, len(values), max_bins + 1)[1:-1].astype(int)], side='left')
+    cuts = numpy.unique(numpy.concatenate(([0], cuts, [len(values)])))
+    sums = numpy.add.reduceat(values, cuts[:-1])
+    counts = numpy.diff(cuts).astype(float)
+    return sums / counts, counts, values[cuts[1:] - 1]
+
+def jenks_breaks(values, k, max_bins=JENKS_MAX_BINS):
+    values = values[numpy.isfinite(values)]
+    if not len(values):
+        return []
+    means, weights, maxes = weighted_bins(values, max_bins)
+    m = len(means)
+    if m <= k:
+        return maxes.tolist()
+
+    # Prefix sums, so the squared deviation of bins i..j (inclusive) is
+    # S2[j+1]-S2[i] - (S1[j+1]-S1[i])^2 / (W[j+1]-W[i]).
+    W = numpy.concatenate(([0], numpy.cumsum(weights)))
+    S1 = numpy.concatenate(([0], numpy.cumsum(weights * means)))
+    S2 = numpy.concatenate(([0], numpy.cumsum(weights * means * means)))
+    i = numpy.arange(m)[:, None]
+    j = numpy.arange(m)[None, :]
+    with_data = j >= i
+    w = numpy.where(with_data, W[j+1] - W[i], 1)
+    cost = numpy.where(with_data, (S2[j+1] - S2[i]) - (S1[j+1] - S1[i]) ** 2 / w, numpy.inf)
+
+    # best[j] = least cost of classifying bins 0..j; first[c][j] = first bin
+    # of the last class in that classification (for backtracking).
+    best = cost[0].copy()
+    first = []
+    for c in xrange(1, k):
+        # Last class is bins i..j; the other c classes cover 0..i-1.
+        previous = numpy.concatenate(([numpy.inf], best[:-1]))
+        total = previous[:, None] + cost
+        start = numpy.argmin(total, axis=0)
+        best = total[start, numpy.arange(m)]
+        first.append(start)
+
+    breaks = []
+    end = m - 1
+    for start in reversed(first):
+        breaks.append(maxes[end])
+        end = start[end] - 1
+    breaks.append(maxes[end])
+    return sorted(set(numpy.asarray(breaks).tolist()))
+
+BREAK_FUNCTIONS = {
+    'quantile':quantile_breaks,
+    'equal_interval':equal_interval_breaks,
+    'jenks':jenks_breaks,
+}
+
+def class_breaks(values, method='quantile', k=5):
+    """ Class breaks of a values array. See the module docstring. """
+    return BREAK_FUNCTIONS[method](numpy.asarray(values, dtype=float), k)
+
+def get_breaks(place_type, field, method='quantile', k=5):
+    """
+    Returns (breaks, minimum value) for a field over every place of a type,
+    cached per (place type, field, method, k).
+    """
+    cache_key = "class_breaks %s %s %s %d" % (place_type, field, method, k)
+    result = safe_get_cache(cache_key)
+    if result is None:
+        values = column(place_type, field)
+        if len(values):
+            result = (class_breaks(values, method, k), float(values.min()))
+        else:
+            result = ([], None)
+        safe_set_cache(cache_key, result, CACHE_SECONDS)
+    return result
+
+# ----- Styles -----
+
+def interpolate_colors(colors, k):
+    """ k colors evenly spaced along a ramp of '#RRGGBB' colors. """
+    if k == len(colors):
+        return list(colors)
+    rgb = numpy.array([[int(c.lstrip('#')[i:i+2], 16) for i in (0, 2, 4)] for c in colors], dtype=float)
+    if k == 1:
+        return [colors[-1]]
+    positions = numpy.linspace(0, len(colors) - 1, k)
+    ramp = []
+    for p in positions:
+        low = int(numpy.floor(p))
+        high = min(low + 1, len(colors) - 1)
+        mix = rgb[low] + (rgb[high] - rgb[low]) * (p - low)
+        ramp.append('#%02X%02X%02X' % tuple(numpy.round(mix).astype(int)))
+    return ramp
+
+def style(breaks, minimum, colors=DEFAULT_COLORS):
+    """
+    The [[min, "#color"], ...] style for a set of breaks: each class's lower
+    bound (the data minimum, then the previous class's break) and color.
+    """
+    ramp = interpolate_colors(colors, len(breaks))
+    lower = [minimum] + list(breaks[:-1])
+    return [[low, color] for low, color in zip(lower, ramp)]
@@ -0,0 +1,300 @@
+# coding=utf-8
+"""
+Columnar, memory-mapped snapshots of PlacePopulation, CrimeData and
+DerivedMetrics.
+
+Analysis across every place (class breaks, rankings, rollups) needs one or
+two fields of tens of thousands of rows, but going through the ORM builds
+a full model instance of ~100 fields per row (and the caching manager
+writes every one of them to the cache). Instead, build_snapshot() (the
+build_columnar command) writes each data model's rows, for each place
+type, as a Table: one typed NumPy .npy file per field, rows sorted by
+place, then roll-up sources before original ones (see rollup.py), then
+source date, so each place's last row is the one to show for it. Reading
+a Table maps the files read-only (numpy.load(mmap_mode='r')), so a column
+costs nothing until it's touched, every process on the machine shares the
+same pages, and slices of columns are views rather than copies.
+
+Layout under COLUMNAR_DIR:
+
+    current                         name of the live snapshot
+    <version>/<model>/<place type>/
+        meta.json                   fields, dtypes, row count, sources
+                                    (pk, date, name, derived_from)
+        place_id.npy, source.npy    the row keys
+        places.npy, offsets.npy     the place index: rows of places[i] are
+                                    offsets[i]:offsets[i+1]
+        <field>.npy                 one per data field
+
+A new snapshot is written to its own version directory, then "current" is
+switched with an atomic rename, so readers never see a half-written one.
+Each process notices a new snapshot within VERSION_CHECK_SECONDS.
+
+Snapshots are only as fresh as their last build; code that must see the
+latest data falls back to the ORM when get_table() returns None.
+"""
+from django.conf import settings
+from django.db import models
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from threading import Lock
+from time import time
+import numpy
+import json
+import os
+import shutil
+
+from nationbrowse.demographics.models import DataSource,PlacePopulation,CrimeData,DerivedMetrics
+
+COLUMNAR_DIR = getattr(settings,"DEMOGRAPHICS_COLUMNAR_DIR",
+    os.path.join(settings.DJANGO_SERVER_DIR, 'server', 'nationbrowse', 'demographics', 'columnar'))
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# Models that are snapshotted (and whose fields can be analyzed).
+DATA_MODELS = (PlacePopulation, CrimeData, DerivedMetrics)
+NON_DATA_FIELDS = ('id','place_type','place_id','source')
+
+# How often (seconds) a process checks for a new snapshot.
+VERSION_CHECK_SECONDS = 60
+
+CURRENT_FILE = "current"
+
+def data_fields(model):
+    return [f.name for f in model._meta.fields if f.name not in NON_DATA_FIELDS]
+
+def field_dtype(field):
+    """ The NumPy dtype a model field is stored as. Nullable numbers become floats (None is NaN). """
+    if isinstance(field, (models.DecimalField, models.FloatField)) or field.null:
+        return numpy.float64
+    if isinstance(field, models.PositiveIntegerField):
+        return numpy.uint32
+    return numpy.int64
+
+def model_name(model):
+    if isinstance(model, basestring):
+        return model.lower()
+    return model._meta.object_name.lower()
+
+# ----- Reading -----
+
+class Table(object):
+    """
+    A snapshot of one data model's rows for one place type, read from its
+    directory. Columns are read-only memory maps, opened on first use.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.fields = meta['fields']
+        self.dtypes = dict([(k, numpy.dtype(str(v))) for k, v in meta['dtypes'].iteritems()])
+        self.sources = dict([(int(source[0]), (source[1], source[2])) for source in meta['sources']])
+        # Roll-up sources (snapshots from before they were recorded have none).
+        self.derived = set([int(source[0]) for source in meta['sources'] if len(source) > 3 and source[3] is not None])
+        self.rows = meta['rows']
+        self._columns = {}
+        self.place_ids = self.column('place_id')
+        self.source_ids = self.column('source')
+        self.places = self.column('places')
+        self.offsets = self.column('offsets')
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        """ A whole column (a data field, or a key array) as a read-only array. """
+        array = self._columns.get(name)
+        if array is None:
+            if name not in self.dtypes:
+                raise KeyError(name)
+            if self.rows:
+                array = numpy.load(os.path.join(self.path, "%s.npy" % name), mmap_mode='r')
+            else:
+                # Zero-length files can't be mapped.
+                array = numpy.load(os.path.join(self.path, "%s.npy" % name))
+            self._columns[name] = array
+        return array
+
+    def place_rows(self, place_id):
+        """ The slice of rows of a place (roll-ups, then oldest source first); empty if it has none. """
+        i = numpy.searchsorted(self.places, place_id)
+        if i >= len(self.places) or self.places[i] != place_id:
+            return slice(0, 0)
+        return slice(int(self.offsets[i]), int(self.offsets[i+1]))
+
+    def row_slice(self, rows, fields=None):
+        """ {field: view of the field's column over a slice of rows}. """
+        return dict([(field, self.column(field)[rows]) for field in (fields or self.fields)])
+
+    def place_data(self, place_id, source=None, fields=None):
+        """
+        {field: value} of a place's row from a source (by default, its latest
+        row; see latest_rows()), or None if there's no such row.
+        """
+        rows = self.place_rows(place_id)
+        if source is not None:
+            matches = numpy.nonzero(self.source_ids[rows] == source)[0]
+            if not len(matches):
+                return None
+            i = rows.start + int(matches[-1])
+        elif rows.stop > rows.start:
+            i = rows.stop - 1
+        else:
+            return None
+        return dict([(field, self.column(field)[i].item()) for field in (fields or self.fields)])
+
+    def latest_rows(self):
+        """
+        The index of each place's latest row, in place order: from its most
+        recent original source, or if it has none, its most recent roll-up.
+        """
+        return self.offsets[1:] - 1
+
+    def latest_source(self):
+        """
+        The pk of the most recent original source with rows in the table (or
+        if there are only roll-ups, the most recent of those), or None.
+        """
+        sources = [pk for pk in self.sources if pk not in self.derived] or self.sources.keys()
+        if not sources:
+            return None
+        return max(sources, key=lambda pk:(self.sources[pk][0], pk))
+
+    def source_rows(self, source):
+        """ The indices of the rows from a source, in place order. """
+        return numpy.nonzero(self.source_ids == source)[0]
+
+def snapshot_version(root=None):
+    """ The name of the live snapshot, or None if there is none. """
+    try:
+        with open(os.path.join(root or COLUMNAR_DIR, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+_tables = {}
+_version = {'version':None, 'checked':0}
+_lock = Lock()
+
+def current_version():
+    """ The version of the snapshot this process reads (checked every VERSION_CHECK_SECONDS). """
+    if time() - _version['checked'] > VERSION_CHECK_SECONDS:
+        version = snapshot_version()
+        _version['checked'] = time()
+        if version != _version['version']:
+            _version['version'] = version
+            _tables.clear()
+    return _version['version']
+
+def get_table(model, place_type):
+    """
+    The Table of a data model (class or name) for a place type, from the
+    live snapshot; None if there's no snapshot or it doesn't have the table.
+    """
+    version = current_version()
+    if version is None:
+        return None
+    key = (model_name(model), place_type)
+    try:
+        return _tables[key]
+    except KeyError:
+        pass
+    _lock.acquire()
+    try:
+        if key not in _tables:
+            path = os.path.join(COLUMNAR_DIR, version, *key)
+            _tables[key] = Table(path) if os.path.exists(path) else None
+        return _tables[key]
+    finally:
+        _lock.release()
+
+def reset():
+    """ Drop this process's tables and recheck for a snapshot on next use. """
+    _tables.clear()
+    _version['version'] = None
+    _version['checked'] = 0
+
+# ----- Building -----
+
+def _save(path, name, array):
+    numpy.save(os.path.join(path, "%s.npy" % name), array)
+
+def write_table(path, model, place_type):
+    """ Writes the Table of a data model's rows for a place type to a new directory. Returns the row count. """
+    PlaceClass = get_model('places', place_type)
+    fields = [model._meta.get_field(name) for name in data_fields(model)]
+    sources = dict([(pk, (date.isoformat(), source, derived_from)) for pk, date, source, derived_from in
+        DataSource.objects.values_list('pk','date','source','derived_from').iterator()])
+
+    # Plain values_list() rows, so no model instances (or cache writes).
+    qs = model.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass)).order_by()
+    rows = list(qs.values_list('place_id', 'source', *[f.attname for f in fields]).iterator())
+    columns = zip(*rows) or [()] * (len(fields) + 2)
+    del rows
+
+    place_ids = numpy.array(columns[0], dtype=numpy.int64)
+    source_ids = numpy.array(columns[1], dtype=numpy.int64)
+    source_dates = numpy.array([sources[pk][0] for pk in columns[1]], dtype='S10')
+    originals = numpy.array([sources[pk][2] is None for pk in columns[1]], dtype=bool)
+    # By place, then roll-ups before the place's own rows, then oldest source first.
+    order = numpy.lexsort((source_ids, source_dates, originals, place_ids))
+
+    os.makedirs(path)
+    place_ids = place_ids[order]
+    places, starts = numpy.unique(place_ids, return_index=True)
+    _save(path, 'place_id', place_ids)
+    _save(path, 'source', source_ids[order])
+    _save(path, 'places', places)
+    _save(path, 'offsets', numpy.append(starts, len(place_ids)).astype(numpy.int64))
+
+    dtypes = {'place_id':'int64', 'source':'int64', 'places':'int64', 'offsets':'int64'}
+    for field, values in zip(fields, columns[2:]):
+        dtype = field_dtype(field)
+        if dtype == numpy.float64:
+            values = [v if v is not None else numpy.nan for v in values]
+        _save(path, field.name, numpy.array(values, dtype=dtype)[order])
+        dtypes[field.name] = numpy.dtype(dtype).name
+
+    used = sorted(set(source_ids.tolist()))
+    meta = {
+        'model':model_name(model),
+        'place_type':place_type,
+        'rows':len(place_ids),
+        'fields':[f.name for f in fields],
+        'dtypes':dtypes,
+        'sources':[[pk] + list(sources[pk]) for pk in used],
+    }
+    with open(os.path.join(path, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return len(place_ids)
+
+def build_snapshot(models=DATA_MODELS, place_types=PLACE_TYPES, root=None, verbose=False):
+    """
+    Writes a new snapshot of the data models and makes it the live one.
+    Snapshots older than the one it replaces are deleted. Returns the new
+    snapshot's version.
+    """
+    root = root or COLUMNAR_DIR
+    if not os.path.exists(root):
+        os.makedirs(root)
+    version = "%d" % (time() * 1000)
+    for model in models:
+        for place_type in place_types:
+            count = write_table(os.path.join(root, version, model_name(model), place_type), model, place_type)
+            if verbose:
+                print "  %s %s: %d rows" % (model._meta.verbose_name_plural, place_type, count)
+
+    previous = snapshot_version(root)
+    current = os.path.join(root, CURRENT_FILE)
+    with open(current + ".tmp", 'w') as f:
+        f.write(version)
+    os.rename(current + ".tmp", current)
+
+    # Processes may still have the previous snapshot mapped; keep it around
+    # until the next build.
+    for name in os.listdir(root):
+        if name not in (version, previous, CURRENT_FILE) and os.path.isdir(os.path.join(root, name)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    reset()
+    return version
@@ -0,0 +1,216 @@
+# coding=utf-8
+"""
+Streaming CSV export of PlacePopulation data: for one place, the counties
+or ZIP codes of a state, or a whole place type.
+
+csv_chunks() reads the rows from the same single join as the GeoJSON export
+(places/export.py, without the geometry), in batches from a server-side
+cursor, and yields the CSV a batch at a time, so memory stays bounded
+however many places there are.
+
+Without a ?source, a place type's CSV is of the DataSource of its
+PlacePopulation rows to show (population_source() in places/export.py),
+looked up once and cached until its data changes.
+
+A whole place type from one DataSource is the big, popular download, so
+its gzip'd CSV is written once to CSV_CACHE_DIR and served from there
+(with an ETag from the file, for conditional requests). The cached file is
+removed when the place type's data from that source changes: saving or
+deleting a PlacePopulation row, or a roll-up (see rollup.py). A request
+that finds no cached file is streamed from the database like any other,
+and starts writing the file in the background for the requests after it;
+run the export_demographics_csv command with --cache to write one ahead of
+time.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django_caching.cache import cache
+
+from nationbrowse.places.export import ITERSIZE,export_query,population_source,_cursor,_close
+from streamutil import gzip_stream,write_stream
+from threadutil import call_in_bg
+from threading import Lock
+
+import csv
+import glob
+import gzip
+import os
+import tempfile
+
+CSV_CACHE_DIR = getattr(settings,"DEMOGRAPHICS_CSV_CACHE_DIR",
+    os.path.join(settings.DJANGO_SERVER_DIR, 'server', 'nationbrowse', 'demographics', 'csv_cache'))
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# How long (seconds) a place type's default source is cached; it's also
+# dropped whenever the place type's data changes.
+SOURCE_CACHE_SECONDS = 86400
+
+class _Buffer(object):
+    """ A file-like object for csv.writer that hands back what was written since the last take(). """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def take(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        return data
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def csv_chunks(place_type, state=None, place=None, source=None):
+    """
+    Yields the chunks of a CSV of the demographics of every `place_type`
+    object with any (optionally only those in a State, or one place), a
+    header row and then one row per place.
+    """
+    sql, params, properties = export_query(place_type, state=state, source=source, place=place,
+        geometry=False, only_with_data=True)
+    cursor = _cursor("csv_%s" % place_type)
+    try:
+        cursor.execute(sql, params)
+
+        buf = _Buffer()
+        writer = csv.writer(buf)
+        writer.writerow(['id'] + properties)
+        yield buf.take()
+        while True:
+            rows = cursor.fetchmany(ITERSIZE)
+            if not rows:
+                break
+            writer.writerows([map(_encode, row) for row in rows])
+            yield buf.take()
+    finally:
+        _close(cursor)
+
+def _source_key(place_type):
+    return "demographics_csv_source_%s" % place_type
+
+def default_source(place_type):
+    """ The pk of the DataSource a place type's CSV is of by default (see population_source()), or None. """
+    source = cache.get(_source_key(place_type))
+    if source is None:
+        source = population_source(place_type)
+        # 0 for none, so that's cached too.
+        source = source and source.pk or 0
+        cache.set(_source_key(place_type), source, SOURCE_CACHE_SECONDS)
+    return source or None
+
+# ----- Cache of whole place types -----
+
+def cache_path(place_type, source):
+    """ Where the gzip'd CSV of a place type's data from a source (pk) is cached. """
+    return os.path.join(CSV_CACHE_DIR, "%s-source_%d.csv.gz" % (place_type, source))
+
+def write_cached_csv(place_type, source):
+    """ (Re)writes the cached gzip'd CSV of a place type's data from a source. Returns its path. """
+    path = cache_path(place_type, source)
+    try:
+        os.makedirs(CSV_CACHE_DIR)
+    except OSError:
+        # It already exists.
+        pass
+    # Written aside and renamed into place, so it's never read half-written.
+    fd, tmp = tempfile.mkstemp(dir=CSV_CACHE_DIR)
+    f = os.fdopen(fd, 'wb')
+    try:
+        try:
+            write_stream(gzip_stream(csv_chunks(place_type, source=source)), f)
+        finally:
+            f.close()
+    except:
+        os.remove(tmp)
+        raise
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+    return path
+
+# Cached CSVs this process is writing in the background, and how many
+# times the cache has been invalidated (a write that saw an invalidation
+# may have read the old data, so it's dropped).
+_writing = set()
+_invalidations = {'count':0}
+_lock = Lock()
+
+def _write_in_bg(place_type, source, invalidations):
+    try:
+        try:
+            path = write_cached_csv(place_type, source)
+            if _invalidations['count'] != invalidations:
+                os.remove(path)
+        except Exception:
+            from traceback import print_exc
+            print_exc()
+    finally:
+        _lock.acquire()
+        try:
+            _writing.discard((place_type, source))
+        finally:
+            _lock.release()
+
+def request_cached_csv(place_type, source):
+    """ Starts writing the cached CSV of a place type's data from a source in the background, unless that's running. """
+    _lock.acquire()
+    try:
+        if (place_type, source) in _writing:
+            return
+        _writing.add((place_type, source))
+    finally:
+        _lock.release()
+    call_in_bg(_write_in_bg, [place_type, source, _invalidations['count']])
+
+def open_cached_csv(place_type, source, decompress=False):
+    """
+    The cached gzip'd CSV of a place type's data from a source, opened for
+    reading (decompressed, optionally), or None if it isn't cached; then it
+    starts being written for later requests.
+    """
+    path = cache_path(place_type, source)
+    try:
+        if decompress:
+            return gzip.GzipFile(path, 'rb')
+        return open(path, 'rb')
+    except IOError:
+        request_cached_csv(place_type, source)
+        return None
+
+def cached_etag(path):
+    """
+    An ETag for a cached file, which changes whenever it's rewritten (a
+    rename gives it a new inode); None if there's no such file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return "%s-%x-%x-%x" % (os.path.basename(path).split('.')[0], stat.st_ino, int(stat.st_mtime), stat.st_size)
+
+def invalidate(place_type=None, source=None):
+    """
+    Removes the cached CSVs of a place type and/or a source (pk); all of
+    them by default. The place type's default source is looked up again.
+    """
+    for name in place_type and [place_type] or PLACE_TYPES:
+        cache.set(_source_key(name), None, 5)
+    _lock.acquire()
+    try:
+        _invalidations['count'] += 1
+    finally:
+        _lock.release()
+    pattern = "%s-source_%s.csv.gz" % (place_type or '*', source is None and '*' or int(source))
+    for path in glob.glob(os.path.join(CSV_CACHE_DIR, pattern)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def data_changed(sender, instance, **kwargs):
+    """ post_save/post_delete receiver for PlacePopulation. """
+    place_type = ContentType.objects.get_for_id(instance.place_type_id).model
+    invalidate(place_type, instance.source_id)
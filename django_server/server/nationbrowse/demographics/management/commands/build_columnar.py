@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+
+from nationbrowse.demographics.columnar import COLUMNAR_DIR,build_snapshot
+from time import time
+
+class Command(NoArgsCommand):
+    help = "Writes a columnar (memory-mapped NumPy) snapshot of PlacePopulation, CrimeData and DerivedMetrics, and makes it the live one."
+
+    def handle_noargs(self, **options):
+        start = time()
+        # Snapshots go where every process reads them: DEMOGRAPHICS_COLUMNAR_DIR.
+        print "Building snapshot in %s..." % COLUMNAR_DIR
+        version = build_snapshot(verbose=True)
+        print "Snapshot %s is live (%.1fs)." % (version, time() - start)
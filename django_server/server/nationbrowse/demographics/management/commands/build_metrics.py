@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from nationbrowse.demographics.columnar import PLACE_TYPES,build_snapshot
+from nationbrowse.demographics.metrics import build_metrics
+from time import time
+
+class Command(BaseCommand):
+    help = "Computes DerivedMetrics (median age, dependency ratios, diversity, ...) of every PlacePopulation record."
+    args = "[place_type ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--no-snapshot', action='store_false', dest='snapshot', default=True,
+            help="Don't rebuild the columnar snapshot before and after (the metrics are computed from the current one)."),
+    )
+
+    def handle(self, *args, **options):
+        for place_type in args:
+            if place_type not in PLACE_TYPES:
+                raise CommandError("Unknown place type %r. Choose from: %s" % (place_type, ", ".join(PLACE_TYPES)))
+        place_types = args or PLACE_TYPES
+
+        start = time()
+        if options['snapshot']:
+            print "Building columnar snapshot..."
+            build_snapshot()
+
+        print "Computing metrics..."
+        build_metrics(place_types, verbose=True)
+
+        if options['snapshot']:
+            print "Adding metrics to the columnar snapshot..."
+            build_snapshot()
+        print "Done (%.1fs)." % (time() - start)
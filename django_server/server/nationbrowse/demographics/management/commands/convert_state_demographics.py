@@ -1,6 +1,7 @@
 from django.core.management.base import NoArgsCommand
 
 from nationbrowse.demographics.models import PopulationImport,PlacePopulation
+from nationbrowse.demographics.rollup import deferred_refresh
 from nationbrowse.places.models import State
 from django.db import IntegrityError, transaction
 import gc
@@ -13,6 +14,7 @@ class Command(NoArgsCommand):
     def handle_noargs(self, **options):
         return True
     
+    @deferred_refresh
     def XXXhandle_noargs(self, **options):
         gc.enable()
         for p in PopulationImport.objects.iterator():
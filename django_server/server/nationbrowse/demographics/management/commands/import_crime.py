@@ -3,7 +3,9 @@ from django.core.management.base import NoArgsCommand
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from nationbrowse.demographics.models import DataSource,CrimeData
-from nationbrowse.places.models import State, County
+from nationbrowse.demographics.rollup import deferred_refresh
+from nationbrowse.places.models import County
+from nationbrowse.places.registry import get_registry
 import csv
 import os
 from traceback import print_exc
@@ -14,6 +16,7 @@ class Command(NoArgsCommand):
 
     output_transaction = True
     
+    @deferred_refresh
     def handle_noargs(self, **options):
         datasource, created = DataSource.objects.get_or_create(
             source="FBI Uniform Crime Reporting Program",
@@ -32,28 +35,29 @@ class Command(NoArgsCommand):
         fields = csv_reader.next()
         
         county_type = ContentType.objects.get_for_model(County)
+        states = get_registry('state')
+        counties = get_registry('county')
 
         for row in csv_reader:
-            try:
-                if row[0]:
-                    state = State.objects.get(name__iexact=row[0])
-            except Exception as e:
-                print "%s (%s)" % (row[0], e)
+            if row[0]:
+                state = states.info(states.pk_for_name(row[0]))
+                if state is None:
+                    print "%s (unknown state)" % row[0]
     
     
             county_name = row[1]
             if county_name[-1].isdigit():
                 county_name = county_name[:-1]
     
-            try:
-                county = County.objects.get(state=state,name__iexact=county_name)
-            except Exception as e:
-                print "%s - %s (%s)" % (state, county_name, e)
+            county_id = state and counties.pk_for_name(county_name, state['state'])
+            if county_id is None:
+                print "%s - %s (unknown county)" % (state and state['name'], county_name)
+                continue
             
             try:
                 d, created = CrimeData.objects.get_or_create(
                     place_type = county_type,
-                    place_id = county.pk,
+                    place_id = county_id,
                     source = datasource
                 )
                 d.violent_crime = csvstr_to_int(row[2])
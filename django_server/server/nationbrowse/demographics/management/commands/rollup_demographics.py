@@ -0,0 +1,28 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from nationbrowse.demographics.columnar import build_snapshot
+from nationbrowse.demographics.rollup import rollup
+from time import time
+
+class Command(NoArgsCommand):
+    help = "Sums PlacePopulation and CrimeData up from ZIP codes and counties to states and the nation."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--no-snapshot', action='store_false', dest='snapshot', default=True,
+            help="Don't rebuild the columnar snapshot before and after (the roll-ups read the current one)."),
+    )
+
+    def handle_noargs(self, **options):
+        start = time()
+        if options['snapshot']:
+            print "Building columnar snapshot..."
+            build_snapshot()
+
+        print "Rolling up..."
+        rollup(verbose=True)
+
+        if options['snapshot']:
+            print "Adding roll-ups to the columnar snapshot..."
+            build_snapshot()
+        print "Done (%.1fs)." % (time() - start)
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""
+DerivedMetrics: median and mean age, dependency ratios, sex ratio, racial
+diversity, urbanization and population density of every PlacePopulation
+record.
+
+These are computed for a whole place type at once: the inputs are loaded
+as one array per field (from the columnar snapshot, if there is one) and
+every metric is a handful of numpy operations over all the records -- the
+median age, for instance, finds each record's median bracket with a
+cumulative sum over the age-bracket matrix, and interpolates within it.
+The results replace the place type's DerivedMetrics rows in one
+executemany(), and from then on are ordinary indexed columns: sortable,
+filterable, classifiable (classify.py), rankable (ranking.py) and part of
+the columnar snapshot.
+
+Metrics are None where they're undefined (i.e. no one aged 15-64 for the
+dependency ratios).
+"""
+from __future__ import division
+from django.db import connection, transaction
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from django_caching.cache import cache
+import numpy
+import re
+
+from nationbrowse.demographics.models import PlacePopulation,DerivedMetrics
+from nationbrowse.demographics.columnar import PLACE_TYPES,data_fields,get_table
+
+# The age brackets, as (field, first age, first age of the next bracket);
+# 85+ is taken as 85-95.
+OPEN_BRACKET_END = 95
+_age_field = re.compile(r'^age_(\d+)(?:_(\d+|plus))?$')
+
+def _age_brackets():
+    brackets = []
+    for field in PlacePopulation._meta.fields:
+        match = _age_field.match(field.name)
+        if match:
+            low, high = match.groups()
+            low = int(low)
+            if high == 'plus':
+                high = OPEN_BRACKET_END
+            elif high is None:
+                high = low + 1
+            else:
+                high = int(high) + 1
+            brackets.append((field.name, low, high))
+    brackets.sort(key=lambda b:b[1])
+    return brackets
+
+AGE_BRACKETS = _age_brackets()
+
+# Working ages are [WORKING_AGE_START, WORKING_AGE_END).
+WORKING_AGE_START = 15
+WORKING_AGE_END = 65
+
+RACE_FIELDS = ('onerace_white','onerace_black','onerace_amerindian','onerace_asian','onerace_pacislander','onerace_other')
+MIXED_RACE_FIELDS = ('tworace','threerace','fourrace','fiverace','sixrace')
+
+INPUT_FIELDS = tuple([b[0] for b in AGE_BRACKETS]) + RACE_FIELDS + MIXED_RACE_FIELDS + ('total','urban','male','female')
+
+def _ratio(numerator, denominator, scale=1):
+    """ scale * numerator / denominator, NaN where the denominator is 0. """
+    nonzero = denominator > 0
+    return numpy.where(nonzero, scale * numerator / numpy.where(nonzero, denominator, 1), numpy.nan)
+
+def median_ages(counts, lows, highs):
+    """
+    The median age of each row of a (records x brackets) matrix of people per
+    age bracket, interpolated linearly within the bracket it falls in.
+    """
+    lows, highs = numpy.asarray(lows, dtype=float), numpy.asarray(highs, dtype=float)
+    cumulative = numpy.cumsum(counts, axis=1)
+    total = cumulative[:, -1]
+    half = total / 2
+    # The first bracket whose cumulative count reaches half.
+    bracket = numpy.minimum((cumulative < half[:, None]).sum(axis=1), counts.shape[1] - 1)
+    rows = numpy.arange(len(counts))
+    below = numpy.where(bracket > 0, cumulative[rows, bracket - 1], 0)
+    fraction = _ratio(half - below, counts[rows, bracket])
+    medians = lows[bracket] + numpy.nan_to_num(fraction) * (highs - lows)[bracket]
+    medians[total <= 0] = numpy.nan
+    return medians
+
+def compute(columns, area=None):
+    """
+    Every DerivedMetrics field, as {field: float array}, from {field: array}
+    of the PlacePopulation INPUT_FIELDS of some records (and the area in sq.
+    mi. of each record's place, if known).
+    """
+    columns = dict([(f, numpy.asarray(columns[f], dtype=float)) for f in INPUT_FIELDS])
+    fields, lows, highs = zip(*AGE_BRACKETS)
+    counts = numpy.column_stack([columns[f] for f in fields])
+    lows, highs = numpy.array(lows, dtype=float), numpy.array(highs, dtype=float)
+    people = counts.sum(axis=1)
+
+    young = counts[:, highs <= WORKING_AGE_START].sum(axis=1)
+    old = counts[:, lows >= WORKING_AGE_END].sum(axis=1)
+    working = people - young - old
+
+    races = numpy.column_stack([columns[f] for f in RACE_FIELDS] + [sum([columns[f] for f in MIXED_RACE_FIELDS])])
+    race_total = races.sum(axis=1)
+    shares = races / numpy.where(race_total > 0, race_total, 1)[:, None]
+
+    metrics = {
+        'median_age':median_ages(counts, lows, highs),
+        'mean_age':_ratio(numpy.dot(counts, (lows + highs) / 2), people),
+        'youth_dependency_ratio':_ratio(young, working, 100),
+        'old_age_dependency_ratio':_ratio(old, working, 100),
+        'dependency_ratio':_ratio(young + old, working, 100),
+        'sex_ratio':_ratio(columns['male'], columns['female'], 100),
+        'diversity_index':numpy.where(race_total > 0, 1 - (shares ** 2).sum(axis=1), numpy.nan),
+        'urban_share':_ratio(columns['urban'], columns['total'], 100),
+    }
+    if area is None:
+        area = numpy.zeros(len(people))
+    metrics['pop_per_sq_mi'] = _ratio(columns['total'], numpy.nan_to_num(numpy.asarray(area, dtype=float)))
+    return metrics
+
+def load_inputs(place_type):
+    """
+    Returns (place ids, source ids, {field: array}) of the INPUT_FIELDS of
+    every PlacePopulation record of a place type, from the columnar snapshot
+    if there is one.
+    """
+    table = get_table(PlacePopulation, place_type)
+    if table is not None:
+        return table.place_ids, table.source_ids, dict([(f, table.column(f)) for f in INPUT_FIELDS])
+
+    PlaceClass = get_model('places', place_type)
+    qs = PlacePopulation.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass)).order_by()
+    rows = list(qs.values_list('place_id', 'source', *INPUT_FIELDS).iterator())
+    columns = zip(*rows) or [()] * (len(INPUT_FIELDS) + 2)
+    return (
+        numpy.array(columns[0], dtype=numpy.int64),
+        numpy.array(columns[1], dtype=numpy.int64),
+        dict([(f, numpy.array(columns[i + 2], dtype=float)) for i, f in enumerate(INPUT_FIELDS)]),
+    )
+
+def place_areas(place_type, place_ids):
+    """ The area_sq_mi of each of place_ids' places (NaN if unknown). """
+    PlaceClass = get_model('places', place_type)
+    areas = list(PlaceClass.objects.exclude(area_sq_mi__isnull=True).order_by('pk').values_list('pk','area_sq_mi').iterator())
+    pks = numpy.array([a[0] for a in areas], dtype=numpy.int64)
+    values = numpy.append(numpy.array([a[1] for a in areas], dtype=float), numpy.nan)
+    positions = numpy.searchsorted(pks, place_ids)
+    known = positions < len(pks)
+    known[known] = pks[positions[known]] == numpy.asarray(place_ids)[known]
+    positions[~known] = len(pks)
+    return values[positions]
+
+@transaction.commit_on_success
+def store(place_type, place_ids, source_ids, metrics):
+    """ Replaces the DerivedMetrics rows of a place type. """
+    qn = connection.ops.quote_name
+    opts = DerivedMetrics._meta
+    ct = ContentType.objects.get_for_model(get_model('places', place_type))
+    fields = data_fields(DerivedMetrics)
+    columns = [opts.get_field(name).column for name in ('place_type','place_id','source')] + \
+        [opts.get_field(name).column for name in fields]
+
+    values = numpy.column_stack([metrics[f] for f in fields]) if len(place_ids) else numpy.zeros((0, len(fields)))
+    rows = []
+    for place_id, source_id, row in zip(place_ids.tolist(), source_ids.tolist(), values.tolist()):
+        rows.append([ct.pk, place_id, source_id] + [v if v == v else None for v in row])
+
+    old = list(DerivedMetrics.objects.filter(place_type=ct).values_list('pk', flat=True).iterator())
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s = %%s" % (qn(opts.db_table), qn(opts.get_field('place_type').column)), [ct.pk])
+    if rows:
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(opts.db_table),
+            ", ".join([qn(c) for c in columns]),
+            ", ".join(["%s"] * len(columns)),
+        ), rows)
+    for pk in old:
+        cache.set(DerivedMetrics._cache_key(pk), None, 5)
+    return len(rows)
+
+def build_metrics(place_types=PLACE_TYPES, verbose=False):
+    """ Recomputes the DerivedMetrics of every PlacePopulation record of the place types. """
+    for place_type in place_types:
+        place_ids, source_ids, columns = load_inputs(place_type)
+        place_ids = numpy.asarray(place_ids, dtype=numpy.int64)
+        metrics = compute(columns, place_areas(place_type, place_ids))
+        count = store(place_type, place_ids, numpy.asarray(source_ids, dtype=numpy.int64), metrics)
+        if verbose:
+            print "  %s: %d records" % (place_type, count)
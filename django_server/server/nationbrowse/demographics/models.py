@@ -7,6 +7,7 @@ from django_caching.managers import CachingManager
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+from django.db.models.signals import post_save,post_delete
 
 from datetime import date
 
@@ -18,6 +19,10 @@ class DataSource(CachedModel):
     date = models.DateField(help_text="Note that for some data sources, only the year is valid.")
     url = models.URLField(blank=True,null=True,max_length=255,verify_exists=False)
     
+    # Set on the sources that hold roll-ups (sums up the place hierarchy) of
+    # another source's data; see rollup.py.
+    derived_from = models.ForeignKey('self',blank=True,null=True,related_name='derivatives',editable=False)
+    
     @property
     def name(self):
         return u"%s" % (self.source)
@@ -29,6 +34,33 @@ class DataSource(CachedModel):
         ordering = ('date','source')
         unique_together = (('source','date'),)
 
+def latest_source(qs):
+    """
+    The DataSource of a data model queryset's rows to show: the most recent
+    original source that has any, or (only if there are none) the most
+    recent roll-up; None if the queryset is empty.
+    """
+    sources = DataSource.objects.filter(pk__in=qs.values('source')).order_by('-date','-pk')
+    for candidates in (sources.filter(derived_from__isnull=True), sources):
+        try:
+            return candidates[0]
+        except IndexError:
+            pass
+    return None
+
+def latest_values(qs, *fields):
+    """
+    {place_id: (values of fields)} of each place's latest row in a queryset
+    of a data model: the row of its most recent original source, or (only if
+    it has none, e.g. the Nation) of its most recent roll-up.
+    """
+    latest = {}
+    for row in qs.order_by('place_id','source__date','source').values_list('place_id','source__derived_from',*fields).iterator():
+        place_id, original = row[0], row[1] is None
+        if original or not latest.get(place_id, (False,))[0]:
+            latest[place_id] = (original,) + row[2:]
+    return dict([(place_id, row[1:]) for place_id, row in latest.iteritems()])
+
 class PlacePopulation(CachedModel):
     """
     Each record represents data from one source, for one particular place.
@@ -294,6 +326,49 @@ class CrimeData(CachedModel):
         return u"%s crime data" % (self.place)
     __unicode__ = cached_clsmethod(__unicode__, 604800)
 
+class DerivedMetrics(CachedModel):
+    """
+    Metrics derived from one PlacePopulation record (and the place's area):
+    computed for every record at once by the `build_metrics` command (see
+    metrics.py) and stored, so they can be sorted, filtered, ranked and
+    mapped like any other demographic field.
+    """
+    objects = CachingManager()
+    
+    place_type = models.ForeignKey(ContentType)
+    place_id = models.PositiveIntegerField(db_index=True)
+    place = generic.GenericForeignKey(ct_field='place_type',fk_field='place_id')
+    
+    source = models.ForeignKey(DataSource,db_index=True)
+    
+    # Interpolated within the Census age brackets (85+ is taken as 85-95).
+    median_age = models.FloatField(blank=True,null=True,db_index=True)
+    mean_age = models.FloatField(blank=True,null=True,db_index=True)
+    
+    # Per 100 people aged 15-64.
+    youth_dependency_ratio = models.FloatField("youth dependency ratio (under 15 per 100 aged 15-64)",blank=True,null=True,db_index=True)
+    old_age_dependency_ratio = models.FloatField("old-age dependency ratio (65 and over per 100 aged 15-64)",blank=True,null=True,db_index=True)
+    dependency_ratio = models.FloatField("dependency ratio (under 15 and 65 and over per 100 aged 15-64)",blank=True,null=True,db_index=True)
+    
+    sex_ratio = models.FloatField("sex ratio (males per 100 females)",blank=True,null=True,db_index=True)
+    
+    # Simpson's index over the one-race groups and people of two or more
+    # races: the chance that two random people are of different groups.
+    diversity_index = models.FloatField(blank=True,null=True,db_index=True)
+    
+    urban_share = models.FloatField("urban population (percent)",blank=True,null=True,db_index=True)
+    pop_per_sq_mi = models.FloatField("population per sq. mi.",blank=True,null=True,db_index=True)
+    
+    class Meta:
+        verbose_name = "derived metrics"
+        verbose_name_plural = "derived metrics"
+        ordering = ('place_type','place_id')
+        unique_together = (('place_type','place_id','source'),)
+	
+    def __unicode__(self):
+        return u"%s derived metrics" % (self.place)
+    __unicode__ = cached_clsmethod(__unicode__, 604800)
+
 """
 class PopulationImport(models.Model):
     geo_id = models.CharField(max_length=255)
@@ -442,4 +517,21 @@ class PopulationImport(models.Model):
     p033001 = models.DecimalField(max_digits=4, decimal_places=2)
     class Meta:
         db_table = "dc_dec_2000_sf1"
-"""
\ No newline at end of file
+"""
+
+def data_changed(sender, **kwargs):
+    """ Keeps the roll-ups above a place up to date (see rollup.py). """
+    from nationbrowse.demographics.rollup import data_changed
+    data_changed(sender, **kwargs)
+
+for DataClass in (PlacePopulation, CrimeData):
+    post_save.connect(data_changed, sender=DataClass)
+    post_delete.connect(data_changed, sender=DataClass)
+
+def csv_changed(sender, **kwargs):
+    """ Drops the cached CSV export the row was in (see export.py). """
+    from nationbrowse.demographics.export import data_changed
+    data_changed(sender, **kwargs)
+
+post_save.connect(csv_changed, sender=PlacePopulation)
+post_delete.connect(csv_changed, sender=PlacePopulation)
@@ -0,0 +1,191 @@
+# coding=utf-8
+"""
+Ranks, percentiles and top-K lists of any classifiable field (see
+classify.py) at any place level, nationally or within a state.
+
+"Where does Boone County rank on X" used to mean an ORDER BY over X's
+index, joined through the generic foreign key, on every question. Instead,
+each (place type, field) is loaded once per process (from the columnar
+snapshot, via classify.load_values) and sorted with one argsort into a
+Ranking for the nation and one for each state (the state of each county or
+ZIP code comes from the place registry). A Ranking holds the values in
+descending order (so a top-K list is a slice) and the places sorted by pk:
+finding a place's value is a binary search of the pks, and its rank and
+percentile a binary search of the values -- O(log n) per lookup.
+
+Ranks are "competition" ranks: places with equal values share a rank, and
+the next rank skips (1, 2, 2, 4). A place's percentile is the share of
+places ranked with a value at or below its own, so the top place is at 100.
+
+Rankings are rebuilt on next use when the columnar snapshot or the places
+change, and at least every MAX_AGE_SECONDS; sorting even the ZIP codes
+takes milliseconds.
+"""
+from __future__ import division
+from django.conf import settings
+from django.db.models.loading import get_model
+from threading import Lock
+from time import time
+import numpy
+
+from nationbrowse.places.registry import get_registry
+from nationbrowse.demographics.columnar import current_version
+from nationbrowse.demographics.classify import PLACE_VALUE_FIELDS,data_model,load_values
+
+# Fields shown (with their ranks) on place pages.
+PLACE_RANK_FIELDS = getattr(settings,"DEMOGRAPHICS_PLACE_RANK_FIELDS",(
+    'total','pop_density','area_sq_mi','median_age','diversity_index','avg_household_size',
+))
+
+MAX_AGE_SECONDS = 3600
+
+class Ranking(object):
+    """ One field's values over a set of places, sorted for rank lookups and top-K slices. """
+    def __init__(self, pks, values):
+        pks = numpy.asarray(pks, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=float)
+        keep = numpy.isfinite(values)
+        pks, values = pks[keep], values[keep]
+
+        # Highest first; equal values in pk order.
+        by_pk = numpy.argsort(pks, kind='mergesort')
+        self.sorted_pks, self.pk_values = pks[by_pk], values[by_pk]
+        order = numpy.argsort(-self.pk_values, kind='mergesort')
+        self.pks, self.values = self.sorted_pks[order], self.pk_values[order]
+        self.ascending = self.values[::-1]
+
+    def __len__(self):
+        return len(self.pks)
+
+    def value(self, pk):
+        """ A place's value, or None if it isn't ranked. """
+        i = numpy.searchsorted(self.sorted_pks, pk)
+        if i >= len(self.sorted_pks) or self.sorted_pks[i] != pk:
+            return None
+        return float(self.pk_values[i])
+
+    def ranks(self, values):
+        """ The ranks that values would have (an array, for an array). """
+        return len(self) - numpy.searchsorted(self.ascending, values, side='right') + 1
+
+    def percentiles(self, values):
+        """ The share (0-100) of places whose value is at or below each of values. """
+        if not len(self):
+            return numpy.zeros(numpy.shape(values))
+        return 100 * numpy.searchsorted(self.ascending, values, side='right') / len(self)
+
+    def rank(self, pk):
+        """ Returns {'value','rank','percentile','count'} for a place, or None if it isn't ranked. """
+        value = self.value(pk)
+        if value is None:
+            return None
+        return {
+            'value':value,
+            'rank':int(self.ranks(value)),
+            'percentile':float(self.percentiles(value)),
+            'count':len(self),
+        }
+
+    def top(self, k, offset=0, ascending=False):
+        """ Returns [(pk, value, rank), ...] of the k highest (or lowest) ranked places after `offset`. """
+        pks, values = self.pks, self.values
+        if ascending:
+            pks, values = pks[::-1], self.ascending
+        pks, values = pks[offset:offset+k], values[offset:offset+k]
+        return zip(pks.tolist(), values.tolist(), self.ranks(values).tolist())
+
+class RankingSet(object):
+    """ The national Ranking of a field for a place type, and a Ranking for each state. """
+    def __init__(self, place_type, values):
+        pks = numpy.fromiter(values.iterkeys(), dtype=numpy.int64, count=len(values))
+        vals = numpy.fromiter(values.itervalues(), dtype=float, count=len(values))
+        self.nation = Ranking(pks, vals)
+        self.states = {}
+        if place_type == 'state':
+            return
+
+        registry = get_registry(place_type)
+        state_names = numpy.array([(s or u'').upper() for s in registry.states] + [u''])
+        positions = numpy.searchsorted(registry.pks, pks)
+        known = positions < len(registry.pks)
+        known[known] = registry.pks[positions[known]] == pks[known]
+        positions[~known] = len(registry.pks)
+
+        # One sort by state; each state's places are then a slice.
+        keys = state_names[positions]
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        names, starts = numpy.unique(keys, return_index=True)
+        ends = numpy.append(starts[1:], len(keys))
+        for name, start, end in zip(names.tolist(), starts.tolist(), ends.tolist()):
+            if name:
+                self.states[name] = Ranking(pks[order[start:end]], vals[order[start:end]])
+
+    def ranking(self, state=None):
+        """ The national Ranking, or a state's (by abbreviation; None if it has no places). """
+        if state is None:
+            return self.nation
+        return self.states.get(state.upper())
+
+_rankings = {}
+_lock = Lock()
+
+def get_rankings(place_type, field):
+    """ The RankingSet of a field for a place type (built on first use, and after data changes). """
+    key = (place_type, field)
+    version = (current_version(), get_registry(place_type))
+    entry = _rankings.get(key)
+    if entry is None or entry[0] != version or time() - entry[1] > MAX_AGE_SECONDS:
+        _lock.acquire()
+        try:
+            entry = _rankings.get(key)
+            if entry is None or entry[0] != version or time() - entry[1] > MAX_AGE_SECONDS:
+                values = dict([(pk, v) for pk, v in load_values(place_type, field).iteritems() if v is not None])
+                entry = _rankings[key] = (version, time(), RankingSet(place_type, values))
+        finally:
+            _lock.release()
+    return entry[2]
+
+def ranking(place_type, field, state=None):
+    """ The Ranking of a field for a place type, nationally or within a state (None if it has no places). """
+    return get_rankings(place_type, field).ranking(state)
+
+def field_label(place_type, field):
+    """ The verbose name of a rankable field. """
+    if field in PLACE_VALUE_FIELDS:
+        model = get_model('places', place_type)
+    else:
+        model = data_model(field)
+    return unicode(model._meta.get_field(field).verbose_name)
+
+def place_ranks(place_type, pk, fields=PLACE_RANK_FIELDS):
+    """
+    A place's rank on each field, for place pages: a list of {'field',
+    'label', 'value', 'rank', 'percentile', 'count'} dicts, with 'state_rank'
+    and 'state_count' too for counties and ZIP codes. Fields the place has no
+    value for are left out.
+    """
+    info = get_registry(place_type).info(pk)
+    state = info and place_type != 'state' and info['state'] or None
+    ranks = []
+    for field in fields:
+        rankings = get_rankings(place_type, field)
+        rank = rankings.nation.rank(pk)
+        if rank is None:
+            continue
+        if rank['value'] == int(rank['value']):
+            rank['value'] = int(rank['value'])
+        else:
+            rank['value'] = round(rank['value'], 2)
+        rank['field'] = field
+        rank['label'] = field_label(place_type, field)
+        state_ranking = state and rankings.ranking(state)
+        state_rank = state_ranking and state_ranking.rank(pk)
+        if state_rank:
+            rank['state_rank'] = state_rank['rank']
+            rank['state_count'] = state_rank['count']
+        ranks.append(rank)
+    return ranks
+
+def reset():
+    _rankings.clear()
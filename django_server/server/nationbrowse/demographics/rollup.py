@@ -0,0 +1,366 @@
+# coding=utf-8
+"""
+Roll-ups of PlacePopulation and CrimeData up the place hierarchy: ZIP code
+to County (through the ZipCodeCounty crosswalk), County to State, and State
+to the Nation.
+
+For every (original) DataSource, each level is summed from the one below,
+ZIP codes up: a place counts with its own row from the source if it has
+one, else with its roll-up. So a county with county data adds that to its
+state, and one without adds what its ZIP codes sum to. The sums are stored
+as rows of the same model under a derived DataSource ("<source>
+(roll-up)", with `derived_from` set), so the loaded rows are never touched;
+readers use a roll-up row only for places with no row of their own (see
+latest_values() in models.py).
+
+Every count is additive. ZIP codes don't nest in counties, so each ZIP
+code's counts are split between its counties by their share of its area.
+Averages can't be summed: avg_household_size and avg_family_size are
+averaged weighted by their households and families (i.e. the people in
+households over the households).
+
+Aggregation is a grouped reduction over the whole level at once: the child
+rows as a (places x fields) matrix -- the source's own rows read from the
+columnar snapshot -- are scaled by their weights, sorted by parent and
+summed with numpy.add.reduceat. The results are written with a few
+executemany() statements, not per-object saves.
+
+rollup() recomputes everything (the rollup_demographics command); saving
+or deleting one original row refreshes just the places above it (see
+refresh()). Bulk imports wrap themselves in deferred_refresh so that they
+roll up each changed source once at the end instead of once per row.
+"""
+from __future__ import division
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+from django_caching.cache import cache
+from decimal import Decimal
+from threading import local
+import numpy
+
+from nationbrowse.demographics.models import DataSource,PlacePopulation,CrimeData
+from nationbrowse.demographics.columnar import data_fields,get_table
+from nationbrowse.demographics.export import invalidate as invalidate_csv
+from nationbrowse.places.models import Nation,State,County,ZipCode,ZipCodeCounty
+
+# Models whose fields are all counts (or weighted averages of them).
+ROLLUP_MODELS = (PlacePopulation, CrimeData)
+
+# The level each level rolls up to.
+PARENTS = {
+    'zipcode':'county',
+    'county':'state',
+    'state':'nation',
+}
+
+# Averages, and the count each is weighted by.
+WEIGHTED_AVERAGES = {
+    'avg_household_size':'num_households',
+    'avg_family_size':'num_families',
+}
+
+PLACE_CLASSES = {
+    'nation':Nation,
+    'state':State,
+    'county':County,
+    'zipcode':ZipCode,
+}
+
+NATION_DEFAULTS = {'name':u"United States"}
+
+# Per thread: (model, source pk) pairs changed inside deferred_refresh.
+_deferred = local()
+
+def _ct(place_type):
+    return ContentType.objects.get_for_model(PLACE_CLASSES[place_type])
+
+def _any(qs):
+    return bool(qs.order_by().values_list('pk')[:1])
+
+def derived_source(source):
+    """ The DataSource that roll-ups of a source are stored under (created if needed). """
+    derived, created = DataSource.objects.get_or_create(derived_from=source, defaults={
+        'source':u"%s (roll-up)" % source.source,
+        'date':source.date,
+        'url':source.url,
+    })
+    return derived
+
+def nation():
+    """ The Nation every State rolls up to (created if there is none). """
+    try:
+        return Nation.objects.order_by('pk')[0]
+    except IndexError:
+        return Nation.objects.create(slug="united-states", **NATION_DEFAULTS)
+
+# ----- Reduction -----
+
+def load(model, place_type, source, place_ids=None):
+    """
+    Returns (place ids, values) of a source's rows for a place type, where
+    values is a float matrix with a column per data field. All rows are read
+    from the columnar snapshot when it has the source; the rows of some
+    places (or any rows the snapshot doesn't have) come from the database.
+    """
+    fields = data_fields(model)
+    if place_ids is None:
+        table = get_table(model, place_type)
+        if table is not None and source.pk in table.sources:
+            rows = table.source_rows(source.pk)
+            values = numpy.empty((len(rows), len(fields)))
+            for j, field in enumerate(fields):
+                values[:, j] = table.column(field)[rows]
+            return numpy.asarray(table.place_ids[rows], dtype=numpy.int64), values
+
+    qs = model.objects.filter(place_type=_ct(place_type), source=source).order_by()
+    if place_ids is not None:
+        if not len(place_ids):
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, len(fields)))
+        qs = qs.filter(place_id__in=list(place_ids))
+    rows = list(qs.values_list('place_id', *fields).iterator())
+    ids = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+    values = numpy.array([row[1:] for row in rows], dtype=float).reshape((len(rows), len(fields)))
+    return ids, values
+
+def merge(own, rolled):
+    """
+    The (place ids, values) a level counts with: each place's own row (own),
+    or if it has none, its roll-up (rolled).
+    """
+    keep = ~numpy.in1d(rolled[0], own[0])
+    return numpy.concatenate((own[0], rolled[0][keep])), numpy.vstack((own[1], rolled[1][keep]))
+
+def parents(place_type, place_ids):
+    """
+    Returns (child positions, parent ids, weights): for each (child, parent)
+    pair, the child's position in place_ids, its parent's id and the share of
+    the child that belongs to it.
+    """
+    place_ids = numpy.asarray(place_ids, dtype=numpy.int64)
+    if place_type == 'state':
+        return numpy.arange(len(place_ids)), numpy.repeat(nation().pk, len(place_ids)), numpy.ones(len(place_ids))
+
+    if place_type == 'county':
+        pairs = County.objects.filter(pk__in=place_ids.tolist()).order_by().values_list('pk','state')
+    else:
+        pairs = ZipCodeCounty.objects.filter(zipcode__in=place_ids.tolist()).order_by().values_list('zipcode','county','zipcode_fraction')
+    pairs = list(pairs.iterator())
+    children = numpy.array([p[0] for p in pairs], dtype=numpy.int64)
+    parent_ids = numpy.array([p[1] for p in pairs], dtype=numpy.int64)
+    if place_type == 'county':
+        weights = numpy.ones(len(pairs))
+    else:
+        # Slivers were dropped from the crosswalk, so make each ZIP code's
+        # shares add up to all of it.
+        weights = numpy.array([p[2] for p in pairs], dtype=float)
+        order = numpy.argsort(children, kind='mergesort')
+        keys, starts = numpy.unique(children[order], return_index=True)
+        totals = numpy.add.reduceat(weights[order], starts) if len(keys) else weights
+        weights = weights / totals[numpy.searchsorted(keys, children)]
+
+    # Positions of the children in place_ids.
+    order = numpy.argsort(place_ids, kind='mergesort')
+    positions = order[numpy.searchsorted(place_ids, children, sorter=order)] if len(children) else children
+    return positions, parent_ids, weights
+
+def group_sums(groups, values):
+    """ (sorted distinct groups, sum of the rows of values in each group). """
+    order = numpy.argsort(groups, kind='mergesort')
+    keys, starts = numpy.unique(groups[order], return_index=True)
+    if not len(keys):
+        return keys, values[:0]
+    return keys, numpy.add.reduceat(values[order], starts, axis=0)
+
+def reduce_level(model, place_type, place_ids, values):
+    """ Rolls the values of places of a type up to their parents. Returns (parent ids, values). """
+    fields = data_fields(model)
+    averages = [(fields.index(avg), fields.index(weight)) for avg, weight in WEIGHTED_AVERAGES.iteritems() if avg in fields]
+
+    positions, parent_ids, weights = parents(place_type, place_ids)
+    rows = values[positions] * weights[:, None]
+    for avg, weight in averages:
+        # Weighted by the (already scaled) count.
+        rows[:, avg] = values[positions, avg] * rows[:, weight]
+
+    parent_ids, sums = group_sums(parent_ids, rows)
+    for avg, weight in averages:
+        counts = sums[:, weight]
+        sums[:, avg] = numpy.where(counts > 0, sums[:, avg] / numpy.where(counts > 0, counts, 1), 0)
+    return parent_ids, sums
+
+# ----- Storing -----
+
+def _db_values(model, values):
+    """ Rows of values as the fields' database values (counts rounded to integers). """
+    fields = [model._meta.get_field(name) for name in data_fields(model)]
+    rounded = numpy.round(values).astype(numpy.int64)
+    result = []
+    for i in xrange(len(values)):
+        row = []
+        for j, field in enumerate(fields):
+            if field.name in WEIGHTED_AVERAGES:
+                row.append(Decimal("%.2f" % values[i, j]))
+            else:
+                row.append(int(rounded[i, j]))
+        result.append(row)
+    return result
+
+def store(model, place_type, source, place_ids, values, scope=None):
+    """
+    Stores roll-up rows for places of a type under a (derived) source:
+    existing rows are updated, new ones inserted, and rows of places in
+    `scope` (every place, if None) that aren't in place_ids are deleted.
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    ct = _ct(place_type)
+    columns = [opts.get_field(name).column for name in data_fields(model)]
+
+    existing = model.objects.filter(place_type=ct, source=source).order_by()
+    if scope is not None:
+        existing = existing.filter(place_id__in=list(scope))
+    existing = dict(existing.values_list('place_id','pk').iterator())
+
+    updates, inserts = [], []
+    for place_id, row in zip(place_ids.tolist(), _db_values(model, values)):
+        pk = existing.pop(place_id, None)
+        if pk is None:
+            inserts.append([ct.pk, place_id, source.pk] + row)
+        else:
+            updates.append(row + [pk])
+
+    cursor = connection.cursor()
+    if updates:
+        cursor.executemany("UPDATE %s SET %s WHERE %s = %%s" % (
+            qn(opts.db_table),
+            ", ".join(["%s = %%s" % qn(c) for c in columns]),
+            qn(opts.pk.column),
+        ), updates)
+    if inserts:
+        keys = [opts.get_field(name).column for name in ('place_type','place_id','source')]
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(opts.db_table),
+            ", ".join([qn(c) for c in keys + columns]),
+            ", ".join(["%s"] * (len(keys) + len(columns))),
+        ), inserts)
+    if existing:
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(opts.db_table),
+            qn(opts.pk.column),
+            ", ".join(["%s"] * len(existing)),
+        ), existing.values())
+
+    transaction.commit_unless_managed()
+
+    # The rows changed behind the caching manager's back.
+    for row in updates:
+        cache.set(model._cache_key(row[-1]), None, 5)
+    for pk in existing.values():
+        cache.set(model._cache_key(pk), None, 5)
+    if model is PlacePopulation:
+        invalidate_csv(place_type, source.pk)
+    return len(updates) + len(inserts)
+
+# ----- Roll-ups -----
+
+def rollup_source(model, source, verbose=False):
+    """ Recomputes every roll-up of a model's data from one (original) source. """
+    if not _any(model.objects.filter(source=source)) and not _any(DataSource.objects.filter(derived_from=source)):
+        return
+    derived = derived_source(source)
+    place_type = 'zipcode'
+    place_ids, values = load(model, place_type, source)
+    while place_type in PARENTS:
+        parent_type = PARENTS[place_type]
+        rolled = reduce_level(model, place_type, place_ids, values)
+        count = store(model, parent_type, derived, *rolled)
+        if verbose:
+            print "  %s, %s: %d %s" % (model._meta.verbose_name_plural, derived, count, parent_type)
+        place_ids, values = merge(load(model, parent_type, source), rolled)
+        place_type = parent_type
+
+@transaction.commit_on_success
+def rollup(models=ROLLUP_MODELS, verbose=False):
+    """ Recomputes every roll-up of every source. """
+    for source in DataSource.objects.filter(derived_from__isnull=True).order_by('date','pk'):
+        for model in models:
+            rollup_source(model, source, verbose)
+
+def children(place_type, parent_ids):
+    """ The ids of the places of a type that roll up to any of parent_ids. """
+    if place_type == 'state':
+        return list(State.objects.order_by().values_list('pk', flat=True))
+    if place_type == 'county':
+        qs = County.objects.filter(state__in=parent_ids).values_list('pk', flat=True)
+    else:
+        qs = ZipCodeCounty.objects.filter(county__in=parent_ids).values_list('zipcode', flat=True).distinct()
+    return list(qs.order_by())
+
+def refresh(model, place_type, place_id, source):
+    """
+    Recomputes the roll-ups above one place's row (of an original source),
+    i.e. after it was saved or deleted.
+    """
+    if source.derived_from_id is not None:
+        return
+    derived = derived_source(source)
+    place_ids = [place_id]
+    while place_type in PARENTS:
+        parent_type = PARENTS[place_type]
+        scope = set(parents(place_type, place_ids)[1].tolist())
+        if not scope:
+            break
+        child_ids = children(place_type, list(scope))
+        child_ids, values = merge(load(model, place_type, source, child_ids), load(model, place_type, derived, child_ids))
+        parent_ids, sums = reduce_level(model, place_type, child_ids, values)
+        keep = numpy.in1d(parent_ids, list(scope))
+        store(model, parent_type, derived, parent_ids[keep], sums[keep], scope)
+        # Places with rows of their own count with those, so nothing above them changes.
+        own = load(model, parent_type, source, list(scope))[0]
+        place_type, place_ids = parent_type, sorted(scope - set(own.tolist()))
+        if not place_ids:
+            break
+
+def deferred_refresh(func):
+    """
+    Decorator for bulk imports: while func runs, saved and deleted rows
+    don't refresh the roll-ups above them one by one. Each source they
+    came from is rolled up once (rollup_source) after func returns. If
+    func raises, nothing is rolled up; run rollup_demographics.
+    """
+    def _deferred_refresh(*args, **kwargs):
+        outer = getattr(_deferred, 'changed', None)
+        if outer is not None:
+            return func(*args, **kwargs)
+        _deferred.changed = set()
+        try:
+            result = func(*args, **kwargs)
+            changed = _deferred.changed
+        finally:
+            _deferred.changed = None
+        for model, source_id in changed:
+            rollup_source(model, DataSource.objects.get(pk=source_id))
+        return result
+    _deferred_refresh.__name__ = func.__name__
+    _deferred_refresh.__doc__ = func.__doc__
+    return _deferred_refresh
+
+def data_changed(sender, instance, **kwargs):
+    """
+    post_save/post_delete receiver for the data models. Rows loaded from
+    fixtures are skipped; run the rollup_demographics command after loaddata.
+    """
+    if kwargs.get('raw'):
+        return
+    try:
+        source = instance.source
+    except DataSource.DoesNotExist:
+        return
+    changed = getattr(_deferred, 'changed', None)
+    if changed is not None:
+        if source.derived_from_id is None:
+            changed.add((sender, source.pk))
+        return
+    place_type = instance.place_type.model
+    if place_type in PARENTS:
+        refresh(sender, place_type, instance.place_id, source)
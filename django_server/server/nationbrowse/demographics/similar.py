@@ -0,0 +1,175 @@
+# coding=utf-8
+"""
+"Places like this one": nearest neighbors in a space of demographic shares.
+
+Each place is described by the latest PlacePopulation record it has, as:
+
+ * the share of its people in each of the age brackets of
+   PlacePopulation.age_fields,
+ * the share in each one-race group (and of two or more races),
+ * its average household and family sizes, and the shares of households
+   that are families and of people who live in households,
+ * the share of its people who live in urban areas.
+
+Every feature is standardized (z-scores over the place type), and each
+group is weighted by 1/sqrt(its size) so that the 18 age brackets count no
+more than urbanization does. The resulting matrix is loaded once per
+process per place type -- from the columnar snapshot, if there is one --
+into a scipy cKDTree, which finds the exact k nearest places (Euclidean
+distance) in well under a millisecond even for the ZIP codes. Results are
+kept per place, so each is only ever searched for once per process.
+"""
+from __future__ import division
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from scipy.spatial import cKDTree
+from threading import Lock
+from time import time
+import numpy
+
+from nationbrowse.places.geocode import place_info
+from nationbrowse.demographics.models import PlacePopulation,latest_values
+from nationbrowse.demographics.columnar import current_version,get_table
+from nationbrowse.demographics.metrics import AGE_BRACKETS,RACE_FIELDS,MIXED_RACE_FIELDS
+
+MAX_K = 25
+MAX_AGE_SECONDS = 3600
+
+# Age brackets of PlacePopulation.age_fields: (first age, first age of the next).
+AGE_GROUPS = [(int(f.split('_')[1]), f.endswith('_plus') and 200 or int(f.split('_')[2]) + 1)
+              for f, short, long in PlacePopulation.age_fields]
+
+HOUSEHOLD_FIELDS = ('num_households','pop_in_households','avg_household_size','num_families','pop_in_families','avg_family_size')
+
+INPUT_FIELDS = tuple([b[0] for b in AGE_BRACKETS]) + RACE_FIELDS + MIXED_RACE_FIELDS + HOUSEHOLD_FIELDS + ('total','urban')
+
+def _share(part, whole):
+    return part / numpy.where(whole > 0, whole, 1)
+
+def feature_groups(columns):
+    """
+    The raw (unstandardized) features of some records, from {field: array}
+    of their INPUT_FIELDS: a list of (records x features) matrices, one per
+    group of features.
+    """
+    columns = dict([(f, numpy.asarray(columns[f], dtype=float)) for f in INPUT_FIELDS])
+    total = columns['total']
+
+    ages = numpy.zeros((len(total), len(AGE_GROUPS)))
+    for field, low, high in AGE_BRACKETS:
+        for i, (group_low, group_high) in enumerate(AGE_GROUPS):
+            if group_low <= low < group_high:
+                ages[:, i] += columns[field]
+    ages = _share(ages, ages.sum(axis=1)[:, None])
+
+    races = numpy.column_stack([columns[f] for f in RACE_FIELDS] + [sum([columns[f] for f in MIXED_RACE_FIELDS])])
+    races = _share(races, races.sum(axis=1)[:, None])
+
+    households = numpy.column_stack((
+        columns['avg_household_size'],
+        columns['avg_family_size'],
+        _share(columns['num_families'], columns['num_households']),
+        _share(columns['pop_in_households'], total),
+    ))
+    urban = _share(columns['urban'], total)[:, None]
+    return [ages, races, households, urban]
+
+def feature_matrix(groups):
+    """ Standardizes and weights feature groups (see the module docstring) into one matrix. """
+    matrices = []
+    for group in groups:
+        if not len(group):
+            matrices.append(group)
+            continue
+        std = group.std(axis=0)
+        scaled = (group - group.mean(axis=0)) / numpy.where(std > 0, std, 1)
+        matrices.append(scaled / numpy.sqrt(group.shape[1]))
+    return numpy.hstack(matrices)
+
+class SimilarityIndex(object):
+    """
+    A KD-tree over the feature vectors of one place type. Results are lists
+    of (pk, distance), most similar first.
+    """
+    def __init__(self, pks, matrix):
+        self.pks = numpy.asarray(pks, dtype=numpy.int64)
+        self.matrix = numpy.asarray(matrix, dtype=float)
+        self.row_for_pk = dict(zip(self.pks.tolist(), xrange(len(self.pks))))
+        self.tree = cKDTree(self.matrix) if len(self.pks) else None
+        self._results = {}
+
+    def __len__(self):
+        return len(self.pks)
+
+    def similar_to(self, pk, k=10):
+        """ The k places most similar to a place of this type (not counting itself). """
+        row = self.row_for_pk.get(pk)
+        if row is None:
+            return []
+        results = self._results.get(pk)
+        if results is None:
+            fetch = min(len(self), MAX_K + 1)
+            dist, rows = self.tree.query(self.matrix[row], k=fetch)
+            dist, rows = numpy.atleast_1d(dist), numpy.atleast_1d(rows)
+            keep = rows != row
+            results = self._results[pk] = zip(self.pks[rows[keep]].tolist(), dist[keep].tolist())[:MAX_K]
+        return results[:k]
+
+def load_inputs(place_type):
+    """
+    Returns (place ids, {field: array}) of the INPUT_FIELDS of each place's
+    latest PlacePopulation record, from the columnar snapshot if there is one.
+    """
+    table = get_table(PlacePopulation, place_type)
+    if table is not None:
+        rows = table.latest_rows()
+        return numpy.asarray(table.places), dict([(f, table.column(f)[rows]) for f in INPUT_FIELDS])
+
+    PlaceClass = get_model('places', place_type)
+    qs = PlacePopulation.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass))
+    latest = latest_values(qs, *INPUT_FIELDS)
+    pks = sorted(latest)
+    columns = zip(*[latest[pk] for pk in pks]) or [()] * len(INPUT_FIELDS)
+    return numpy.array(pks, dtype=numpy.int64), dict([(f, numpy.array(columns[i], dtype=float)) for i, f in enumerate(INPUT_FIELDS)])
+
+def build_index(place_type):
+    pks, columns = load_inputs(place_type)
+    # Places with no people have no shares to compare.
+    keep = numpy.asarray(columns['total']) > 0
+    columns = dict([(f, numpy.asarray(v)[keep]) for f, v in columns.iteritems()])
+    return SimilarityIndex(pks[keep], feature_matrix(feature_groups(columns)))
+
+_indexes = {}
+_indexes_lock = Lock()
+
+def get_similarity_index(place_type):
+    """ The SimilarityIndex for a place type (built on first use, and after data changes). """
+    version = current_version()
+    entry = _indexes.get(place_type)
+    if entry is None or entry[0] != version or time() - entry[1] > MAX_AGE_SECONDS:
+        _indexes_lock.acquire()
+        try:
+            entry = _indexes.get(place_type)
+            if entry is None or entry[0] != version or time() - entry[1] > MAX_AGE_SECONDS:
+                entry = _indexes[place_type] = (version, time(), build_index(place_type))
+        finally:
+            _indexes_lock.release()
+    return entry[2]
+
+def reset():
+    """ Drops the indexes (they will be rebuilt on next use). """
+    _indexes.clear()
+
+def similar_places(place_type, pk, k=8):
+    """
+    The k places of the same type most demographically similar to the given
+    place, as {'id','name','url','distance'} dicts.
+    """
+    places = []
+    for similar_pk, distance in get_similarity_index(place_type).similar_to(pk, k):
+        info = place_info(place_type, similar_pk)
+        if info:
+            info = dict(info)
+            info['distance'] = distance
+            places.append(info)
+    return places
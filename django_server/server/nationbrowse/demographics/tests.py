@@ -4,6 +4,22 @@ Unit tests for Demographics.
 """
 
 from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from nationbrowse.places.models import Nation,State,County,ZipCode,ZipCodeCounty
+from nationbrowse.demographics.models import DataSource,PlacePopulation,DerivedMetrics
+from nationbrowse.demographics.classify import class_breaks,jenks_breaks,interpolate_colors,style,load_values
+from nationbrowse.demographics import columnar,rollup,ranking,metrics,similar,export
+from nationbrowse.places import registry
+from datetime import date
+from decimal import Decimal
+import tempfile
+import os
+import shutil
+from cStringIO import StringIO
+import csv
+import gzip
+import json
+import numpy
 
 # Make HTTP requests inside tests never time out.
 import socket
@@ -15,3 +31,472 @@ class DemographicsTest(TestCase):
         TODO
         """
         self.assert_(True)
+
+class ClassifyTest(TestCase):
+    def test_breaks(self):
+        values = [1, 2, 3, 4, 10, 11, 12, 50, 51, numpy.nan]
+        self.assertEqual(class_breaks(values, 'quantile', 2), [10.0, 51.0])
+        self.assertEqual(class_breaks(values, 'equal_interval', 2), [26.0, 51.0])
+        self.assertEqual(class_breaks(values, 'jenks', 3), [4.0, 12.0, 51.0])
+        self.assertEqual(class_breaks([], 'jenks', 3), [])
+
+    def test_jenks_bins(self):
+        # Binned Jenks still finds well-separated clusters.
+        values = numpy.concatenate([numpy.arange(1000.), numpy.arange(5000., 6000.)])
+        self.assertEqual(jenks_breaks(values, 2, max_bins=100), [999.0, 5999.0])
+
+    def test_style(self):
+        self.assertEqual(interpolate_colors(['#000000', '#FFFFFF'], 3), ['#000000', '#808080', '#FFFFFF'])
+        self.assertEqual(style([10, 20], 1, ['#000000', '#FFFFFF']), [[1, '#000000'], [10, '#FFFFFF']])
+
+    def test_class_breaks_view(self):
+        for i, density in enumerate((5, 10, 20, 400)):
+            State.objects.create(name="State %d" % i,slug="s%d" % i,abbr="S%d" % i,ap_style="S%d" % i,pop_density=density)
+        response = self.client.get('/demographics/classes/state/pop_density/', {'method':'jenks','k':2})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['breaks'], [20.0, 400.0])
+        self.assertEqual([low for low, color in data['style']], [5.0, 20.0])
+        self.assertEqual(self.client.get('/demographics/classes/state/bogus/').status_code, 404)
+        self.assertEqual(self.client.get('/demographics/classes/state/pop_density/', {'k':50}).status_code, 400)
+        self.assertEqual(self.client.get('/demographics/classes/state/pop_density/', {'method':'bogus'}).status_code, 400)
+
+class ColumnarTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_dir = columnar.COLUMNAR_DIR
+        columnar.COLUMNAR_DIR = self.root
+        columnar.reset()
+
+        state_ct = ContentType.objects.get_for_model(State)
+        census_1990 = DataSource.objects.create(source="Census", date=date(1990,1,1))
+        self.census = DataSource.objects.create(source="Census", date=date(2000,1,1))
+        for pk, total in ((3, 300), (1, 100)):
+            PlacePopulation.objects.create(place_type=state_ct, place_id=pk, source=self.census,
+                total=total, avg_household_size=Decimal("2.50"), avg_family_size=Decimal("3.10"))
+        PlacePopulation.objects.create(place_type=state_ct, place_id=1, source=census_1990,
+            total=90, avg_household_size=Decimal("2.75"), avg_family_size=Decimal("3.20"))
+
+    def tearDown(self):
+        columnar.COLUMNAR_DIR = self.old_dir
+        columnar.reset()
+        shutil.rmtree(self.root)
+
+    def test_no_snapshot(self):
+        self.assertEqual(columnar.get_table(PlacePopulation, 'state'), None)
+        self.assertEqual(load_values('state', 'total'), {1:100, 3:300})
+
+    def test_snapshot(self):
+        version = columnar.build_snapshot()
+        self.assertEqual(columnar.snapshot_version(), version)
+        table = columnar.get_table(PlacePopulation, 'state')
+        self.assertEqual(len(table), 3)
+        self.assertEqual(len(columnar.get_table('crimedata', 'state')), 0)
+        self.assertEqual(columnar.get_table(PlacePopulation, 'county').latest_source(), None)
+
+        # Sorted by place, then oldest source first; columns are read-only maps.
+        total = table.column('total')
+        self.assert_(isinstance(total, numpy.memmap))
+        self.assertEqual(total.dtype, numpy.uint32)
+        self.assertEqual(total.tolist(), [90, 100, 300])
+        self.assertEqual(table.column('avg_household_size').tolist(), [2.75, 2.5, 2.5])
+        self.assertRaises(ValueError, total.__setitem__, 0, 1)
+
+        rows = table.place_rows(1)
+        self.assertEqual((rows.start, rows.stop), (0, 2))
+        self.assertEqual(table.place_rows(2), slice(0, 0))
+        self.assertEqual(table.row_slice(rows, ['total'])['total'].tolist(), [90, 100])
+        self.assertEqual(table.place_data(1, fields=['total']), {'total':100})
+        self.assertEqual(table.place_data(2), None)
+        self.assertEqual(table.latest_rows().tolist(), [1, 2])
+        self.assertEqual(table.latest_source(), self.census.pk)
+        self.assertEqual(load_values('state', 'total'), {1:100, 3:300})
+
+        # A rebuild replaces the snapshot, keeping the one before it.
+        newer = columnar.build_snapshot()
+        self.assertEqual(columnar.snapshot_version(), newer)
+        columnar.build_snapshot()
+        self.assertEqual(sorted(n for n in os.listdir(self.root) if n != columnar.CURRENT_FILE)[0], newer)
+
+class RollupTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_dir = columnar.COLUMNAR_DIR
+        columnar.COLUMNAR_DIR = self.root
+        columnar.reset()
+
+        self.a = State.objects.create(name="A",slug="a",abbr="A",ap_style="A")
+        self.b = State.objects.create(name="B",slug="b",abbr="B",ap_style="B")
+        self.counties = [
+            County.objects.create(name="C%d" % i,slug="c%d" % i,long_name="C%d County" % i,state=state)
+            for i, state in enumerate((self.a, self.a, self.b))
+        ]
+        self.census = DataSource.objects.create(source="Census", date=date(2000,1,1))
+
+    def tearDown(self):
+        columnar.COLUMNAR_DIR = self.old_dir
+        columnar.reset()
+        shutil.rmtree(self.root)
+
+    def population(self, place, source, total, households=0, household_size="0"):
+        return PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(place), place_id=place.pk,
+            source=source, total=total, num_households=households, avg_household_size=Decimal(household_size),
+            avg_family_size=Decimal("0"))
+
+    def rollups(self, source, PlaceClass, field='total'):
+        qs = PlacePopulation.objects.filter(source__derived_from=source, place_type=ContentType.objects.get_for_model(PlaceClass))
+        return dict(qs.values_list('place_id', field))
+
+    def test_counties(self):
+        c0, c1, c2 = self.counties
+        self.population(c0, self.census, 100, 40, "2.50")
+        row = self.population(c1, self.census, 50, 10, "2.00")
+        last = self.population(c2, self.census, 30)
+
+        nation = Nation.objects.get()
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:150, self.b.pk:30})
+        self.assertEqual(self.rollups(self.census, Nation), {nation.pk:180})
+        # Household sizes are weighted by households.
+        self.assertEqual(self.rollups(self.census, State, 'avg_household_size'), {self.a.pk:Decimal("2.40"), self.b.pk:Decimal("0")})
+        self.assertEqual(self.rollups(self.census, Nation, 'avg_household_size'), {nation.pk:Decimal("2.40")})
+        self.assertEqual(self.rollups(self.census, County), {})
+
+        # Changes refresh just the places above.
+        row.total = 70
+        row.save()
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:170, self.b.pk:30})
+        last.delete()
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:170})
+        self.assertEqual(self.rollups(self.census, Nation), {nation.pk:170})
+
+        # A full roll-up from the columnar snapshot agrees.
+        PlacePopulation.objects.filter(source__derived_from=self.census).delete()
+        columnar.build_snapshot()
+        rollup.rollup()
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:170})
+        self.assertEqual(self.rollups(self.census, Nation), {nation.pk:170})
+
+    def test_zipcodes(self):
+        c0, c1, c2 = self.counties
+        z0 = ZipCode.objects.create(name="00001",slug="00001")
+        z1 = ZipCode.objects.create(name="00002",slug="00002")
+        # Shares are normalized: 2/3 of z0 is in c0.
+        for zipcode, county, share in ((z0, c0, .5), (z0, c1, .25), (z1, c2, 1)):
+            ZipCodeCounty.objects.create(zipcode=zipcode, county=county, overlap_area=share,
+                zipcode_fraction=share, county_fraction=share)
+        zcta = DataSource.objects.create(source="ZCTA", date=date(2000,1,1))
+        self.population(z0, zcta, 90, 30, "3.00")
+        self.population(z1, zcta, 10)
+
+        self.assertEqual(self.rollups(zcta, County), {c0.pk:60, c1.pk:30, c2.pk:10})
+        self.assertEqual(self.rollups(zcta, County, 'avg_household_size'), {c0.pk:Decimal("3.00"), c1.pk:Decimal("3.00"), c2.pk:Decimal("0")})
+        self.assertEqual(self.rollups(zcta, State), {self.a.pk:90, self.b.pk:10})
+        self.assertEqual(self.rollups(zcta, Nation).values(), [100])
+
+        # A county with data of its own counts with that; the others still
+        # count with what their ZIP codes sum to.
+        self.population(c0, zcta, 5)
+        self.assertEqual(self.rollups(zcta, County), {c0.pk:60, c1.pk:30, c2.pk:10})
+        self.assertEqual(self.rollups(zcta, State), {self.a.pk:35, self.b.pk:10})
+        self.assertEqual(self.rollups(zcta, Nation).values(), [45])
+
+        # A full roll-up agrees.
+        PlacePopulation.objects.filter(source__derived_from=zcta).delete()
+        rollup.rollup()
+        self.assertEqual(self.rollups(zcta, County), {c0.pk:60, c1.pk:30, c2.pk:10})
+        self.assertEqual(self.rollups(zcta, State), {self.a.pk:35, self.b.pk:10})
+
+    def test_deferred_refresh(self):
+        c0, c1, c2 = self.counties
+        self.population(c0, self.census, 100)
+        calls = []
+        refresh = rollup.refresh
+        rollup.refresh = lambda *args: calls.append(args)
+        try:
+            @rollup.deferred_refresh
+            def bulk_import():
+                for county, total in ((c1, 50), (c2, 30)):
+                    row = self.population(county, self.census, 0)
+                    row.total = total
+                    row.save()
+                self.assertEqual(self.rollups(self.census, State), {self.a.pk:100})
+                return len(calls)
+            self.assertEqual(bulk_import(), 0)
+        finally:
+            rollup.refresh = refresh
+        # Rolled up once, after the import.
+        self.assertEqual(calls, [])
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:150, self.b.pk:30})
+        self.assertEqual(self.rollups(self.census, Nation).values(), [180])
+
+        # Outside of it, saves refresh row by row again.
+        row = PlacePopulation.objects.get(place_id=c2.pk, source=self.census)
+        row.total = 40
+        row.save()
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:150, self.b.pk:40})
+
+    def test_latest(self):
+        for county, total in zip(self.counties, (100, 50, 30)):
+            self.population(county, self.census, total)
+        # Stored after State B's roll-up, under the same source date.
+        self.population(self.b, self.census, 300)
+        estimate = DataSource.objects.create(source="Estimate", date=date(2005,1,1))
+        self.population(self.a, estimate, 1000)
+        nation = Nation.objects.get()
+        self.assertEqual(self.rollups(self.census, State), {self.a.pk:150, self.b.pk:30})
+        # The Nation counts State B's own row.
+        self.assertEqual(self.rollups(self.census, Nation), {nation.pk:450})
+
+        # Places show their most recent own rows over any roll-ups, and
+        # roll-ups only where they have none.
+        self.assertEqual(State.objects.get(pk=self.a.pk).population_demographics.total, 1000)
+        self.assertEqual(State.objects.get(pk=self.b.pk).population_demographics.total, 300)
+        self.assertEqual(Nation.objects.get().population_demographics.total, 1000)
+        for snapshot in (False, True):
+            if snapshot:
+                columnar.build_snapshot()
+                table = columnar.get_table(PlacePopulation, 'state')
+                self.assertEqual(table.latest_source(), estimate.pk)
+                self.assertEqual(table.place_data(self.b.pk, fields=['total']), {'total':300})
+            self.assertEqual(load_values('state', 'total'), {self.a.pk:1000})
+            pks, columns = similar.load_inputs('state')
+            self.assertEqual(dict(zip(pks.tolist(), columns['total'].tolist())), {self.a.pk:1000, self.b.pk:300})
+
+class RankingTest(TestCase):
+    def setUp(self):
+        registry.reset()
+        ranking.reset()
+
+    def test_ranking(self):
+        r = ranking.Ranking([1, 2, 3, 4, 5], [10, 30, 30, 5, numpy.nan])
+        self.assertEqual(len(r), 4)
+        self.assertEqual(r.top(3), [(2, 30.0, 1), (3, 30.0, 1), (1, 10.0, 3)])
+        self.assertEqual(r.top(2, 1, ascending=True), [(1, 10.0, 3), (3, 30.0, 1)])
+        self.assertEqual(r.rank(1), {'value':10.0, 'rank':3, 'percentile':50.0, 'count':4})
+        self.assertEqual(r.rank(3)['percentile'], 100.0)
+        self.assertEqual(r.rank(5), None)
+        self.assertEqual(r.ranks(numpy.array([31, 0])).tolist(), [1, 5])
+
+    def test_rankings(self):
+        mo = State.objects.create(name="Missouri",slug="missouri",abbr="MO",ap_style="Mo.",pop_density=80)
+        ks = State.objects.create(name="Kansas",slug="kansas",abbr="KS",ap_style="Kan.",pop_density=30)
+        counties = [
+            County.objects.create(name=name,slug=name.lower(),long_name="%s County" % name,state=state,pop_density=density)
+            for name, state, density in (("Boone", mo, 240.5), ("Howard", mo, 20), ("Douglas", ks, 240.5), ("Linn", ks, 16))
+        ]
+        boone = counties[0]
+
+        rankings = ranking.get_rankings('county', 'pop_density')
+        self.assertEqual(rankings.nation.rank(boone.pk)['rank'], 1)
+        self.assertEqual(rankings.ranking('mo').top(5), [(boone.pk, 240.5, 1), (counties[1].pk, 20.0, 2)])
+        self.assertEqual(rankings.ranking('TX'), None)
+
+        ranks = dict([(r['field'], r) for r in ranking.place_ranks('county', counties[1].pk)])
+        self.assertEqual(ranks['pop_density']['label'], u"population density (per sq. mi.)")
+        self.assertEqual((ranks['pop_density']['rank'], ranks['pop_density']['count']), (3, 4))
+        self.assertEqual((ranks['pop_density']['state_rank'], ranks['pop_density']['state_count']), (2, 2))
+
+        response = self.client.get('/demographics/rankings/county/pop_density/', {'state':'KS', 'id':counties[3].pk})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['count'], 2)
+        self.assertEqual([(p['id'], p['rank']) for p in data['places']], [(counties[2].pk, 1), (counties[3].pk, 2)])
+        self.assertEqual(data['place']['percentile'], 50.0)
+        data = json.loads(self.client.get('/demographics/rankings/state/pop_density/', {'limit':1, 'order':'asc'}).content)
+        self.assertEqual([p['id'] for p in data['places']], [ks.pk])
+        self.assertEqual(self.client.get('/demographics/rankings/county/bogus/').status_code, 404)
+        self.assertEqual(self.client.get('/demographics/rankings/county/pop_density/', {'state':'TX'}).status_code, 404)
+        self.assertEqual(self.client.get('/demographics/rankings/state/pop_density/', {'state':'MO'}).status_code, 400)
+        self.assertEqual(self.client.get('/demographics/rankings/state/pop_density/', {'limit':'x'}).status_code, 400)
+
+        response = self.client.get(boone.get_absolute_url())
+        self.assertContains(response, "#1 of 4")
+
+class MetricsTest(TestCase):
+    def inputs(self, **values):
+        columns = dict([(f, [0]) for f in metrics.INPUT_FIELDS])
+        columns.update([(f, [v]) for f, v in values.iteritems()])
+        return columns
+
+    def test_compute(self):
+        result = metrics.compute(self.inputs(age_0_4=10, age_30_34=10, age_70_74=10, male=10, female=20,
+            onerace_white=15, onerace_black=10, tworace=5, total=30, urban=12), [2.0])
+        self.assertEqual(result['median_age'].tolist(), [32.5])
+        self.assertAlmostEqual(result['mean_age'][0], 35.8333, 4)
+        self.assertEqual((result['youth_dependency_ratio'][0], result['old_age_dependency_ratio'][0], result['dependency_ratio'][0]), (100, 100, 200))
+        self.assertEqual(result['sex_ratio'].tolist(), [50.0])
+        self.assertAlmostEqual(result['diversity_index'][0], 1 - (.5 ** 2 + (1/3.) ** 2 + (1/6.) ** 2))
+        self.assertEqual(result['urban_share'].tolist(), [40.0])
+        self.assertEqual(result['pop_per_sq_mi'].tolist(), [15.0])
+
+        # Undefined where there's no one to divide by.
+        empty = metrics.compute(self.inputs())
+        self.assert_(all([numpy.isnan(v[0]) for v in empty.values()]))
+
+    def test_median_interpolation(self):
+        counts = numpy.array([[1, 1, 2], [0, 4, 0], [0, 0, 0]], dtype=float)
+        medians = metrics.median_ages(counts, [0, 10, 20], [10, 20, 30])
+        self.assertEqual(medians[:2].tolist(), [20.0, 15.0])
+        self.assert_(numpy.isnan(medians[2]))
+
+    def test_build(self):
+        state = State.objects.create(name="A",slug="a",abbr="A",ap_style="A",area_sq_mi=10)
+        census = DataSource.objects.create(source="Census", date=date(2000,1,1))
+        PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(State), place_id=state.pk,
+            source=census, total=30, age_0_4=10, age_30_34=10, age_70_74=10,
+            avg_household_size=Decimal("0"), avg_family_size=Decimal("0"))
+        metrics.build_metrics(['state'])
+        row = DerivedMetrics.objects.get(place_id=state.pk, source=census)
+        self.assertEqual((row.median_age, row.pop_per_sq_mi, row.sex_ratio), (32.5, 3.0, None))
+        self.assertEqual(load_values('state', 'median_age'), {state.pk:32.5})
+        # Rebuilding replaces the rows.
+        metrics.build_metrics(['state'])
+        self.assertEqual(DerivedMetrics.objects.count(), 1)
+
+class SimilarTest(TestCase):
+    def setUp(self):
+        registry.reset()
+        similar.reset()
+
+    def test_index(self):
+        index = similar.SimilarityIndex([10, 20, 30, 40], [[0, 0], [1, 0], [5, 5], [0, 2]])
+        self.assertEqual(index.similar_to(10, 2), [(20, 1.0), (40, 2.0)])
+        self.assertEqual([pk for pk, d in index.similar_to(30)], [40, 20, 10])
+        self.assertEqual(index.similar_to(50), [])
+
+    def test_features(self):
+        # Shares don't depend on the size of the place.
+        ages, races, households, urban = similar.feature_groups(dict([(f, [1, 2]) for f in similar.INPUT_FIELDS]))
+        self.assertEqual(ages.shape, (2, len(PlacePopulation.age_fields)))
+        self.assertEqual(ages[0].tolist(), ages[1].tolist())
+        self.assertEqual(urban.tolist(), [[1.0], [1.0]])
+
+        # Standardized, and each group weighted by 1/sqrt(its size).
+        matrix = similar.feature_matrix([numpy.array([[1., 5.], [3., 5.]]), numpy.array([[0.], [1.]])])
+        self.assert_(numpy.allclose(matrix, [[-1 / numpy.sqrt(2), 0, -1], [1 / numpy.sqrt(2), 0, 1]]))
+
+    def test_similar_places(self):
+        ct = ContentType.objects.get_for_model(State)
+        census = DataSource.objects.create(source="Census", date=date(2000,1,1))
+        states = []
+        for i, (young, old, urban) in enumerate(((90, 10, 90), (85, 15, 80), (10, 90, 5), (20, 80, 10))):
+            state = State.objects.create(name="S%d" % i,slug="s%d" % i,abbr="S%d" % i,ap_style="S%d" % i)
+            PlacePopulation.objects.create(place_type=ct, place_id=state.pk, source=census, total=100, urban=urban,
+                age_0_4=young, age_70_74=old, onerace_white=100, avg_household_size=Decimal("2.5"), avg_family_size=Decimal("3"))
+            states.append(state)
+        State.objects.create(name="Empty",slug="empty",abbr="E",ap_style="E")
+
+        self.assertEqual([p['id'] for p in similar.similar_places('state', states[0].pk, 2)], [states[1].pk, states[3].pk])
+        response = self.client.get('/demographics/similar/state/%d/' % states[2].pk, {'k':1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['id'] for p in json.loads(response.content)['places']], [states[3].pk])
+        self.assertEqual(self.client.get('/demographics/similar/state/99999/').status_code, 404)
+        self.assertEqual(self.client.get('/demographics/similar/state/%d/' % states[0].pk, {'k':0}).status_code, 400)
+
+class CsvExportTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_dir = export.CSV_CACHE_DIR
+        export.CSV_CACHE_DIR = self.root
+        # Background writes are run by the test (a thread wouldn't see the test database).
+        self.background = []
+        self.old_call_in_bg = export.call_in_bg
+        export.call_in_bg = lambda function, args=[], kwargs={}: self.background.append((function, args))
+        registry.reset()
+
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        ks = State.objects.create(name="Kansas",slug="ks",abbr="KS",ap_style="Kan.")
+        self.boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=mo)
+        self.cole = County.objects.create(name="Cole",slug="cole-mo",long_name="Cole County",state=mo)
+        self.douglas = County.objects.create(name="Douglas",slug="douglas-ks",long_name="Douglas County",state=ks)
+        self.source = DataSource.objects.create(source="Census",date=date(2000,1,1))
+        ct = ContentType.objects.get_for_model(County)
+        for county, total in ((self.boone, 135454), (self.douglas, 99962)):
+            PlacePopulation.objects.create(place_type=ct, place_id=county.pk, source=self.source, total=total,
+                avg_household_size=Decimal("2.38"), avg_family_size=Decimal("2.91"))
+
+    def tearDown(self):
+        export.CSV_CACHE_DIR = self.old_dir
+        export.call_in_bg = self.old_call_in_bg
+        shutil.rmtree(self.root)
+
+    def run_background(self):
+        for function, args in self.background:
+            function(*args)
+        self.background = []
+
+    def rows(self, content):
+        rows = list(csv.DictReader(StringIO(content)))
+        return [(int(row['id']), int(row['total'])) for row in rows]
+
+    def test_csv(self):
+        # Only places with demographics.
+        response = self.client.get('/demographics/csv/county/', {'state':'mo'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(self.rows(response.content), [(self.boone.pk, 135454)])
+        self.assertEqual(self.background, [])
+
+        response = self.client.get('/demographics/csv/county/%d/' % self.douglas.pk, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(self.rows(gzip.GzipFile(fileobj=StringIO(response.content)).read()), [(self.douglas.pk, 99962)])
+
+        self.assertEqual(self.client.get('/demographics/csv/county/99999/').status_code, 404)
+        self.assertEqual(self.client.get('/demographics/csv/county/', {'source':'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/demographics/csv/county/', {'source':99999}).status_code, 404)
+
+    def test_cached_csv(self):
+        # A miss is streamed, and the file written in the background (once).
+        for i in range(2):
+            response = self.client.get('/demographics/csv/county/')
+            self.assertEqual(self.rows(response.content), [(self.boone.pk, 135454), (self.douglas.pk, 99962)])
+            self.failIf(response.has_header('ETag'))
+        self.assertEqual(len(self.background), 1)
+        self.assertEqual(os.listdir(self.root), [])
+        self.run_background()
+        self.assertEqual(os.listdir(self.root), ["county-source_%d.csv.gz" % self.source.pk])
+
+        response = self.client.get('/demographics/csv/county/')
+        self.assertEqual(self.rows(response.content), [(self.boone.pk, 135454), (self.douglas.pk, 99962)])
+        etag = response['ETag']
+
+        # The same file, compressed; and conditional requests.
+        response = self.client.get('/demographics/csv/county/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(self.rows(gzip.GzipFile(fileobj=StringIO(response.content)).read())), 2)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get('/demographics/csv/county/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Changing the data drops the cached file.
+        PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(County), place_id=self.cole.pk,
+            source=self.source, total=71397, avg_household_size=Decimal("2.4"), avg_family_size=Decimal("3"))
+        self.assertEqual(os.listdir(self.root), [])
+        response = self.client.get('/demographics/csv/county/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.rows(response.content)), 3)
+
+        # A write that read the data before a change is dropped.
+        PlacePopulation.objects.filter(place_id=self.cole.pk).delete()
+        self.run_background()
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_default_source(self):
+        # A newer source without population data (i.e. the crime data's)
+        # isn't the default.
+        DataSource.objects.create(source="FBI Uniform Crime Reporting Program",date=date(2008,1,1))
+        self.assertEqual(export.default_source('county'), self.source.pk)
+        self.assertEqual(export.default_source('zipcode'), None)
+        response = self.client.get('/demographics/csv/county/')
+        self.assertEqual(len(self.rows(response.content)), 2)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=county-source_%d.csv' % self.source.pk)
+        self.run_background()
+        self.assertEqual(os.listdir(self.root), ["county-source_%d.csv.gz" % self.source.pk])
+        self.assertEqual(len(self.rows(self.client.get('/demographics/csv/county/').content)), 2)
+        self.assertEqual(self.client.get('/demographics/csv/zipcode/').status_code, 404)
+
+        # A newer source with population data is.
+        estimate = DataSource.objects.create(source="Estimate",date=date(2005,1,1))
+        PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(County), place_id=self.cole.pk,
+            source=estimate, total=75000, avg_household_size=Decimal("2.4"), avg_family_size=Decimal("3"))
+        self.assertEqual(export.default_source('county'), estimate.pk)
+        self.assertEqual(self.rows(self.client.get('/demographics/csv/county/').content), [(self.cole.pk, 75000)])
@@ -4,8 +4,28 @@ import views
 
 urlpatterns = patterns('',
     url(
-        regex   = '^csv/(?P<place_type>[-\w]+)/(?P<slug>[-\w]+)/source_(?P<source_id>[-\w]+)/$',
+        regex   = '^csv/(?P<place_type>state|county|zipcode)/$',
         view    = views.demographics_csv,
         name    = 'demographics_csv',
     ),
+    url(
+        regex   = '^csv/(?P<place_type>state|county|zipcode)/(?P<pk>\d+)/$',
+        view    = views.demographics_csv,
+        name    = 'place_demographics_csv',
+    ),
+    url(
+        regex   = '^classes/(?P<place_type>state|county|zipcode)/(?P<field>\w+)/$',
+        view    = views.class_breaks,
+        name    = 'class_breaks',
+    ),
+    url(
+        regex   = '^rankings/(?P<place_type>state|county|zipcode)/(?P<field>\w+)/$',
+        view    = views.rankings,
+        name    = 'rankings',
+    ),
+    url(
+        regex   = '^similar/(?P<place_type>state|county|zipcode)/(?P<pk>\d+)/$',
+        view    = views.similar,
+        name    = 'similar',
+    ),
 )
@@ -1,31 +1,198 @@
 # coding=utf-8
-from cacheutil import safe_get_cache,safe_set_cache
-from django.shortcuts import get_object_or_404,render_to_response
-from django.http import Http404
-from django.template import RequestContext
-from models import PlacePopulation
-
-def demographics_csv(request,place_type,slug,source_id):
-    # Not complete yet.
-    raise Http404
-    """
-    cache_key = "demographics_csv place_type=%s slug=%s source_id=%s" % (place_type, slug, source_id)
-    response = safe_get_cache(cache_key)
-
-    if not response:
-        try:
-            demographics = PlacePopulation.objects.get(
-                place_type__name=place_type,
-                
-            )
-        
-        response=render_to_response("places/place_detail.html",{
-            'title':title,
-            'place':place,
-            'demographics':getattr(place.population_demographics,'__dict__',{}),
-            'place_type':place_type
-        },context_instance=RequestContext(request))
-        
-        safe_set_cache(cache_key,response,86400)
+from django.shortcuts import get_object_or_404
+from django.http import Http404,HttpResponse,HttpResponseBadRequest
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from models import DataSource
+from nationbrowse.demographics.classify import get_breaks,style,is_classifiable,METHODS,MAX_CLASSES,DEFAULT_COLORS
+from nationbrowse.demographics.ranking import ranking
+from nationbrowse.demographics.similar import similar_places,MAX_K as MAX_SIMILAR_K
+from nationbrowse.demographics.export import csv_chunks,cache_path,cached_etag,open_cached_csv,default_source
+from nationbrowse.places.geocode import place_info
+from nationbrowse.places.models import State
+from streamutil import gzip_stream,read_stream
+
+import json
+import re
+
+HEX_COLOR = re.compile(r'^#?[0-9a-fA-F]{6}$')
+
+MAX_RANKING_LIMIT = 100
+
+def _accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING','')
+
+def _csv_source(request,place_type):
+    """ The DataSource pk a CSV request is for (see default_source()). Raises ValueError if it's malformed. """
+    source = request.GET.get('source')
+    if source:
+        return get_object_or_404(DataSource,pk=int(source)).pk
+    source = default_source(place_type)
+    if source is None:
+        raise Http404
+    return source
+
+def _csv_etag(request,place_type,pk=None):
+    # Only whole place types are cached (see export.py).
+    if pk is not None or request.GET.get('state'):
+        return None
+    try:
+        source = _csv_source(request,place_type)
+    except ValueError:
+        return None
+    etag = cached_etag(cache_path(place_type, source))
+    if etag is None:
+        # Not cached (yet); streamed without one.
+        return None
+    if _accepts_gzip(request):
+        etag += "-gzip"
+    return etag
+
+@cache_control(public=True,max_age=86400)
+@condition(etag_func=_csv_etag)
+def demographics_csv(request,place_type,pk=None):
+    """
+    Streams the demographics of one place (`pk`), or of every `place_type`
+    object, as CSV (see export.py): a row per place, with its id, name and
+    every PlacePopulation field. Optional parameters:
+     * state: State abbreviation; only places in that state
+     * source: DataSource id of the demographics (default: the latest
+       with population data for the place type)
+    A whole place type is served from a cached gzip file, with an ETag, once
+    it's written; other output is gzip'd on the fly for clients that accept
+    it.
+    """
+    try:
+        source = _csv_source(request,place_type)
+    except ValueError:
+        return HttpResponseBadRequest("source must be a DataSource id.")
+    state = request.GET.get('state')
+    if state:
+        state = get_object_or_404(State,abbr__iexact=state)
+    if pk is not None:
+        pk = int(pk)
+        if place_info(place_type, pk) is None:
+            raise Http404
+        filename = "%s-%d-source_%d" % (place_type, pk, source)
+    elif state:
+        filename = "%s-%s-source_%d" % (place_type, state.abbr.lower(), source)
+    else:
+        filename = "%s-source_%d" % (place_type, source)
+
+    gzipped = _accepts_gzip(request)
+    cached = None
+    if pk is None and not state:
+        cached = open_cached_csv(place_type, source, decompress=not gzipped)
+    if cached is not None:
+        chunks = read_stream(cached)
+    else:
+        chunks = csv_chunks(place_type, state=state and state.pk, place=pk, source=source)
+        if gzipped:
+            chunks = gzip_stream(chunks)
+
+    response = HttpResponse(chunks, mimetype="text/csv")
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename=%s.csv' % filename
     return response
-    """
\ No newline at end of file
+
+@cache_control(public=True,max_age=86400)
+def class_breaks(request,place_type,field):
+    """
+    Choropleth classes for `field` over every place of `place_type`, as JSON
+    (see classify.py). Parameters: method (quantile, equal_interval or jenks;
+    default quantile), k (number of classes; default 5) and colors (a comma-
+    separated RRGGBB ramp to spread over the classes).
+    """
+    if not is_classifiable(field):
+        raise Http404
+    method = request.GET.get('method','quantile')
+    try:
+        k = int(request.GET.get('k',5))
+    except ValueError:
+        k = 0
+    if method not in METHODS or not 1 <= k <= MAX_CLASSES:
+        return HttpResponseBadRequest("method must be one of %s; k from 1 to %d." % (", ".join(METHODS), MAX_CLASSES))
+    colors = DEFAULT_COLORS
+    if request.GET.get('colors'):
+        colors = request.GET['colors'].split(',')
+        if not all([HEX_COLOR.match(c) for c in colors]):
+            return HttpResponseBadRequest("colors must be RRGGBB hex colors.")
+        colors = ['#' + c.lstrip('#') for c in colors]
+
+    breaks, minimum = get_breaks(place_type, field, method, k)
+    return HttpResponse(json.dumps({
+        'place_type':place_type,
+        'field':field,
+        'method':method,
+        'k':k,
+        'breaks':breaks,
+        'style':style(breaks, minimum, colors),
+    }), mimetype="application/json")
+
+@cache_control(public=True,max_age=86400)
+def rankings(request,place_type,field):
+    """
+    Places of `place_type` ranked by `field`, as JSON (see ranking.py):
+        {"count": 3141, "places": [{"rank": 1, "value": 9519338.0, "id": 204,
+            "name": "Los Angeles County, California", "url": ...}, ...]}
+    Parameters: state (an abbreviation; rank counties or ZIP codes within
+    it), limit (default 25) and offset for the top-K slice, order (desc or
+    asc) and id (a place whose rank and percentile to include, as "place").
+    """
+    if not is_classifiable(field):
+        raise Http404
+    state = request.GET.get('state') or None
+    order = request.GET.get('order','desc')
+    try:
+        limit = int(request.GET.get('limit',25))
+        offset = int(request.GET.get('offset',0))
+        pk = request.GET.get('id') and int(request.GET['id']) or None
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_RANKING_LIMIT or offset < 0 or order not in ('desc','asc') or (state and place_type == 'state'):
+        return HttpResponseBadRequest("limit must be from 1 to %d; offset a positive number; order desc or asc; state only for counties and ZIP codes." % MAX_RANKING_LIMIT)
+
+    ranked = ranking(place_type, field, state)
+    if ranked is None:
+        raise Http404
+    places = []
+    for place_pk, value, rank in ranked.top(limit, offset, ascending=(order == 'asc')):
+        result = {'rank':rank, 'value':value}
+        result.update(place_info(place_type, place_pk) or {'id':place_pk})
+        places.append(result)
+    data = {
+        'place_type':place_type,
+        'field':field,
+        'state':state,
+        'count':len(ranked),
+        'places':places,
+    }
+    if pk is not None:
+        data['place'] = ranked.rank(pk)
+    return HttpResponse(json.dumps(data), mimetype="application/json")
+
+@cache_control(public=True,max_age=86400)
+def similar(request,place_type,pk):
+    """
+    The places of `place_type` most demographically similar to the one with
+    `pk`, as JSON (see similar.py):
+        {"id": 1234, "places": [{"id": 1240, "name": ..., "url": ...,
+            "distance": 0.42}, ...]}
+    Parameters: k (default 10).
+    """
+    try:
+        k = int(request.GET.get('k',10))
+    except ValueError:
+        k = 0
+    if not 1 <= k <= MAX_SIMILAR_K:
+        return HttpResponseBadRequest("k must be from 1 to %d." % MAX_SIMILAR_K)
+    pk = int(pk)
+    if place_info(place_type, pk) is None:
+        raise Http404
+    return HttpResponse(json.dumps({
+        'place_type':place_type,
+        'id':pk,
+        'places':similar_places(place_type, pk, k),
+    }), mimetype="application/json")
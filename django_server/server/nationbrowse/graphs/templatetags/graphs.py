@@ -9,6 +9,7 @@ from nationbrowse.graphs import googleGraphs as google_graphs
 from nationbrowse.demographics.models import *
 
 from django.db.models.loading import get_model
+from nationbrowse.places.registry import get_registry
 
 register = template.Library()
 
@@ -40,13 +41,13 @@ class StaticMapHTMLNode(template.Node):
             PlaceClass = get_model("places",place_type)
             if not PlaceClass:
                 return ""
-            place = PlaceClass.objects.get(slug__iexact=slug)
+            place = PlaceClass.objects.get(pk=get_registry(place_type).pk_for_slug(slug))
             
             if place_type == 'state':
                 return '\n<img src="http://chart.apis.google.com/chart?cht=t&chs=400x200&chd=s:_&chtm=usa&chco=BBBBBB,000066,0000FF&chld=%s&chd=t:100">' % (
                     place.abbr
                 )
-            elif place.center:
+            elif place.latitude is not None:
                 return '\n<img src="http://maps.google.com/maps/api/staticmap?markers=color:blue|%s,%s&center=%s,%s&zoom=5&maptype=terrain&size=300x200&key=%s&sensor=false">' % (
                     place.latitude,
                     place.longitude,
@@ -98,7 +99,7 @@ class RacePiechartNode(template.Node):
             PlaceClass = get_model("places",place_type)
             if not PlaceClass:
                 return ""
-            place = PlaceClass.objects.get(slug=slug)
+            place = PlaceClass.objects.get(pk=get_registry(place_type).pk_for_slug(slug))
             
             # Labels, values, and colors for each race.
             labels = [
@@ -189,7 +190,7 @@ class AgeBarchartNode(template.Node):
             PlaceClass = get_model("places",place_type)
             if not PlaceClass:
                 return ""
-            place = PlaceClass.objects.get(slug=slug)
+            place = PlaceClass.objects.get(pk=get_registry(place_type).pk_for_slug(slug))
             
             # Labels, values, and colors for each race.
             field_names, labels, nul = zip(*PlacePopulation.age_fields)
@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+Compact polygon encoding for delivering geometries to the browser.
+
+The simplified WKT columns (see simplify.py) are text-heavy: every vertex
+costs ~20 characters and has to be parsed as text on the client. Here each
+ring is turned into an "encoded polyline" instead:
+
+ * coordinates are quantized to the grid of the zoom band (10^-precision
+   degrees; see SIMPLIFIED_LEVELS), and repeated grid points are dropped;
+ * each vertex is stored as the zigzag/varint-encoded delta from the
+   previous one, in printable ASCII (the Google Maps polyline algorithm,
+   generalized to any precision -- with precision 5 the output is exactly
+   Google's, so google.maps.geometry.encoding.decodePath() can read it).
+
+Decoding is a single pass of integer shifts and additions per character.
+Rings are left open (the closing vertex is implied).
+"""
+import re
+
+# Tokens of a (MULTI)POLYGON WKT string.
+_wkt_tokens = re.compile(r'\(|\)|[^()]+')
+
+def parse_wkt_polygons(wkt):
+    """
+    Parses POLYGON or MULTIPOLYGON WKT into a list of polygons, each a list
+    of rings, each a list of (x, y) floats. Empty geometries give [].
+    """
+    if not wkt:
+        return []
+    geom_type = wkt.split('(', 1)[0].strip().upper()
+    if geom_type not in ('POLYGON', 'MULTIPOLYGON', 'POLYGON EMPTY', 'MULTIPOLYGON EMPTY'):
+        raise ValueError("Not a polygon WKT: %s" % wkt[:30])
+
+    if '(' not in wkt:
+        return []
+
+    stack = [[]]
+    for match in _wkt_tokens.finditer(wkt[wkt.index('('):]):
+        token = match.group(0)
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            group = stack.pop()
+            stack[-1].append(group)
+        else:
+            if len(stack) > 1 and token.strip(' ,\n\t'):
+                stack[-1].extend([
+                    tuple([float(n) for n in point.split()[:2]])
+                    for point in token.split(',') if point.strip()
+                ])
+    top = stack[0][0]
+    if geom_type.startswith('MULTIPOLYGON'):
+        return top
+    return [top]
+
+def encode_number(value, chunks):
+    """ Appends the polyline characters for one signed integer. """
+    value = ~(value << 1) if value < 0 else (value << 1)
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+def quantize_ring(ring, precision):
+    """
+    Snaps (x, y) points to the 10^-precision grid, returning integer
+    (lat, lon) pairs with consecutive duplicates and the closing vertex
+    removed.
+    """
+    factor = 10 ** precision
+    points = []
+    last = None
+    for x, y in ring:
+        point = (int(round(y * factor)), int(round(x * factor)))
+        if point != last:
+            points.append(point)
+            last = point
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+def encode_points(points):
+    """ Encodes quantized (lat, lon) integer pairs as a polyline string. """
+    chunks = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        encode_number(lat - prev_lat, chunks)
+        encode_number(lon - prev_lon, chunks)
+        prev_lat, prev_lon = lat, lon
+    return ''.join(chunks)
+
+def encode_ring(ring, precision=5):
+    """ Encodes one ring of (x, y) points as a polyline string. """
+    return encode_points(quantize_ring(ring, precision))
+
+def encode_polygons(polygons, precision=5):
+    """
+    Encodes parsed polygons (see parse_wkt_polygons) as a list of polygons,
+    each a list of ring strings. Rings that collapse to fewer than three
+    points at this precision are dropped (and a polygon along with its outer
+    ring).
+    """
+    encoded = []
+    for polygon in polygons:
+        rings = []
+        for i, ring in enumerate(polygon):
+            points = quantize_ring(ring, precision)
+            if len(points) < 3:
+                if i == 0:
+                    break
+                continue
+            rings.append(encode_points(points))
+        if rings:
+            encoded.append(rings)
+    return encoded
+
+def decode_ring(encoded, precision=5):
+    """ The inverse of encode_ring; returns a list of (x, y). Mostly for testing. """
+    factor = 10 ** precision
+    values = []
+    value = shift = 0
+    for char in encoded:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else (value >> 1))
+            value = shift = 0
+    points = []
+    lat = lon = 0
+    for i in xrange(0, len(values) - 1, 2):
+        lat += values[i]
+        lon += values[i+1]
+        points.append((lon / float(factor), lat / float(factor)))
+    return points
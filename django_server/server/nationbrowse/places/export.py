@@ -0,0 +1,165 @@
+# coding=utf-8
+"""
+Streaming GeoJSON export of places joined with their PlacePopulation data.
+
+geojson_features() yields a FeatureCollection one Feature at a time, so the
+output can be as large as every ZIP code in the nation while memory stays
+bounded: rows come from a single LEFT JOIN of the place table with
+PlacePopulation, read in batches (fetchmany, and a server-side cursor on
+PostgreSQL), and geometries come from the pre-simplified WKT column for the
+requested zoom band (see simplify.py), so no polygon is ever loaded or
+simplified during an export.
+
+Used by the `export_geojson` management command and the places:export view;
+demographics/export.py streams CSV from the same join.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+
+from nationbrowse.demographics.models import PlacePopulation,latest_source
+from nationbrowse.places.simplify import field_for_zoom
+from nationbrowse.places.encoding import parse_wkt_polygons
+
+import json
+
+# Rows fetched from the database at a time.
+ITERSIZE = 500
+
+# PlacePopulation columns that aren't demographics.
+NON_DEMOGRAPHIC_FIELDS = ('id','place_type','place_id','source')
+
+# Place columns included as feature properties (when the model has them).
+PLACE_PROPERTIES = ('name','slug','long_name','area_sq_mi','pop_density')
+
+def demographic_fields():
+    """ The PlacePopulation fields exported as properties, in model order. """
+    return [f for f in PlacePopulation._meta.fields if f.name not in NON_DEMOGRAPHIC_FIELDS]
+
+def population_source(place_type):
+    """
+    The DataSource of the PlacePopulation rows of a place type to show (see
+    demographics.models.latest_source()), or None if it has none.
+    """
+    PlaceClass = get_model('places', place_type)
+    return latest_source(PlacePopulation.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass)))
+
+def _cursor(name):
+    """
+    A cursor that doesn't pull the whole result set into memory on execute:
+    a named (server-side) cursor on PostgreSQL, else a normal one.
+    """
+    cursor = connection.cursor()
+    if settings.DATABASE_ENGINE == 'postgresql_psycopg2':
+        return connection.connection.cursor(name=name)
+    return cursor
+
+def _close(cursor):
+    """
+    Closes a _cursor() and ends the transaction it read in, so the connection
+    isn't left idle in a transaction (i.e. when the client goes away
+    mid-stream).
+    """
+    try:
+        cursor.close()
+    finally:
+        transaction.rollback_unless_managed()
+
+def export_query(place_type, zoom=None, state=None, source=None, place=None, geometry=True, only_with_data=False):
+    """
+    Returns (sql, params, property names) for the export join. `state` limits
+    counties and ZIP codes to those in a State (pk), and `place` to one place
+    (pk); `source` is the DataSource pk of the demographics to join (default:
+    population_source()). Rows are (pk, WKT, properties...), or (pk, properties...)
+    without `geometry`; with `only_with_data`, places without demographics
+    are left out.
+    """
+    PlaceClass = get_model('places', place_type)
+    qn = connection.ops.quote_name
+    opts = PlaceClass._meta
+    pop_opts = PlacePopulation._meta
+    field_names = [f.name for f in opts.fields]
+
+    place_columns = [name for name in PLACE_PROPERTIES if name in field_names]
+    pop_fields = demographic_fields()
+
+    columns = ["p.%s" % qn(opts.pk.column)]
+    if geometry:
+        columns.append("p.%s" % qn(field_for_zoom(zoom)))
+    columns += ["p.%s" % qn(opts.get_field(name).column) for name in place_columns]
+    columns += ["d.%s" % qn(f.column) for f in pop_fields]
+
+    params = [ContentType.objects.get_for_model(PlaceClass).pk]
+    join = "d.%s = p.%s AND d.%s = %%s" % (
+        qn(pop_opts.get_field('place_id').column), qn(opts.pk.column),
+        qn(pop_opts.get_field('place_type').column)
+    )
+    if source is None:
+        source = population_source(place_type)
+        source = source and source.pk
+    if source is not None:
+        join += " AND d.%s = %%s" % qn(pop_opts.get_field('source').column)
+        params.append(source)
+    else:
+        # No demographics for the place type (rather than every source's).
+        join += " AND 1 = 0"
+
+    conditions = []
+    if state is not None:
+        if place_type == 'state':
+            conditions.append("p.%s = %%s" % qn(opts.pk.column))
+        else:
+            conditions.append("p.%s = %%s" % qn(opts.get_field('state').column))
+        params.append(state)
+    if place is not None:
+        conditions.append("p.%s = %%s" % qn(opts.pk.column))
+        params.append(place)
+    where = conditions and " WHERE " + " AND ".join(conditions) or ""
+
+    sql = "SELECT %s FROM %s p %s JOIN %s d ON %s%s ORDER BY p.%s" % (
+        ", ".join(columns), qn(opts.db_table), only_with_data and "INNER" or "LEFT OUTER",
+        qn(pop_opts.db_table), join, where, qn(opts.pk.column)
+    )
+    return sql, params, place_columns + [f.name for f in pop_fields]
+
+def _geometry(wkt):
+    if not wkt:
+        return None
+    return {'type':'MultiPolygon', 'coordinates':parse_wkt_polygons(wkt)}
+
+def _json_default(value):
+    # Decimal fields (i.e. avg_family_size)
+    return float(value)
+
+def geojson_features(place_type, zoom=None, state=None, source=None):
+    """
+    Yields the chunks of a GeoJSON FeatureCollection of every `place_type`
+    object (optionally only those in a State), one Feature per chunk.
+    """
+    sql, params, properties = export_query(place_type, zoom, state, source)
+    cursor = _cursor("export_%s" % place_type)
+    try:
+        cursor.execute(sql, params)
+
+        yield '{"type":"FeatureCollection","features":['
+        first = True
+        while True:
+            rows = cursor.fetchmany(ITERSIZE)
+            if not rows:
+                break
+            for row in rows:
+                feature = json.dumps({
+                    'type':'Feature',
+                    'id':row[0],
+                    'geometry':_geometry(row[1]),
+                    'properties':dict(zip(properties, row[2:])),
+                }, separators=(',',':'), default=_json_default)
+                if first:
+                    yield "\n" + feature
+                    first = False
+                else:
+                    yield ",\n" + feature
+    finally:
+        _close(cursor)
+    yield "\n]}\n"
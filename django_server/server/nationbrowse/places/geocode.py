@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+Reverse geocoding: which State, County and ZipCode contain a lat/lon?
+
+Lookups go through the in-process spatial index (see spatial_index.py), and
+results are memoized per geohash cell so repeated and nearby points (the
+common case for batch jobs: addresses on the same block, GPS traces) skip
+even the index. Precision 9 geohash cells are ~5m x 5m -- well under the
+accuracy of TIGER/Line boundaries -- so sharing a result within a cell does
+not change answers in practice.
+
+The names and URLs of places come from the place registry (see
+registry.py), so a lookup never touches the database once everything is
+loaded, and follows changes to the places. For batches,
+reverse_geocode_many() computes the geohashes of all its points at once
+(see geohash.py).
+"""
+from nationbrowse.places.spatial_index import get_place_index
+from nationbrowse.places.registry import get_registry
+from nationbrowse.places import geohash
+
+PLACE_TYPES = ('state','county','zipcode')
+
+GEOHASH_PRECISION = 9
+
+# Maximum number of memoized geohash cells (per process). The memo is simply
+# dropped when it fills up.
+RESULT_CACHE_SIZE = 200000
+
+# {geohash: {place type: pk}}
+_results = {}
+
+def geohash_key(lat, lon):
+    """ The geohash cell used to bucket results for this point. """
+    return geohash.encode([lat], [lon], GEOHASH_PRECISION)[0]
+
+def place_info(place_type, pk):
+    """ Returns the {'id','name','url'} dict for a place, or None. """
+    if pk is None:
+        return None
+    return get_registry(place_type).link_info(pk)
+
+def reverse_geocode(lat, lon):
+    """
+    Returns {'state': info, 'county': info, 'zipcode': info} for the given
+    point, where each info is a {'id','name','url'} dict or None.
+    Returns None if this server is not GIS-aware.
+    """
+    index = get_place_index()
+    if index is None:
+        return None
+    return _lookup(index, geohash_key(lat, lon), lat, lon)
+
+def reverse_geocode_many(lats, lons):
+    """
+    reverse_geocode() for sequences of latitudes and longitudes (which must
+    be valid); returns a list of results, or None if this server is not
+    GIS-aware.
+    """
+    index = get_place_index()
+    if index is None:
+        return None
+    keys = geohash.encode(lats, lons, GEOHASH_PRECISION)
+    return [_lookup(index, key, lat, lon) for key, lat, lon in zip(keys, lats, lons)]
+
+def _lookup(index, key, lat, lon):
+    pks = _results.get(key)
+    if pks is None:
+        pks = index.lookup(lat, lon, PLACE_TYPES)
+        if len(_results) >= RESULT_CACHE_SIZE:
+            _results.clear()
+        _results[key] = pks
+    result = {}
+    for place_type in PLACE_TYPES:
+        result[place_type] = place_info(place_type, pks[place_type])
+    return result
+
+def reset():
+    """ Forget memoized results (i.e. after a data import). """
+    _results.clear()
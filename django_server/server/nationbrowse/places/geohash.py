@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+Vectorized geohashes, for bucketing and batching large numbers of points.
+
+geopy.geohash.Geohash encodes a point with a bit-by-bit Python loop, which
+adds up when reverse geocoding or bucketing hundreds of thousands of
+coordinates. Here whole arrays are done at once, with integer arithmetic:
+
+ * a geohash of precision p is 5p bits: the first ceil(5p/2) bits of the
+   longitude's position on a 2^n grid and the first floor(5p/2) of the
+   latitude's, interleaved (longitude first), five bits per base32 char;
+ * encoding quantizes lat/lon to those grids, interleaves the bits with
+   the usual shift-and-mask "bit spreading", and looks up the characters;
+ * decoding, neighbors and bbox covers work on the grid cells directly.
+
+Codes are the same as geopy's (and everyone else's). All functions take
+and return numpy arrays; codes are string arrays (dtype 'S<precision>'),
+and every code in one array has the same precision.
+"""
+from __future__ import division
+from geopy.geohash import Geohash
+import numpy
+
+MAX_PRECISION = 12
+
+# Refuse bbox covers bigger than this many cells.
+MAX_COVER_CELLS = 1000000
+
+_ENCODE = numpy.frombuffer(Geohash.ENCODE_MAP, dtype=numpy.uint8)
+_DECODE = numpy.empty(256, dtype=numpy.int64)
+_DECODE.fill(-1)
+_DECODE[_ENCODE] = numpy.arange(32)
+
+# Neighbor directions, as (lat step, lon step): N, NE, E, SE, S, SW, W, NW.
+DIRECTIONS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+def grid_bits(precision):
+    """ (latitude bits, longitude bits) of a geohash precision. """
+    bits = 5 * precision
+    return bits // 2, bits - bits // 2
+
+def _spread(v):
+    """ Moves bit i of each (up to 32 bit) value to bit 2i. """
+    v = v.astype(numpy.uint64) & numpy.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << numpy.uint64(shift))) & numpy.uint64(mask)
+    return v
+
+def _compact(v):
+    """ The inverse of _spread: moves bit 2i of each value to bit i. """
+    v = v & numpy.uint64(0x5555555555555555)
+    for shift, mask in ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                        (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)):
+        v = (v | (v >> numpy.uint64(shift))) & numpy.uint64(mask)
+    return v
+
+def _check_precision(precision):
+    if not 1 <= precision <= MAX_PRECISION:
+        raise ValueError("Geohash precision must be from 1 to %d." % MAX_PRECISION)
+
+def encode_cells(lat_cells, lon_cells, precision):
+    """ Geohashes of grid cells (as returned by cells()). """
+    lat_bits, lon_bits = grid_bits(precision)
+    lat_cells, lon_cells = numpy.asarray(lat_cells), numpy.asarray(lon_cells)
+    if lat_bits == lon_bits:
+        hashes = (_spread(lon_cells) << numpy.uint64(1)) | _spread(lat_cells)
+    else:
+        hashes = _spread(lon_cells) | (_spread(lat_cells) << numpy.uint64(1))
+
+    chars = numpy.empty(hashes.shape + (precision,), dtype=numpy.uint8)
+    for i in xrange(precision):
+        shift = numpy.uint64(5 * (precision - 1 - i))
+        chars[..., i] = _ENCODE[((hashes >> shift) & numpy.uint64(31)).astype(numpy.intp)]
+    return chars.view('S%d' % precision).reshape(hashes.shape)
+
+def cells(lats, lons, precision):
+    """ The (latitude, longitude) grid cells of points, as int64 arrays. """
+    lat_bits, lon_bits = grid_bits(precision)
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    if ((lats < -90) | (lats > 90) | (lons < -180) | (lons > 180)).any():
+        raise ValueError("Coordinates out of range.")
+    lat_cells = numpy.floor((lats + 90) / 180 * 2 ** lat_bits).astype(numpy.int64)
+    lon_cells = numpy.floor((lons + 180) / 360 * 2 ** lon_bits).astype(numpy.int64)
+    # The north pole and antimeridian belong to the last cell.
+    return numpy.minimum(lat_cells, 2 ** lat_bits - 1), numpy.minimum(lon_cells, 2 ** lon_bits - 1)
+
+def encode(lats, lons, precision=MAX_PRECISION):
+    """ Geohashes of arrays of latitudes and longitudes. """
+    _check_precision(precision)
+    lat_cells, lon_cells = cells(lats, lons, precision)
+    return encode_cells(lat_cells, lon_cells, precision)
+
+def decode_cells(codes):
+    """ Returns (lat cells, lon cells, precision) of an array of geohashes. """
+    codes = numpy.asarray(codes)
+    if codes.dtype.kind == 'U':
+        codes = codes.astype('S')
+    if codes.dtype.kind != 'S':
+        raise ValueError("Geohashes must be strings.")
+    precision = codes.dtype.itemsize
+    _check_precision(precision)
+    values = _DECODE[codes.reshape(codes.shape + (1,)).view(numpy.uint8)]
+    if (values < 0).any():
+        raise ValueError("Invalid geohash (bad character, or mixed precisions).")
+
+    hashes = numpy.zeros(codes.shape, dtype=numpy.uint64)
+    for i in xrange(precision):
+        hashes = (hashes << numpy.uint64(5)) | values[..., i].astype(numpy.uint64)
+    lat_bits, lon_bits = grid_bits(precision)
+    if lat_bits == lon_bits:
+        lon_cells, lat_cells = _compact(hashes >> numpy.uint64(1)), _compact(hashes)
+    else:
+        lon_cells, lat_cells = _compact(hashes), _compact(hashes >> numpy.uint64(1))
+    return lat_cells.astype(numpy.int64), lon_cells.astype(numpy.int64), precision
+
+def cell_size(precision):
+    """ (height, width) in degrees of the cells of a geohash precision. """
+    lat_bits, lon_bits = grid_bits(precision)
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+def decode(codes):
+    """ The (latitudes, longitudes) of the centers of an array of geohash cells. """
+    lat_cells, lon_cells, precision = decode_cells(codes)
+    height, width = cell_size(precision)
+    return (lat_cells + .5) * height - 90, (lon_cells + .5) * width - 180
+
+def bbox(codes):
+    """ The (south, west, north, east) bounds of an array of geohash cells. """
+    lat_cells, lon_cells, precision = decode_cells(codes)
+    height, width = cell_size(precision)
+    return lat_cells * height - 90, lon_cells * width - 180, (lat_cells + 1) * height - 90, (lon_cells + 1) * width - 180
+
+def neighbors(codes):
+    """
+    The eight neighbors of each geohash, as an array with one more dimension
+    (in DIRECTIONS order: N, NE, E, SE, S, SW, W, NW). Neighbors wrap around
+    the antimeridian; there are none past the poles (those are '').
+    """
+    lat_cells, lon_cells, precision = decode_cells(codes)
+    lat_bits, lon_bits = grid_bits(precision)
+    result = numpy.empty(lat_cells.shape + (len(DIRECTIONS),), dtype='S%d' % precision)
+    for i, (dlat, dlon) in enumerate(DIRECTIONS):
+        lat = lat_cells + dlat
+        lon = (lon_cells + dlon) % (2 ** lon_bits)
+        valid = (lat >= 0) & (lat < 2 ** lat_bits)
+        column = encode_cells(numpy.clip(lat, 0, 2 ** lat_bits - 1), lon, precision)
+        column[~valid] = ''
+        result[..., i] = column
+    return result
+
+def cover(south, west, north, east, precision):
+    """
+    The geohashes of every cell of a precision that touches a bounding box,
+    as a 1-d array (row by row, from the south-west). A box with west > east
+    crosses the antimeridian.
+    """
+    _check_precision(precision)
+    lat_bits, lon_bits = grid_bits(precision)
+    (south_cell, north_cell), (west_cell, east_cell) = cells([south, north], [west, east], precision)
+    lat_range = numpy.arange(min(south_cell, north_cell), max(south_cell, north_cell) + 1)
+    if west_cell <= east_cell and west <= east:
+        lon_range = numpy.arange(west_cell, east_cell + 1)
+    else:
+        lon_range = numpy.concatenate((numpy.arange(west_cell, 2 ** lon_bits), numpy.arange(0, east_cell + 1)))
+    if len(lat_range) * len(lon_range) > MAX_COVER_CELLS:
+        raise ValueError("Bounding box covers too many cells at this precision.")
+    lat_grid, lon_grid = numpy.meshgrid(lat_range, lon_range, indexing='ij')
+    return encode_cells(lat_grid.ravel(), lon_grid.ravel(), precision)
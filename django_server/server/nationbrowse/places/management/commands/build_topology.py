@@ -0,0 +1,137 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from django_caching.cache import cache
+from nationbrowse.places.models import TopologyArc
+from nationbrowse.places.encoding import parse_wkt_polygons
+from nationbrowse.places.topology import snap_polygons,build_topology,arc_values,invalidate_topology,write_topology,topology_files
+from threadutil import close_db_connection
+from multiprocessing import Pool, cpu_count
+from time import time
+import json
+import gc
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# Places (or arcs) handed to a worker at once.
+BLOCK_SIZE = 100
+ARC_BLOCK_SIZE = 1000
+
+def snap_block(args):
+    """
+    Worker: loads and snaps the polygons of every place in the block.
+    Returns a list of (pk, snapped polygons).
+    """
+    place_type, pks = args
+    PlaceClass = get_model('places', place_type)
+
+    results = []
+    qs = PlaceClass.pobjects.filter(pk__in=pks).order_by().values_list('pk','poly')
+    for pk, poly in qs.iterator():
+        if poly and not poly.empty:
+            results.append((pk, snap_polygons(parse_wkt_polygons(poly.wkt))))
+    gc.collect()
+    return results
+
+def simplify_arcs(arcs):
+    """ Worker: the encoded TopologyArc columns for each arc of the block. """
+    return [arc_values(arc) for arc in arcs]
+
+def write_file(args):
+    """ Worker: writes one (place type, zoom, state) topology file. """
+    return write_topology(*args)
+
+@transaction.commit_on_success
+def save_topology(PlaceClass, values, place_arcs):
+    """
+    Replaces a place type's TopologyArcs and the places' `arcs`, with a few
+    executemany() statements rather than a query per arc and per place.
+    """
+    qn = connection.ops.quote_name
+    place_ct = ContentType.objects.get_for_model(PlaceClass)
+    arc_opts, place_opts = TopologyArc._meta, PlaceClass._meta
+    arc_fields = sorted(values and values[0].keys() or [])
+    arcs_column = qn(place_opts.get_field('arcs').column)
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s = %%s" % (
+        qn(arc_opts.db_table), qn(arc_opts.get_field('place_type').column)), [place_ct.pk])
+    if values:
+        columns = [arc_opts.get_field(name).column for name in ['place_type','index'] + arc_fields]
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(arc_opts.db_table),
+            ", ".join([qn(c) for c in columns]),
+            ", ".join(["%s"] * len(columns)),
+        ), [[place_ct.pk, index] + [arc[f] for f in arc_fields] for index, arc in enumerate(values)])
+
+    cursor.execute("UPDATE %s SET %s = NULL" % (qn(place_opts.db_table), arcs_column))
+    cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+        qn(place_opts.db_table), arcs_column, qn(place_opts.pk.column),
+    ), [[json.dumps(arcs, separators=(',',':')), pk] for pk, arcs in place_arcs.iteritems()])
+
+    # The rows changed behind the caching manager's back.
+    for pk in place_arcs:
+        cache.set(PlaceClass._cache_key(pk), None, 5)
+
+class Command(BaseCommand):
+    help = "Builds the shared-border (TopoJSON-style) topology of Places, with arcs simplified for each zoom band."
+    args = "[place_type ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=cpu_count(),
+            help='Number of worker processes (default: number of CPUs).'),
+    )
+
+    def handle(self, *place_types, **options):
+        if not getattr(settings,'USE_GIS',False):
+            raise CommandError("build_topology requires a GIS-aware server (USE_GIS).")
+
+        place_types = place_types or PLACE_TYPES
+        for place_type in place_types:
+            if place_type not in PLACE_TYPES:
+                raise CommandError("Unknown place type: %s" % place_type)
+
+        pool = Pool(processes=options['processes'], initializer=close_db_connection)
+        try:
+            for place_type in place_types:
+                PlaceClass = get_model('places', place_type)
+                pks = list(PlaceClass.pobjects.exclude(poly=None).order_by('pk').values_list('pk', flat=True))
+                blocks = [(place_type, pks[i:i+BLOCK_SIZE]) for i in xrange(0, len(pks), BLOCK_SIZE)]
+
+                print "Loading %d %s polygons..." % (len(pks), place_type)
+                start = time()
+                snapped = []
+                for results in pool.imap_unordered(snap_block, blocks):
+                    snapped.extend(results)
+                snapped.sort()
+
+                arcs, place_arcs = build_topology(snapped)
+                points = sum([len(ring) for pk, place in snapped for polygon in place for ring in polygon])
+                del snapped
+                print "  %d vertices in %d arcs (%.1f sec)" % (points, len(arcs), time() - start)
+
+                print "Simplifying %d arcs..." % len(arcs)
+                start = time()
+                arc_blocks = [arcs[i:i+ARC_BLOCK_SIZE] for i in xrange(0, len(arcs), ARC_BLOCK_SIZE)]
+                values = []
+                for results in pool.imap(simplify_arcs, arc_blocks):
+                    values.extend(results)
+                    print "  %d/%d (%.1f/sec)" % (len(values), len(arcs), len(values)/max(time()-start, .001))
+
+                save_topology(PlaceClass, values, place_arcs)
+                invalidate_topology(place_type)
+
+                # Write every payload now, national and per state, so no
+                # request has to build one.
+                start = time()
+                files = topology_files(place_type)
+                for path in pool.imap_unordered(write_file, files):
+                    pass
+                print "  wrote %d %s topology files (%.1f sec)" % (len(files), place_type, time() - start)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,136 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connection, transaction
+from cacheutil import safe_del_cache
+from nationbrowse.places.models import County,ZipCode,ZipCodeCounty,cached_class_names
+from nationbrowse.places.spatial_index import get_place_index
+from nationbrowse.places.measure import equal_area
+from threadutil import close_db_connection
+from multiprocessing import Pool, cpu_count
+from time import time
+import gc
+
+# ZIP codes handed to a worker at once.
+BLOCK_SIZE = 250
+
+# Overlaps smaller than this share of the ZIP code are TIGER/ZCTA boundary
+# misalignment slivers, not real overlaps.
+MIN_FRACTION = .001
+
+_county_areas = {}
+
+def county_area(pk, geom):
+    """ Per-worker memo of county areas; a county is compared with many ZIP codes. """
+    area = _county_areas.get(pk)
+    if area is None:
+        area = _county_areas[pk] = equal_area(geom)
+    return area
+
+def crosswalk_block(pks):
+    """
+    Worker: returns (zipcode pk, county pk, overlap area, zipcode fraction,
+    county fraction) rows for a block of ZIP codes. The County index is built
+    by the parent before the pool starts and shared by every worker.
+    """
+    index = get_place_index()
+    rows = []
+    qs = ZipCode.pobjects.filter(pk__in=pks).order_by().values_list('pk','poly')
+    for pk, poly in qs.iterator():
+        if not poly or poly.empty:
+            continue
+        zip_area = equal_area(poly)
+        if not zip_area:
+            continue
+        for county_pk, prepared in index.candidates('county', poly.extent):
+            if not prepared.intersects(poly):
+                continue
+            if prepared.contains(poly):
+                overlap = zip_area
+            else:
+                overlap = equal_area(poly.intersection(prepared.base_geom))
+            zipcode_fraction = overlap / zip_area
+            if zipcode_fraction < MIN_FRACTION:
+                continue
+            rows.append((
+                pk,
+                county_pk,
+                overlap,
+                zipcode_fraction,
+                overlap / county_area(county_pk, prepared.base_geom)
+            ))
+    gc.collect()
+    return rows
+
+def invalidate_crosswalk(old, new):
+    """
+    The crosswalk is replaced with raw SQL, so drop the cached crosswalk
+    lookups (ZipCode.counties and states, County.zipcodes) of the places
+    whose overlaps changed. old and new are {(zipcode, county): zipcode fraction}.
+    """
+    changed = [pair for pair in set(old) | set(new) if old.get(pair) != new.get(pair)]
+    zipcodes = set([zipcode for zipcode, county in changed])
+    counties = set([county for zipcode, county in changed])
+    for PlaceClass, method, pks in ((ZipCode, 'counties', zipcodes), (ZipCode, 'states', zipcodes), (County, 'zipcodes', counties)):
+        for class_name in cached_class_names(PlaceClass):
+            for pk in pks:
+                # The key cached_clsmethod uses for a call without arguments.
+                safe_del_cache('cached_clsmethod_%s_%s_%s_%s_%s' % (class_name, method, pk, hash(()), hash(frozenset())))
+
+@transaction.commit_on_success
+def replace_crosswalk(rows):
+    """ Swaps the whole crosswalk table contents in one transaction. """
+    old = dict([((zipcode, county), fraction) for zipcode, county, fraction in
+        ZipCodeCounty.objects.order_by().values_list('zipcode','county','zipcode_fraction').iterator()])
+    qn = connection.ops.quote_name
+    opts = ZipCodeCounty._meta
+    columns = [opts.get_field(name).column for name in (
+        'zipcode','county','overlap_area','zipcode_fraction','county_fraction'
+    )]
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s" % qn(opts.db_table))
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(opts.db_table),
+        ", ".join([qn(c) for c in columns]),
+        ", ".join(["%s"] * len(columns))
+    ), rows)
+    invalidate_crosswalk(old, dict([((row[0], row[1]), row[3]) for row in rows]))
+
+class Command(BaseCommand):
+    help = "Builds the ZipCodeCounty crosswalk (ZIP/county overlaps and area fractions) with a process pool."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=cpu_count(),
+            help='Number of worker processes (default: number of CPUs).'),
+    )
+
+    def handle(self, **options):
+        if not getattr(settings,'USE_GIS',False):
+            raise CommandError("build_zipcode_crosswalk requires a GIS-aware server (USE_GIS).")
+
+        start = time()
+        print "Indexing County polygons..."
+        get_place_index().warm(('county',))
+
+        pks = list(ZipCode.pobjects.order_by('pk').values_list('pk', flat=True))
+        blocks = [pks[i:i+BLOCK_SIZE] for i in xrange(0, len(pks), BLOCK_SIZE)]
+
+        # Close our own connection before forking so workers don't share it.
+        connection.close()
+        pool = Pool(processes=options['processes'], initializer=close_db_connection)
+        rows = []
+        done = 0
+        try:
+            for block_rows in pool.imap_unordered(crosswalk_block, blocks):
+                rows.extend(block_rows)
+                done += BLOCK_SIZE
+                print "  %d/%d ZIP codes (%.1f/sec)" % (min(done, len(pks)), len(pks), min(done, len(pks))/max(time()-start, .001))
+        finally:
+            pool.close()
+            pool.join()
+
+        print "Saving %d overlaps..." % len(rows)
+        replace_crosswalk(rows)
+        print "Done in %.1f sec." % (time()-start)
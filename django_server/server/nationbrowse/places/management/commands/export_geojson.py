@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from nationbrowse.places.models import State
+from nationbrowse.places.export import geojson_features
+from streamutil import gzip_stream,write_stream
+from time import time
+import sys
+
+PLACE_TYPES = ('state','county','zipcode')
+
+class Command(BaseCommand):
+    help = "Streams a GeoJSON FeatureCollection of Places (with their demographics) to a file or stdout."
+    args = "place_type"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--state', dest='state', default=None,
+            help='Only export places in this State (abbreviation, i.e. MO).'),
+        make_option('--zoom', dest='zoom', type='int', default=None,
+            help='Map zoom level that selects the simplified geometry (default: lowest detail).'),
+        make_option('--source', dest='source', type='int', default=None,
+            help='DataSource id of the demographics to include (default: the latest).'),
+        make_option('--output', '-o', dest='output', default=None,
+            help='File to write to (default: stdout). Output is gzip\'d if it ends in ".gz".'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+            help='Gzip the output.'),
+    )
+
+    def handle(self, place_type=None, **options):
+        if place_type not in PLACE_TYPES:
+            raise CommandError("Give a place type: %s" % ", ".join(PLACE_TYPES))
+
+        state = None
+        if options['state']:
+            try:
+                state = State.objects.get(abbr__iexact=options['state']).pk
+            except State.DoesNotExist:
+                raise CommandError("Unknown state: %s" % options['state'])
+
+        chunks = geojson_features(place_type, zoom=options['zoom'], state=state, source=options['source'])
+        output = options['output']
+        if options['gzip'] or (output and output.endswith('.gz')):
+            chunks = gzip_stream(chunks)
+
+        start = time()
+        if output:
+            f = open(output, 'wb')
+            try:
+                size = write_stream(chunks, f)
+            finally:
+                f.close()
+            print "Wrote %d bytes to %s in %.1f sec." % (size, output, time()-start)
+        else:
+            write_stream(chunks, sys.stdout)
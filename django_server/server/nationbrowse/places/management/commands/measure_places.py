@@ -0,0 +1,119 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from django_caching.cache import cache
+from nationbrowse.demographics.models import PlacePopulation,latest_values
+from nationbrowse.places.measure import geometry_values
+from nationbrowse.places.registry import bump_version
+from threadutil import close_db_connection
+from multiprocessing import Pool, cpu_count
+from time import time
+import gc
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# Places handed to a worker at once.
+BLOCK_SIZE = 250
+
+def measure_block(args):
+    """
+    Worker: computes the center, bbox and area columns for every place in
+    the block. Returns a list of (pk, values dict).
+    """
+    place_type, pks = args
+    PlaceClass = get_model('places', place_type)
+
+    results = []
+    qs = PlaceClass.pobjects.filter(pk__in=pks).order_by().values_list('pk','poly')
+    for pk, poly in qs.iterator():
+        results.append((pk, geometry_values(poly)))
+    gc.collect()
+    return results
+
+def invalidate_places(PlaceClass, places):
+    """ update() bypasses the caching manager; drop the cached copies (by pk and by slug) of the (pk, slug) places it changed. """
+    for pk, slug in places:
+        cache.set(PlaceClass._cache_key(pk), None, 5)
+        cache.set(PlaceClass._cache_key(slug, 'slug'), None, 5)
+
+@transaction.commit_on_success
+def save_measurements(PlaceClass, results):
+    for pk, values in results:
+        PlaceClass.pobjects.filter(pk=pk).update(**values)
+    pks = [pk for pk, values in results]
+    invalidate_places(PlaceClass, PlaceClass.pobjects.filter(pk__in=pks).order_by().values_list('pk','slug'))
+
+@transaction.commit_on_success
+def save_densities(PlaceClass):
+    """
+    Stores population / area for every place of this class with both.
+    Uses the latest population record of each place.
+    """
+    place_ct = ContentType.objects.get_for_model(PlaceClass)
+    qs = PlacePopulation.objects.filter(place_type=place_ct)
+    totals = dict([(place_id, row[0]) for place_id, row in latest_values(qs, 'total').iteritems()])
+
+    count = 0
+    areas = PlaceClass.objects.filter(area_sq_mi__gt=0).order_by().values_list('pk','slug','area_sq_mi')
+    for pk, slug, area_sq_mi in list(areas):
+        total = totals.get(pk)
+        if total is None:
+            density = None
+        else:
+            density = total / area_sq_mi
+        PlaceClass.objects.filter(pk=pk).update(pop_density=density)
+        invalidate_places(PlaceClass, [(pk, slug)])
+        count += 1
+    return count
+
+class Command(BaseCommand):
+    help = "Stores the center, bounding box, area and population density columns of Places, using a process pool."
+    args = "[place_type ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=cpu_count(),
+            help='Number of worker processes (default: number of CPUs).'),
+        make_option('--density-only', action='store_true', dest='density_only', default=False,
+            help='Only recompute population densities (i.e. after importing demographics).'),
+    )
+
+    def handle(self, *place_types, **options):
+        if not getattr(settings,'USE_GIS',False) and not options['density_only']:
+            raise CommandError("measure_places requires a GIS-aware server (USE_GIS), unless --density-only is given.")
+
+        place_types = place_types or PLACE_TYPES
+        for place_type in place_types:
+            if place_type not in PLACE_TYPES:
+                raise CommandError("Unknown place type: %s" % place_type)
+
+        if not options['density_only']:
+            # Close our own connection before forking so workers don't share it.
+            connection.close()
+            pool = Pool(processes=options['processes'], initializer=close_db_connection)
+            try:
+                for place_type in place_types:
+                    PlaceClass = get_model('places', place_type)
+                    pks = list(PlaceClass.pobjects.order_by('pk').values_list('pk', flat=True))
+                    blocks = [(place_type, pks[i:i+BLOCK_SIZE]) for i in xrange(0, len(pks), BLOCK_SIZE)]
+
+                    print "Measuring %d %s objects in %d blocks..." % (len(pks), place_type, len(blocks))
+                    start = time()
+                    done = 0
+                    for results in pool.imap_unordered(measure_block, blocks):
+                        save_measurements(PlaceClass, results)
+                        done += len(results)
+                        print "  %d/%d (%.1f/sec)" % (done, len(pks), done/max(time()-start, .001))
+            finally:
+                pool.close()
+                pool.join()
+
+        for place_type in place_types:
+            PlaceClass = get_model('places', place_type)
+            print "Saved population density for %d %s objects." % (save_densities(PlaceClass), place_type)
+
+        # Centers are in the place registries and the nearby-places indexes.
+        bump_version()
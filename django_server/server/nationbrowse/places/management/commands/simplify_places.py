@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from django.conf import settings
+from django.db.models.loading import get_model
+from cacheutil import safe_del_cache
+from django_caching.cache import cache
+from nationbrowse.places.models import cached_class_names
+from nationbrowse.places.simplify import simplified_values,SIMPLIFIED_FIELDS
+from threadutil import close_db_connection
+from multiprocessing import Pool, cpu_count
+from time import time
+import gc
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# Number of places handed to a worker at once. ZIP polygons are big, so keep
+# this small enough that a block's geometries comfortably fit in memory.
+BLOCK_SIZE = 100
+
+def invalidate_place(PlaceClass, pk):
+    """ Drop cached copies of the object (and its simple_wkt) so the new columns are seen. """
+    cache.set(PlaceClass._cache_key(pk), None, 5)
+    for class_name in cached_class_names(PlaceClass):
+        safe_del_cache('cached_property_%s_%s_%s' % (class_name, 'simple_wkt', pk))
+
+def simplify_block(args):
+    """
+    Worker: simplify and store every place in the block.
+    Returns the number of places processed.
+    """
+    place_type, pks = args
+    PlaceClass = get_model('places', place_type)
+
+    count = 0
+    qs = PlaceClass.pobjects.filter(pk__in=pks).order_by().values_list('pk','poly')
+    for pk, poly in qs.iterator():
+        PlaceClass.pobjects.filter(pk=pk).update(**simplified_values(poly))
+        invalidate_place(PlaceClass, pk)
+        count += 1
+    gc.collect()
+    return count
+
+class Command(BaseCommand):
+    help = "Materializes the simplified (per zoom band) geometry columns of Places, using a process pool."
+    args = "[place_type ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=cpu_count(),
+            help='Number of worker processes (default: number of CPUs).'),
+        make_option('--missing-only', action='store_true', dest='missing_only', default=False,
+            help='Only process places whose simplified columns are empty.'),
+    )
+
+    def handle(self, *place_types, **options):
+        if not getattr(settings,'USE_GIS',False):
+            raise CommandError("simplify_places requires a GIS-aware server (USE_GIS).")
+
+        place_types = place_types or PLACE_TYPES
+        for place_type in place_types:
+            if place_type not in PLACE_TYPES:
+                raise CommandError("Unknown place type: %s" % place_type)
+
+        pool = Pool(processes=options['processes'], initializer=close_db_connection)
+        try:
+            for place_type in place_types:
+                PlaceClass = get_model('places', place_type)
+                qs = PlaceClass.pobjects.exclude(poly=None).order_by('pk')
+                if options['missing_only']:
+                    qs = qs.filter(**{"%s__isnull" % SIMPLIFIED_FIELDS[-1]:True})
+                pks = list(qs.values_list('pk', flat=True))
+                blocks = [(place_type, pks[i:i+BLOCK_SIZE]) for i in xrange(0, len(pks), BLOCK_SIZE)]
+
+                print "Simplifying %d %s objects in %d blocks..." % (len(pks), place_type, len(blocks))
+                start = time()
+                done = 0
+                for count in pool.imap_unordered(simplify_block, blocks):
+                    done += count
+                    print "  %d/%d (%.1f/sec)" % (done, len(pks), done/max(time()-start, .001))
+        finally:
+            pool.close()
+            pool.join()
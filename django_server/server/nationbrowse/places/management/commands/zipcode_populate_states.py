@@ -1,71 +1,127 @@
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
 
-from nationbrowse.places.models import State,ZipCode
-from multiprocessing import Process
-from django.db import IntegrityError, connection, transaction
+from django.conf import settings
+from django.db import connection, transaction
+from nationbrowse.places.models import ZipCode
+from nationbrowse.places.spatial_index import get_place_index
+from nationbrowse.places.registry import bump_version
+from django_caching.cache import cache
+from threadutil import close_db_connection
+from multiprocessing import Pool, cpu_count
+from time import time
 import gc
 
-def convert_block(qs):
-    try:
-        connection.close()
-    except:
-        pass
-    
-    for z in qs.iterator():
-        if not z.poly:
-            print "\t%s HAS NO POLY" % z.id
-        else:
-            # Get an "exact" match: State completely contains the ZipCode polygon
-            try:
-                z.state = State.objects.only('id','name').get(poly__contains=z.poly)
-            except State.DoesNotExist:
-                z.state = None
-    
-            # Get an inexact match: State contains the center of the ZipCode polygon
-            if z.state == None:
-                try:
-                    z.state = State.objects.only('id','name').get(poly__contains=z.center)
-                except State.DoesNotExist:
-                    z.state = None
+# ZIP codes handed to a worker at once.
+BLOCK_SIZE = 250
+
+def primary_match(place_type, poly, point):
+    """
+    Returns the pk of the `place_type` object that best matches the ZIP polygon:
+     * an "exact" match: the place completely contains the ZipCode polygon
+     * otherwise an inexact match: the place contains a point inside the ZipCode
+    Candidates are prefiltered by bounding box via the spatial index.
+    """
+    candidates = get_place_index().candidates(place_type, poly.extent)
+    for pk, prepared in candidates:
+        if prepared.contains(poly):
+            return pk
+    for pk, prepared in candidates:
+        if prepared.covers(point):
+            return pk
+    return None
+
+def join_block(pks):
+    """
+    Worker: computes (zipcode pk, state pk, county pk) for a block of ZIP codes.
+    The State and County indexes are built by the parent before the pool
+    starts, so every worker shares them (copy-on-write) instead of rebuilding.
+    """
+    results = []
+    qs = ZipCode.pobjects.filter(pk__in=pks).order_by().values_list('pk','poly')
+    for pk, poly in qs.iterator():
+        if not poly or poly.empty:
+            print "\t%s HAS NO POLY" % pk
+            continue
+        # Unlike the centroid, point_on_surface is guaranteed to be inside the polygon.
+        point = poly.point_on_surface
+        results.append((
+            pk,
+            primary_match('state', poly, point),
+            primary_match('county', poly, point)
+        ))
+    gc.collect()
+    return results
+
+@transaction.commit_on_success
+def bulk_update(results):
+    """
+    Writes the assignments with one UPDATE per distinct (state, county) pair
+    instead of one save() per ZIP code. A ZIP code that matched no State (or
+    County) keeps the one it had. Returns (ZIP codes updated, UPDATEs).
+    """
+    groups = {}
+    for pk, state_id, county_id in results:
+        groups.setdefault((state_id, county_id), []).append(pk)
+    updated = set()
+    num_updates = 0
+    for (state_id, county_id), pks in groups.items():
+        values = {}
+        if state_id is not None:
+            values['state'] = state_id
+        if county_id is not None:
+            values['county'] = county_id
+        if values:
+            ZipCode.pobjects.filter(pk__in=pks).update(**values)
+            updated.update(pks)
+            num_updates += 1
+    return updated, num_updates
+
+def invalidate_cached(pks):
+    """ update() bypasses the caching manager; drop the cached copies of the ZIP codes it changed. """
+    for pk, slug in ZipCode.pobjects.order_by().values_list('pk','slug').iterator():
+        if pk in pks:
+            cache.set(ZipCode._cache_key(pk), None, 5)
+            cache.set(ZipCode._cache_key(slug, 'slug'), None, 5)
+    bump_version()
 
-            if z.state:
-                try:
-                    sid = transaction.savepoint()
-                    z.save()
-                    transaction.savepoint_commit(sid)
-                    #print "\t%s: %s" % (z.id, z.state)
-                except IntegrityError:
-                    transaction.savepoint_rollback(sid)
-                    print "\t%s: DB IntegrityError!" % z.id
-            else:
-                print "\t%s: No primary state" % z.id
+class Command(BaseCommand):
+    help = "Assigns every ZipCode its primary State and County with a parallel spatial join."
 
-def convert_by_block(qs,split_into):
-    num_objs = qs.count()
-    per_set = int(num_objs/split_into)
-    for i in range(0,split_into):
-        start = per_set*i
-        if i == split_into-1:
-            end = num_objs
-        else:
-            end = per_set*(i+1)
-        print "  %02d/%02d (%d to %d out of %d)..."%(i+1, split_into, start, end, num_objs)
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=cpu_count(),
+            help='Number of worker processes (default: number of CPUs).'),
+    )
 
-        p = Process(
-            target=convert_block,
-            args=(qs[start:end],)
-        )
-        p.daemon = False
-        p.start()
-        p.join()
-    
-        gc.collect()
+    def handle(self, **options):
+        if not getattr(settings,'USE_GIS',False):
+            raise CommandError("zipcode_populate_states requires a GIS-aware server (USE_GIS).")
+
+        start = time()
+        print "Indexing State and County polygons..."
+        get_place_index().warm(('state','county'))
+        print "  done (%.1f sec)" % (time()-start)
+
+        pks = list(ZipCode.pobjects.order_by('pk').values_list('pk', flat=True))
+        blocks = [pks[i:i+BLOCK_SIZE] for i in xrange(0, len(pks), BLOCK_SIZE)]
+
+        # Close our own connection before forking so workers don't share it.
+        connection.close()
+        pool = Pool(processes=options['processes'], initializer=close_db_connection)
+        results = []
+        try:
+            for block_results in pool.imap_unordered(join_block, blocks):
+                results.extend(block_results)
+                print "  %d/%d ZIP codes joined (%.1f/sec)" % (len(results), len(pks), len(results)/max(time()-start, .001))
+        finally:
+            pool.close()
+            pool.join()
 
-class Command(NoArgsCommand):
-    help = "Disabled. Used for converting ZipCode shapefile data into the Places data model."
-    
-    output_transaction = True
-    
-    def handle_noargs(self, **options):
-        convert_by_block(ZipCode.objects.only('id'), 300)
+        missing = [pk for pk, state_id, county_id in results if state_id is None]
+        for pk in missing:
+            print "\t%s: No primary state" % pk
 
+        print "Saving..."
+        updated, num_updates = bulk_update(results)
+        invalidate_cached(updated)
+        print "Saved %d ZIP codes with %d UPDATEs in %.1f sec." % (len(updated), num_updates, time()-start)
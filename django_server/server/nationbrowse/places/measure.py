@@ -0,0 +1,43 @@
+# coding=utf-8
+"""
+Per-place measurements derived from `poly`: geographic center, bounding box
+and area. These are computed once per import by the `measure_places` command
+and stored in PolyModel columns (see GEOMETRY_FIELDS), so pages, lists and
+rankings never have to load or reproject a polygon for them.
+"""
+
+# National Atlas Equal Area. Not the most exact, but it applies nationally.
+EQUAL_AREA_SRID = 2163
+SQ_M_PER_SQ_MI = 2589988.110336
+
+GEOMETRY_FIELDS = (
+    'center_lat','center_lon',
+    'bbox_west','bbox_south','bbox_east','bbox_north',
+    'area_sq_mi',
+)
+
+def equal_area(geom):
+    """ Area of a WGS84 geometry in square miles, without mutating it. """
+    return geom.transform(EQUAL_AREA_SRID, clone=True).area / SQ_M_PER_SQ_MI
+
+def geometry_values(poly):
+    """
+    Returns a {field: value} dict of the GEOMETRY_FIELDS for the given polygon
+    (all None for a missing/empty polygon), suitable for QuerySet.update().
+    """
+    values = dict([(field, None) for field in GEOMETRY_FIELDS])
+    if not poly or poly.empty:
+        return values
+
+    center = poly.centroid
+    west, south, east, north = poly.extent
+    values.update({
+        'center_lat':center.y,
+        'center_lon':center.x,
+        'bbox_west':west,
+        'bbox_south':south,
+        'bbox_east':east,
+        'bbox_north':north,
+        'area_sq_mi':equal_area(poly),
+    })
+    return values
@@ -8,6 +8,8 @@ This file defines the data models for our places.
  * State
  * County
  * ZipCode
+ * ZipCodeCounty, the materialized ZIP code <-> County overlap table
+ * TopologyArc, the shared borders of each place type's polygons
 
 To match up with Census-recorded data, we also store the FIPS code of most
 of these objects - they come embedded in the Census' TIGER/Line data, which
@@ -20,14 +22,18 @@ is what populates these model tables.
 from django.conf import settings
 from cacheutil import cached_clsmethod,cached_property,USING_DUMMY_CACHE
 from django.db import models
+from django.db.models.signals import post_save,post_delete
 from django_caching.models import CachedModel
 from django_caching.managers import CachingManager
 
 from nationbrowse.demographics.models import PlacePopulation
 from django.contrib.gis.measure import Area
 from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from threadutil import call_in_bg
-import re
+from nationbrowse.places.simplify import simplify_poly,simplified_values,field_for_zoom
+from nationbrowse.places.measure import equal_area,geometry_values
+from nationbrowse.places import registry
 
 # Are we on a GIS-aware server?
 USE_GIS = getattr(settings,'USE_GIS',False)
@@ -41,8 +47,6 @@ if USE_GIS:
 
 # --------------------------------------------------------------
 
-TRUNCATE_WKT = re.compile('(-?\d?\d?\d\.\d\d\d\d\d\d)(\d+)(,? ?)')
-
 class PolyModel(CachedModel):
     """
     An abstract base class for any model with a polygon region.
@@ -55,6 +59,33 @@ class PolyModel(CachedModel):
     else:
         poly    = models.TextField(verbose_name="geographic area data (non-GIS)",blank=True,null=True)
 
+    # Simplified copies of `poly` for each map zoom band, as WKT with truncated
+    # coordinates. Filled by the `simplify_places` command; see simplify.py.
+    wkt_low     = models.TextField(verbose_name="simplified area data (low detail)",blank=True,null=True,editable=False)
+    wkt_medium  = models.TextField(verbose_name="simplified area data (medium detail)",blank=True,null=True,editable=False)
+    wkt_high    = models.TextField(verbose_name="simplified area data (high detail)",blank=True,null=True,editable=False)
+
+    # Large columns that querysets (and so cached objects) leave out; see
+    # PolyDeferGeoManager. They're loaded on first access.
+    deferred_fields = ('poly','wkt_low','wkt_medium','wkt_high','arcs')
+
+    # Measurements of `poly`, stored by the `measure_places` command so that
+    # pages and rankings can use (and sort/filter on) them without loading or
+    # reprojecting the polygon. See measure.py.
+    center_lat  = models.FloatField(verbose_name="center latitude",blank=True,null=True,db_index=True,editable=False)
+    center_lon  = models.FloatField(verbose_name="center longitude",blank=True,null=True,db_index=True,editable=False)
+    bbox_west   = models.FloatField(verbose_name="bounding box west",blank=True,null=True,db_index=True,editable=False)
+    bbox_south  = models.FloatField(verbose_name="bounding box south",blank=True,null=True,db_index=True,editable=False)
+    bbox_east   = models.FloatField(verbose_name="bounding box east",blank=True,null=True,db_index=True,editable=False)
+    bbox_north  = models.FloatField(verbose_name="bounding box north",blank=True,null=True,db_index=True,editable=False)
+    area_sq_mi  = models.FloatField(verbose_name="area (sq. mi.)",blank=True,null=True,db_index=True,editable=False)
+    pop_density = models.FloatField(verbose_name="population density (per sq. mi.)",blank=True,null=True,db_index=True,editable=False)
+
+    # `poly` as indexes into the TopologyArc table of this place type (JSON,
+    # nested by polygon and ring). Filled by the `build_topology` command;
+    # see topology.py.
+    arcs        = models.TextField(verbose_name="topology arcs",blank=True,null=True,editable=False)
+
     poly_source = "U.S. Census Bureau TIGER/Line, 2008"
     poly_source_url = "http://www.census.gov/geo/www/tiger/"
 
@@ -78,6 +109,8 @@ class PolyModel(CachedModel):
         """
         Returns the latitude for this objects' geographic center.
         """
+        if self.center_lat is not None:
+            return self.center_lat
         if not self.center:
             return None
         
@@ -88,11 +121,22 @@ class PolyModel(CachedModel):
         """
         Returns the longitude for this objects' geographic center.
         """
+        if self.center_lon is not None:
+            return self.center_lon
         if not self.center:
             return None
         
         return self.center.x
 
+    @property
+    def bbox(self):
+        """
+        Returns the stored (west, south, east, north) bounding box, or None.
+        """
+        if self.bbox_west is None:
+            return None
+        return (self.bbox_west, self.bbox_south, self.bbox_east, self.bbox_north)
+
     def contains_coordinate(self, lat, lon):
         """ Helper method; given a lat/lon, returns whether the given point is within this PolyModel. """
         if not USE_GIS:
@@ -114,71 +158,82 @@ class PolyModel(CachedModel):
         WKT), we simplify it a bit and lose some of the detail (.01 tolerance -> 9000 chars
         for Missouri's WKT; .05 -> 2278 chars).
         
-        Additionally uses a compiled regular expression to truncate coordinates to at most
-        six decimal places.
+        The simplified version is materialized in the `wkt_medium` column by the
+        `simplify_places` command; this only simplifies on the fly (the slow way) for
+        places that haven't been processed yet.
         """
+        if self.wkt_medium:
+            return self.wkt_medium
         if not USE_GIS:
             return None
         if not self.poly:
             return False
         
-        simple = TRUNCATE_WKT.sub(
-            r'\1\3',
-            self.poly.simplify(tolerance=.01).wkt
-        )
-        
-        # If that tolerance level results in an empty polygon (the algorithm
-        # gets rid of too many points), try to do a "dumb" simplification on it.
-        if simple == "POLYGON EMPTY":
-            simple = TRUNCATE_WKT.sub(
-                r'\1\3',
-                self.poly.simplify(tolerance=.01,preserve_topology=True).wkt
-            )
-        
-        # Try a "dumb" simplification on it.
-        if simple == "POLYGON EMPTY":
-            simple = TRUNCATE_WKT.sub(
-                r'\1\3',
-                self.poly.simplify().wkt
-            )
-        
-        # Try a "dumb" simplification on it.
-        if simple == "POLYGON EMPTY":
-            simple = TRUNCATE_WKT.sub(
-                r'\1\3',
-                self.poly.simplify(preserve_topology=True).wkt
-            )
-        
-        # If even *that* doesn't get a simple polygon, just return the standard poly,
-        # with the coordinates truncated to 6 decimal places.
-        if simple == "POLYGON EMPTY":
-            simple = TRUNCATE_WKT.sub(
-                r'\1\3',
-                self.poly.wkt
-            )
-        
-        return simple
+        return simplify_poly(self.poly, tolerance=.01, precision=4)
     simple_wkt = cached_property(simple_wkt, 15552000)
     
+    def wkt_for_zoom(self, zoom):
+        """
+        Returns the simplified WKT appropriate for the given map zoom level, or
+        None if it hasn't been materialized.
+        """
+        return getattr(self, field_for_zoom(zoom))
+    
+    def refresh_simplified(self, commit=True):
+        """
+        Recomputes the simplified geometry columns from `poly`. Requires GIS.
+        """
+        if not USE_GIS:
+            return None
+        poly = self.poly
+        if isinstance(poly,basestring):
+            poly = geo_from_str(poly)
+        values = simplified_values(poly)
+        for field, wkt in values.items():
+            setattr(self, field, wkt)
+        if commit:
+            self.__class__._default_manager.filter(pk=self.pk).update(**values)
+        return values
+    
+    def refresh_measurements(self, commit=True):
+        """
+        Recomputes the center, bbox and area columns from `poly`. Requires GIS.
+        (pop_density is left alone; see the `measure_places` command.)
+        """
+        if not USE_GIS:
+            return None
+        poly = self.poly
+        if isinstance(poly,basestring):
+            poly = geo_from_str(poly)
+        values = geometry_values(poly)
+        for field, value in values.items():
+            setattr(self, field, value)
+        if commit:
+            self.__class__._default_manager.filter(pk=self.pk).update(**values)
+        return values
+    
+    @property
     def area(self):
         """
-        Since most of our polygons are HORRIBLY detailed (~ 1 million chars for Missouri's
-        WKT), we simplify it a bit and lose some of the detail (.01 tolerance -> 9000 chars
-        for Missouri's WKT; .05 -> 2278 chars).
-        
-        Additionally uses a compiled regular expression to truncate coordinates to at most
-        six decimal places.
+        Returns this place's area as an Area measure, from the stored `area_sq_mi`
+        column if it has been filled in.
+        """
+        if self.area_sq_mi is not None:
+            return Area(sq_mi=self.area_sq_mi,default_unit="sq_mi")
+        return self.computed_area
+    
+    def computed_area(self):
+        """
+        Computes the area from `poly` (reprojected to an equal-area projection; the
+        slow way) for places that haven't been measured yet.
         """
         if not USE_GIS:
             return None
         if not self.poly:
             return False
         
-        # Not the most exact, but it applies nationally.
-        p = self.poly
-        p.transform(2163)
-        return Area(sq_m=p.area,default_unit="sq_mi")
-    area = cached_property(area, 15552000)
+        return Area(sq_mi=equal_area(self.poly),default_unit="sq_mi")
+    computed_area = cached_property(computed_area, 15552000)
     
     # Special fake foreign key that checks the PlacePopulation table for a record
     # that corresponds with this Place.
@@ -186,18 +241,31 @@ class PolyModel(CachedModel):
     
     def population_demographics(self):
         """
-        If this place has a record in PlacePopulation, retrieve and return that.
+        If this place has a record in PlacePopulation, retrieve and return that:
+        the one from the most recent original source, or if it has none, the
+        most recent roll-up.
         """
-        if self.demographic_fkey and self.demographic_fkey.count() > 0:
+        records = self.demographic_fkey.order_by('-source__date','-source')
+        for qs in (records.filter(source__derived_from__isnull=True), records):
             try:
-                return self.demographic_fkey.all()[0]
-            except:
-                return None
+                return qs[0]
+            except IndexError:
+                pass
+        return None
     population_demographics = cached_property(population_demographics, 15552000)
 
     class Meta:
         abstract = True
 
+def cached_class_names(PlaceClass):
+    """
+    The class names a place's cached_clsmethod and cached_property results
+    are keyed under: its own, and those of the deferred subclasses that
+    querysets (see PolyModel.deferred_fields) return.
+    """
+    return [PlaceClass.__name__] + ["%s_Deferred_%s" % (PlaceClass.__name__, '_'.join(sorted(fields)))
+        for fields in (('poly',), PlaceClass.deferred_fields)]
+
 # --------------------------------------------------------------
 
 class Nation(PolyModel):
@@ -231,11 +299,11 @@ class State(PolyModel):
     fips_code = models.PositiveSmallIntegerField(verbose_name="FIPS code",null=True,db_index=True)
     
     def counties(self):
-        return self.county_set.defer('poly',).all()
+        return self.county_set.defer(*PolyModel.deferred_fields).all()
     counties = cached_clsmethod(counties, 15552000)
     
     def zipcodes(self):
-        return self.zipcode_set.defer('poly',).all()
+        return self.zipcode_set.defer(*PolyModel.deferred_fields).all()
     zipcodes = cached_clsmethod(zipcodes, 15552000)
     
     class Meta:
@@ -265,12 +333,12 @@ class County(PolyModel):
     cbsafp = models.PositiveIntegerField(verbose_name="Metropolitan Area Code",blank=True,null=True)
     metdivfp = models.PositiveIntegerField(verbose_name="Metropolitan Division Code",blank=True,null=True)
 
-    #def zipcodes(self):
-    #    if USE_GIS:
-    #        return ZipCode.objects.filter(poly__intersects=self.poly)
-    #    else:
-    #        return None
-    #zipcodes = cached_property(zipcodes, 15552000)
+    def zipcodes(self):
+        """
+        ZIP codes that overlap this county, from the ZipCodeCounty crosswalk.
+        """
+        return ZipCode.objects.filter(county_overlaps__county=self).order_by('name')
+    zipcodes = cached_clsmethod(zipcodes, 15552000)
     
     class Meta:
         verbose_name_plural = "counties"
@@ -285,7 +353,7 @@ class County(PolyModel):
     def get_absolute_url(self):
         return ('places:county_detail', (), {
             'state_abbr' : self.state.abbr.lower(),
-            'name' : self.name.lower()
+            'name' : registry.normalize_name(self.name)
         })
 
 class ZipCode(PolyModel):
@@ -295,31 +363,25 @@ class ZipCode(PolyModel):
     else:
         objects = CachingManager()
     
-    # Technically, ZipCodes can span multiple states. We're only storing the "primary" match.
+    # Technically, ZipCodes can span multiple states (and counties). We're only storing
+    # the "primary" match. Both are assigned by the `zipcode_populate_states` command.
     state  = models.ForeignKey('State',blank=True,null=True,db_index=True)
+    county = models.ForeignKey('County',blank=True,null=True,db_index=True)
+
+    def counties(self):
+        """
+        Counties this ZIP code overlaps, from the ZipCodeCounty crosswalk. Ordered
+        by how much of the ZIP code lies in each, so the first one is the "primary" county.
+        """
+        return County.objects.filter(zipcode_overlaps__zipcode=self).order_by('-zipcode_overlaps__zipcode_fraction')
+    counties = cached_clsmethod(counties, 15552000)
 
-    #def counties(self):
-    #    if USE_GIS:
-    #        return County.objects.filter(state=self.state,poly__intersects=self.poly)
-    #    else:
-    #        return None
-    #counties = cached_property(counties, 15552000)
-
-    #def county(self):
-    #    """
-    #    If this ZIP code belongs to a county, returns that.
-    #    If it belongs to more than one county, returns the first match.
-    #    Otherwise, returns None.
-    #    """
-    #    if USE_GIS:
-    #        c = self.counties
-    #        if c and (c.count() > 0):
-    #            return c[0]
-    #        else:
-    #            return None
-    #    else:
-    #        return None
-    #county = cached_property(county, 15552000)
+    def states(self):
+        """
+        States this ZIP code overlaps (via the counties it overlaps).
+        """
+        return State.objects.filter(county__zipcode_overlaps__zipcode=self).distinct()
+    states = cached_clsmethod(states, 15552000)
 
     class Meta:
         ordering = ('name',)
@@ -333,3 +395,61 @@ class ZipCode(PolyModel):
         return ('places:zipcode_detail', (), {
             'slug' : self.id
         })
+
+class ZipCodeCounty(CachedModel):
+    """
+    The ZIP code <-> County crosswalk: one row for every ZIP code and county whose
+    polygons intersect, with the area they share. ZIP codes (ZCTAs) do not nest
+    inside counties, so this is many-to-many.
+
+    Computing `poly__intersects` per page view is far too slow, so this table is
+    materialized offline by the `build_zipcode_crosswalk` command. Areas are
+    computed in SRID=2163, the National Atlas Equal Area projection.
+    """
+    objects = CachingManager()
+    
+    zipcode = models.ForeignKey('ZipCode',related_name='county_overlaps',db_index=True)
+    county = models.ForeignKey('County',related_name='zipcode_overlaps',db_index=True)
+    
+    overlap_area = models.FloatField(verbose_name="overlap area (sq. mi.)")
+    zipcode_fraction = models.FloatField(help_text="share of the ZIP code's area that lies in the county")
+    county_fraction = models.FloatField(help_text="share of the county's area that lies in the ZIP code")
+    
+    class Meta:
+        verbose_name = "ZIP code/county overlap"
+        ordering = ('zipcode','-zipcode_fraction')
+        unique_together = (('zipcode','county'),)
+    
+    def __unicode__(self):
+        return u"%s in %s (%.1f%%)" % (self.zipcode_id, self.county_id, self.zipcode_fraction*100)
+
+class TopologyArc(CachedModel):
+    """
+    One arc of the shared-border topology of a place type: a stretch of
+    border between two junctions, which every place it bounds refers to (by
+    index) in its `arcs`. Stored simplified for each map zoom band, as
+    TopoJSON delta-encoded coordinates on the band's grid.
+
+    Built by the `build_topology` command; see topology.py.
+    """
+    objects = CachingManager()
+    
+    place_type = models.ForeignKey(ContentType)
+    index = models.PositiveIntegerField(db_index=True)
+    
+    arc_low = models.TextField(verbose_name="arc (low detail)")
+    arc_medium = models.TextField(verbose_name="arc (medium detail)")
+    arc_high = models.TextField(verbose_name="arc (high detail)")
+    
+    class Meta:
+        verbose_name = "topology arc"
+        ordering = ('place_type','index')
+        unique_together = (('place_type','index'),)
+    
+    def __unicode__(self):
+        return u"%s arc %d" % (self.place_type, self.index)
+
+# Keep every process's PlaceRegistry up to date (see registry.py).
+for PlaceClass in (State, County, ZipCode):
+    post_save.connect(registry.place_changed, sender=PlaceClass)
+    post_delete.connect(registry.place_changed, sender=PlaceClass)
@@ -0,0 +1,188 @@
+# coding=utf-8
+"""
+"Places near here": k-nearest and radius searches over place centroids.
+
+Centroids for a place type are loaded once per process from the stored
+center columns (filled by `measure_places`) and projected into SRID=2163
+(the National Atlas Equal Area projection, same one we use for areas) so
+that plain Euclidean distance is a good proxy for ground distance. A scipy cKDTree answers the queries; candidates are then
+re-ranked by great-circle distance, so the reported distances (in miles)
+are exact even where the projection distorts (i.e. Alaska and Hawaii).
+
+An index is rebuilt when the shared place data version changes (which
+`measure_places` bumps; see registry.py), and at least every
+MAX_AGE_SECONDS.
+"""
+from __future__ import division
+from django.conf import settings
+from django.db.models.loading import get_model
+from scipy.spatial import cKDTree
+from threading import Lock
+from time import time
+import numpy
+
+from nationbrowse.places.geocode import place_info
+from nationbrowse.places.registry import current_version
+
+USE_GIS = getattr(settings,'USE_GIS',False)
+
+# Spherical Lambert Azimuthal Equal Area parameters of EPSG:2163.
+EARTH_RADIUS_M = 6370997.0
+LAEA_LAT0 = numpy.radians(45.0)
+LAEA_LON0 = numpy.radians(-100.0)
+
+METERS_PER_MILE = 1609.344
+EARTH_RADIUS_MI = 3958.7613
+
+# How much further than requested to search in projected space before the
+# exact great-circle filter; covers the projection's worst-case distortion
+# within the 50 states.
+PROJECTION_SLACK = 1.5
+
+# Indexes are rebuilt at least this often (seconds), in case a change
+# didn't bump the data version.
+MAX_AGE_SECONDS = 3600
+
+def project(lats, lons):
+    """
+    Projects arrays of WGS84 lat/lon (degrees) to EPSG:2163 x/y (meters).
+    Returns an (n, 2) array.
+    """
+    phi = numpy.radians(numpy.asarray(lats, dtype=float))
+    lam = numpy.radians(numpy.asarray(lons, dtype=float)) - LAEA_LON0
+    cos_phi = numpy.cos(phi)
+    k = numpy.sqrt(2 / (1 + numpy.sin(LAEA_LAT0)*numpy.sin(phi) + numpy.cos(LAEA_LAT0)*cos_phi*numpy.cos(lam)))
+    x = EARTH_RADIUS_M * k * cos_phi * numpy.sin(lam)
+    y = EARTH_RADIUS_M * k * (numpy.cos(LAEA_LAT0)*numpy.sin(phi) - numpy.sin(LAEA_LAT0)*cos_phi*numpy.cos(lam))
+    return numpy.column_stack((x, y))
+
+def great_circle_miles(lat, lon, lats, lons):
+    """ Haversine distance (miles) from one point to arrays of points. """
+    phi1, phi2 = numpy.radians(lat), numpy.radians(lats)
+    dphi = phi2 - phi1
+    dlam = numpy.radians(lons) - numpy.radians(lon)
+    a = numpy.sin(dphi/2)**2 + numpy.cos(phi1)*numpy.cos(phi2)*numpy.sin(dlam/2)**2
+    return 2 * EARTH_RADIUS_MI * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+
+class CentroidIndex(object):
+    """
+    A KD-tree over the projected centroids of one place type.
+    Results are lists of (pk, distance in miles), nearest first.
+    """
+    def __init__(self, pks, lats, lons):
+        self.pks = numpy.asarray(pks)
+        self.lats = numpy.asarray(lats, dtype=float)
+        self.lons = numpy.asarray(lons, dtype=float)
+        self.row_for_pk = dict(zip(self.pks.tolist(), xrange(len(self.pks))))
+        # (No tree for no places: cKDTree can't be built over zero rows.)
+        self.tree = cKDTree(project(self.lats, self.lons)) if len(self.pks) else None
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _results(self, lat, lon, rows, exclude=None, max_miles=None):
+        rows = numpy.asarray(rows, dtype=int)
+        if exclude is not None:
+            rows = rows[self.pks[rows] != exclude]
+        miles = great_circle_miles(lat, lon, self.lats[rows], self.lons[rows])
+        if max_miles is not None:
+            keep = miles <= max_miles
+            rows, miles = rows[keep], miles[keep]
+        order = numpy.argsort(miles, kind='mergesort')
+        return zip(self.pks[rows[order]].tolist(), miles[order].tolist())
+
+    def centroid(self, pk):
+        """ Returns the (lat, lon) centroid for a place, or None. """
+        row = self.row_for_pk.get(pk)
+        if row is None:
+            return None
+        return self.lats[row], self.lons[row]
+
+    def nearest(self, lat, lon, k=10, exclude=None):
+        """ The k places whose centroids are nearest to the point. """
+        if not len(self) or k < 1:
+            return []
+        # Over-fetch so the great-circle re-ranking (and excluding a place
+        # from its own results) still leaves k good answers.
+        fetch = min(len(self), 2*k + 1)
+        dist, rows = self.tree.query(project([lat], [lon])[0], k=fetch)
+        rows = numpy.atleast_1d(rows)
+        return self._results(lat, lon, rows, exclude)[:k]
+
+    def within(self, lat, lon, miles, exclude=None):
+        """ Every place whose centroid is within `miles` of the point. """
+        if not len(self):
+            return []
+        radius = miles * METERS_PER_MILE * PROJECTION_SLACK
+        rows = self.tree.query_ball_point(project([lat], [lon])[0], radius)
+        return self._results(lat, lon, rows, exclude, max_miles=miles)
+
+    def nearest_to_place(self, pk, k=10):
+        """ The k places nearest to another place of the same type. """
+        center = self.centroid(pk)
+        if center is None:
+            return []
+        return self.nearest(center[0], center[1], k, exclude=pk)
+
+def _load_centroids(place_type):
+    """
+    Returns (pks, lats, lons) for every place of this type, from the stored
+    center columns (see the `measure_places` command).
+    """
+    PlaceClass = get_model('places', place_type)
+    rows = PlaceClass.objects.exclude(center_lat=None).exclude(center_lon=None).order_by().values_list('pk','center_lat','center_lon')
+    rows = list(rows)
+    if not rows:
+        return [], [], []
+    return zip(*rows)
+
+_indexes = {}
+_indexes_lock = Lock()
+
+def get_centroid_index(place_type):
+    """
+    Returns the process-wide CentroidIndex for a place type (built on first
+    use, and again after the place data changes), or None if this server
+    is not GIS-aware.
+    """
+    if not USE_GIS:
+        return None
+    version = current_version()
+    entry = _indexes.get(place_type)
+    if entry is None or entry[0] != version or time() - entry[1] > MAX_AGE_SECONDS:
+        _indexes_lock.acquire()
+        try:
+            entry = _indexes.get(place_type)
+            if entry is None or entry[0] != version or time() - entry[1] > MAX_AGE_SECONDS:
+                entry = _indexes[place_type] = (version, time(), CentroidIndex(*_load_centroids(place_type)))
+        finally:
+            _indexes_lock.release()
+    return entry[2]
+
+def reset():
+    """ Drops the indexes (they will be rebuilt on next use). """
+    _indexes.clear()
+
+def with_place_info(place_type, results):
+    """
+    Turns (pk, miles) results into {'id','name','url','distance'} dicts for
+    templates and JSON, without touching the database.
+    """
+    places = []
+    for pk, miles in results:
+        info = place_info(place_type, pk)
+        if info:
+            info = dict(info)
+            info['distance'] = miles
+            places.append(info)
+    return places
+
+def nearby_places(place_type, pk, k=8):
+    """
+    The k places of the same type nearest to the given place, as dicts (see
+    with_place_info). Empty if the centroid index isn't available.
+    """
+    index = get_centroid_index(place_type)
+    if index is None:
+        return []
+    return with_place_info(place_type, index.nearest_to_place(pk, k))
@@ -0,0 +1,125 @@
+# coding=utf-8
+"""
+The pool of random places behind places:random_place.
+
+Each process keeps a deque of POOL_SIZE distinct, randomly picked places
+whose detail pages have already been rendered into the cache. A visitor
+pops one off the front (deque.popleft() is atomic, so concurrent visitors
+never get the same place), which needs no database access. When the pool
+runs low, a single background worker per process tops it up: it picks
+places from the compact pk arrays of the place registries (see
+registry.py), renders their detail pages through the normal views, and
+appends them.
+"""
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import resolve
+from django.http import HttpRequest,QueryDict
+from cacheutil import USING_DUMMY_CACHE
+from threadutil import call_in_bg
+from collections import deque
+from threading import Lock
+from urllib import unquote
+import random
+
+from nationbrowse.places.registry import get_registry
+
+PLACE_TYPES = ('state','county','zipcode')
+
+POOL_SIZE = getattr(settings,'RANDOM_PLACE_POOL_SIZE',50)
+# Start refilling when the pool is down to this many places.
+REFILL_AT = POOL_SIZE // 2
+
+_pool = deque()
+_pooled = set()
+_worker = Lock()
+
+def pick_random_place(rand=random):
+    """
+    Returns ((place type, pk), detail page URL) of a random place: a random
+    place type, then a random place of that type. None if there are none.
+    """
+    registries = [(place_type, get_registry(place_type)) for place_type in PLACE_TYPES]
+    registries = [(place_type, registry) for place_type, registry in registries if len(registry)]
+    if not registries:
+        return None
+    place_type, registry = rand.choice(registries)
+    i = rand.randrange(len(registry))
+    pk = int(registry.pks[i])
+    # The same URL as the place's get_absolute_url().
+    return (place_type, pk), registry.link_info(pk)['url']
+
+def prerender(url):
+    """ Renders (and so caches) the page at a URL, as an anonymous GET would. """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = unquote(url)
+    request.GET = QueryDict('')
+    request.META = {'SERVER_NAME':'localhost', 'SERVER_PORT':'80'}
+    request.user = AnonymousUser()
+    view, args, kwargs = resolve(request.path)
+    view(request, *args, **kwargs)
+
+def refill():
+    """
+    Tops the pool up to POOL_SIZE distinct places. Only one refill runs at
+    a time in a process; others return immediately.
+    """
+    if not _worker.acquire(False):
+        return
+    try:
+        attempts = 0
+        while len(_pool) < POOL_SIZE and attempts < POOL_SIZE * 4:
+            attempts += 1
+            picked = pick_random_place()
+            if picked is None:
+                break
+            key, url = picked
+            if key in _pooled:
+                continue
+            if not USING_DUMMY_CACHE:
+                try:
+                    prerender(url)
+                except Exception:
+                    from traceback import print_exc
+                    print_exc()
+                    continue
+            _pooled.add(key)
+            _pool.append((key, url))
+    finally:
+        _worker.release()
+
+def request_refill():
+    """ Starts a background refill if the pool is low and none is running. """
+    if len(_pool) > REFILL_AT or _worker.locked():
+        return
+    if USING_DUMMY_CACHE:
+        # Nothing to pre-render, so picking places is cheap enough to do now.
+        refill()
+    else:
+        call_in_bg(refill)
+
+def next_random_url():
+    """
+    The URL of the next random place, taken from the pool (or picked on the
+    spot if the pool is empty). Returns None if there are no places.
+    """
+    try:
+        key, url = _pool.popleft()
+    except IndexError:
+        request_refill()
+        try:
+            key, url = _pool.popleft()
+        except IndexError:
+            picked = pick_random_place()
+            if picked is None:
+                return None
+            key, url = picked
+    _pooled.discard(key)
+    request_refill()
+    return url
+
+def reset():
+    """ Empty the pool (i.e. after a data import). """
+    _pool.clear()
+    _pooled.clear()
@@ -0,0 +1,227 @@
+# coding=utf-8
+"""
+An in-memory registry of every State, County and ZipCode, for resolving
+slugs, names and FIPS codes to primary keys without touching the database.
+
+Looking up a county by `state__abbr__iexact` and `name__iexact` is a
+case-insensitive match over a join, on every cache miss of county_detail
+and for every row of an import. Instead, each place type's identifiers are
+loaded once per process, with one values_list() query, into a PlaceRegistry:
+numpy arrays for the numeric columns (pk, FIPS codes, center lat/lon),
+plain lists for the strings, and dicts from each kind of key to a row.
+Resolving is then a dict lookup; the object itself can be fetched by pk,
+which the caching manager serves from the cache.
+
+Names are matched case-, whitespace- and punctuation-insensitively (see
+normalize_name), counties by their name or long name within a state.
+
+The registry also gives each place's display name and URL (link_info()),
+for search results, geocoding and the other JSON APIs that link to places.
+
+Registries are reloaded when a place is saved or deleted in this process
+(post_save/post_delete), and within VERSION_CHECK_SECONDS when any other
+process bumps the shared data version -- which those signals do, as should
+commands that change places with QuerySet.update() (see bump_version()).
+"""
+from django.db.models.loading import get_model
+from django.core.urlresolvers import reverse
+from cacheutil import safe_get_cache,safe_set_cache
+from threading import Lock
+from time import time
+import numpy
+import re
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# How often (seconds) a process checks the shared data version.
+VERSION_CHECK_SECONDS = 60
+VERSION_CACHE_KEY = "place_registry_version"
+VERSION_CACHE_SECONDS = 2592000
+
+_punctuation = re.compile(r"[.'`]+")
+_whitespace = re.compile(r"[\s_-]+")
+
+def normalize_name(name):
+    """ i.e. u"St.  Louis" -> u"st louis". """
+    if name is None:
+        return None
+    return _whitespace.sub(u" ", _punctuation.sub(u"", unicode(name).lower())).strip()
+
+def _state_key(state):
+    return state and state.strip().upper() or None
+
+class PlaceRegistry(object):
+    """
+    The identifiers of every place of one type. `rows` is a sequence of
+    (pk, slug, name, long name, state abbr, FIPS code, state FIPS code,
+    center lat, center lon); missing values are None.
+    """
+    def __init__(self, place_type, rows):
+        self.place_type = place_type
+        rows = list(rows)
+        self.slugs = [row[1] for row in rows]
+        self.names = [row[2] for row in rows]
+        self.long_names = [row[3] for row in rows]
+        self.states = [row[4] for row in rows]
+        self.pks = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        self.fips = numpy.array([row[5] if row[5] is not None else -1 for row in rows], dtype=numpy.int32)
+        self.lats = numpy.array([row[7] if row[7] is not None else numpy.nan for row in rows], dtype=float)
+        self.lons = numpy.array([row[8] if row[8] is not None else numpy.nan for row in rows], dtype=float)
+
+        self._links = {}
+        self._state_names = None
+        self._by_pk = {}
+        self._by_slug = {}
+        self._by_name = {}
+        self._by_fips = {}
+        for i, (pk, slug, name, long_name, state, fips, state_fips, lat, lon) in enumerate(rows):
+            self._by_pk[pk] = i
+            if slug:
+                self._by_slug.setdefault(slug.lower(), i)
+            # Names win over long names, and the first of equal names wins.
+            # County names are only unique within a state.
+            keys = [_state_key(state)]
+            if place_type != 'county':
+                keys.append(None)
+            for n in (name, long_name):
+                if n:
+                    for key in keys:
+                        self._by_name.setdefault((key, normalize_name(n)), i)
+            if fips is not None:
+                self._by_fips.setdefault((state_fips, fips), i)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __contains__(self, pk):
+        return pk in self._by_pk
+
+    def _pk(self, i):
+        if i is None:
+            return None
+        return int(self.pks[i])
+
+    def pk_for_slug(self, slug):
+        """ The pk of the place with this slug (in any case), or None. """
+        return self._pk(self._by_slug.get((slug or '').lower()))
+
+    def pk_for_name(self, name, state=None):
+        """
+        The pk of the place with this name, or None. Counties must be looked
+        up within a state, given by abbreviation.
+        """
+        return self._pk(self._by_name.get((_state_key(state), normalize_name(name))))
+
+    def pk_for_fips(self, fips, state_fips=None):
+        """ The pk of the place with this FIPS code (counties: within a state's FIPS code), or None. """
+        try:
+            fips = int(fips)
+            if state_fips is not None:
+                state_fips = int(state_fips)
+        except (TypeError, ValueError):
+            return None
+        return self._pk(self._by_fips.get((state_fips, fips)))
+
+    def info(self, pk):
+        """ Returns {'id','slug','name','state','fips','lat','lon'} for a place, or None. """
+        i = self._by_pk.get(pk)
+        if i is None:
+            return None
+        fips, lat, lon = self.fips[i], self.lats[i], self.lons[i]
+        return {
+            'id':pk,
+            'slug':self.slugs[i],
+            'name':self.names[i],
+            'state':self.states[i],
+            'fips':int(fips) if fips >= 0 else None,
+            'lat':float(lat) if not numpy.isnan(lat) else None,
+            'lon':float(lon) if not numpy.isnan(lon) else None,
+        }
+
+    def state_name(self, abbr):
+        """ The name of the State with this abbreviation, or None (state registries only). """
+        if self._state_names is None:
+            self._state_names = dict([(_state_key(state), name) for state, name in zip(self.states, self.names)])
+        return self._state_names.get(_state_key(abbr))
+
+    def link_info(self, pk):
+        """
+        Returns {'id','name','url'} for a place (its display name and page),
+        or None. Built on first use for each place.
+        """
+        link = self._links.get(pk)
+        if link is None:
+            i = self._by_pk.get(pk)
+            if i is None:
+                return None
+            pk = int(self.pks[i])
+            if self.place_type == 'state':
+                name, url = self.names[i], reverse('places:state_detail',kwargs={'slug':self.slugs[i]})
+            elif self.place_type == 'county':
+                state = self.states[i] or u''
+                name = u"%s, %s" % (self.long_names[i], get_registry('state').state_name(state))
+                url = reverse('places:county_detail',kwargs={
+                    'state_abbr':state.lower(),
+                    'name':normalize_name(self.names[i])
+                })
+            else:
+                name, url = self.names[i], reverse('places:zipcode_detail',kwargs={'slug':pk})
+            link = self._links[pk] = {'id':pk, 'name':name, 'url':url}
+        return link
+
+def _load_rows(place_type):
+    PlaceClass = get_model('places', place_type)
+    qs = PlaceClass.objects.order_by('pk')
+    if place_type == 'state':
+        rows = qs.values_list('pk','slug','name','abbr','fips_code','center_lat','center_lon')
+        return [(pk, slug, name, None, abbr, fips, None, lat, lon) for pk, slug, name, abbr, fips, lat, lon in rows.iterator()]
+    elif place_type == 'county':
+        return qs.values_list('pk','slug','name','long_name','state__abbr','fips_code','state__fips_code','center_lat','center_lon').iterator()
+    else:
+        rows = qs.values_list('pk','slug','name','state__abbr','center_lat','center_lon')
+        return [(pk, slug, name, None, state, None, None, lat, lon) for pk, slug, name, state, lat, lon in rows.iterator()]
+
+def data_version():
+    """ The shared place data version (changed by bump_version()). """
+    return safe_get_cache(VERSION_CACHE_KEY)
+
+def bump_version():
+    """ Makes every process reload its registries (within VERSION_CHECK_SECONDS). """
+    reset()
+    safe_set_cache(VERSION_CACHE_KEY, "%f" % time(), VERSION_CACHE_SECONDS)
+
+_registries = {}
+_version = {'version':None, 'checked':0}
+_lock = Lock()
+
+def current_version():
+    """ The place data version this process has loaded (checked every VERSION_CHECK_SECONDS). """
+    if time() - _version['checked'] > VERSION_CHECK_SECONDS:
+        version = data_version()
+        _version['checked'] = time()
+        if version != _version['version']:
+            _version['version'] = version
+            _registries.clear()
+    return _version['version']
+
+def get_registry(place_type):
+    """ The PlaceRegistry for a place type (loaded on first use, and after data changes). """
+    current_version()
+    registry = _registries.get(place_type)
+    if registry is None:
+        _lock.acquire()
+        try:
+            registry = _registries.get(place_type)
+            if registry is None:
+                registry = _registries[place_type] = PlaceRegistry(place_type, _load_rows(place_type))
+        finally:
+            _lock.release()
+    return registry
+
+def reset():
+    """ Drop this process's registries. """
+    _registries.clear()
+
+def place_changed(sender, **kwargs):
+    """ post_save/post_delete receiver for the place models. """
+    bump_version()
@@ -0,0 +1,204 @@
+# coding=utf-8
+"""
+Place name search and autocomplete, over every State, County and ZipCode.
+
+The index is built once per process from the place registries (see
+registry.py) and kept in memory:
+
+ * a sorted list of normalized search terms -- each place's name, long
+   name and state abbreviation (and "<county> <state>"), plus their
+   word-suffixes ("louis county" for "st louis county") -- with numpy arrays
+   of the place each term belongs to and how good a match the term is. A prefix query is
+   a bisect into the list; the places in the matching slice are scored with
+   numpy and the best ones picked with argpartition.
+ * an inverted trigram index over names, for typo-tolerant matching when
+   the prefix search comes up short: the Jaccard similarity of the query's
+   trigrams and each place's is counted with a numpy bincount over the
+   posting lists of the query's trigrams.
+
+Ties are broken by population (the latest PlacePopulation total), so
+"spring" finds Springfield, MO before Springfield, SD. The index is rebuilt
+when the registries are (i.e. after places change).
+"""
+from __future__ import division
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.loading import get_model
+from bisect import bisect_left,bisect_right
+from threading import Lock
+import numpy
+
+from nationbrowse.places.registry import get_registry,normalize_name
+from nationbrowse.demographics.models import PlacePopulation,latest_values
+
+PLACE_TYPES = ('state','county','zipcode')
+
+# Match quality of the ways a term can match a query; population adds up
+# to POPULATION_WEIGHT * log10(population), so it only orders places within
+# a kind of match.
+EXACT_MATCH = 3
+TERM_PREFIX = 2
+WORD_PREFIX = 1
+POPULATION_WEIGHT = .1
+
+# Trigram matches need at least this Jaccard similarity.
+MIN_SIMILARITY = .3
+
+MAX_LIMIT = 25
+
+def trigrams(term):
+    """ i.e. u"joplin" -> set([u"  j", u" jo", u"jop", ..., u"in "]). """
+    padded = u"  %s " % term
+    return set([padded[i:i+3] for i in xrange(len(padded) - 2)])
+
+class SearchIndex(object):
+    """
+    `places` is a sequence of (place type, pk, population, [terms], [names]):
+    terms are matched by prefix (and their word-suffixes as well), names by
+    trigrams too. Terms and names should already be normalized.
+    """
+    def __init__(self, places):
+        places = list(places)
+        self.types = numpy.array([PLACE_TYPES.index(p[0]) for p in places], dtype=numpy.int8)
+        self.pks = numpy.array([p[1] for p in places], dtype=numpy.int64)
+        population = numpy.array([p[2] or 0 for p in places], dtype=float)
+        self.weights = POPULATION_WEIGHT * numpy.log10(1 + population)
+
+        terms = []
+        for i, (place_type, pk, pop, place_terms, names) in enumerate(places):
+            for term in set(place_terms):
+                terms.append((term, i, TERM_PREFIX))
+                words = term.split(u" ")
+                for w in xrange(1, len(words)):
+                    terms.append((u" ".join(words[w:]), i, WORD_PREFIX))
+        terms.sort()
+        self.terms = [t[0] for t in terms]
+        self.term_place = numpy.array([t[1] for t in terms], dtype=numpy.int32)
+        self.term_quality = numpy.array([t[2] for t in terms], dtype=float)
+
+        postings = {}
+        self.trigram_counts = numpy.zeros(len(places), dtype=float)
+        for i, (place_type, pk, pop, place_terms, names) in enumerate(places):
+            grams = set()
+            for name in names:
+                grams |= trigrams(name)
+            self.trigram_counts[i] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self.postings = dict([(gram, numpy.array(ids, dtype=numpy.int32)) for gram, ids in postings.iteritems()])
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _results(self, places, scores, limit, seen):
+        """ (place index, score) of the best `limit` places not in `seen`. """
+        if len(places) > limit * 8:
+            top = numpy.argpartition(-scores, limit * 8)[:limit * 8]
+            places, scores = places[top], scores[top]
+        results = []
+        for j in numpy.argsort(-scores, kind='mergesort'):
+            i = int(places[j])
+            if i not in seen:
+                seen.add(i)
+                results.append((i, float(scores[j])))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def prefix_search(self, query, limit=10, place_type=None, seen=None):
+        """ Places with a term starting with the query, best first, as (index, score). """
+        if seen is None:
+            seen = set()
+        low = bisect_left(self.terms, query)
+        high = bisect_left(self.terms, query + u"\uffff", low)
+        if low == high:
+            return []
+        places = self.term_place[low:high]
+        scores = self.term_quality[low:high].copy()
+        exact = bisect_right(self.terms, query, low, high) - low
+        scores[:exact] = EXACT_MATCH
+        scores += self.weights[places]
+        if place_type is not None:
+            keep = self.types[places] == PLACE_TYPES.index(place_type)
+            places, scores = places[keep], scores[keep]
+        return self._results(places, scores, limit, seen)
+
+    def fuzzy_search(self, query, limit=10, place_type=None, seen=None):
+        """ Places whose names have trigrams in common with the query, best first. """
+        if seen is None:
+            seen = set()
+        grams = trigrams(query)
+        lists = [self.postings[g] for g in grams if g in self.postings]
+        if not lists:
+            return []
+        counts = numpy.bincount(numpy.concatenate(lists), minlength=len(self))
+        places = numpy.nonzero(counts)[0]
+        similarity = counts[places] / (len(grams) + self.trigram_counts[places] - counts[places])
+        keep = similarity >= MIN_SIMILARITY
+        if place_type is not None:
+            keep &= self.types[places] == PLACE_TYPES.index(place_type)
+        places = places[keep]
+        return self._results(places, similarity[keep] + self.weights[places], limit, seen)
+
+    def search(self, query, limit=10, place_type=None):
+        """
+        Returns up to `limit` (place type, pk) matching the query: prefix
+        matches first, then (for queries of 3+ characters) fuzzy ones.
+        """
+        query = normalize_name(query)
+        if not query:
+            return []
+        seen = set()
+        results = self.prefix_search(query, limit, place_type, seen)
+        if len(results) < limit and len(query) >= 3:
+            results += self.fuzzy_search(query, limit - len(results), place_type, seen)
+        return [(PLACE_TYPES[self.types[i]], int(self.pks[i])) for i, score in results]
+
+def _populations(place_type):
+    """ {pk: latest population total} for a place type. """
+    PlaceClass = get_model('places', place_type)
+    qs = PlacePopulation.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass))
+    return dict([(place_id, row[0]) for place_id, row in latest_values(qs, 'total').iteritems()])
+
+def _index_places(registries):
+    """ SearchIndex input for the place registries. """
+    states = registries['state']
+    state_names = dict(zip(states.states, states.names))
+    for place_type in PLACE_TYPES:
+        registry = registries[place_type]
+        population = _populations(place_type)
+        for i, pk in enumerate(registry.pks.tolist()):
+            name, long_name, state = registry.names[i], registry.long_names[i], registry.states[i]
+            terms = [normalize_name(n) for n in (name, long_name) if n]
+            if place_type == 'state':
+                terms.append(normalize_name(state))
+            elif place_type == 'county' and state:
+                # "boone mo", "boone county missouri"
+                terms += [u"%s %s" % (t, normalize_name(s)) for t in list(terms) for s in (state, state_names.get(state)) if s]
+            # No typo tolerance for ZIP codes; a mistyped ZIP is just another ZIP.
+            if place_type == 'zipcode':
+                names = []
+            else:
+                names = [normalize_name(name)]
+            yield place_type, pk, population.get(pk), terms, names
+
+_index = {'index':None, 'registries':None}
+_lock = Lock()
+
+def get_search_index():
+    """ The SearchIndex of every place (built on first use, and after the registries change). """
+    registries = dict([(place_type, get_registry(place_type)) for place_type in PLACE_TYPES])
+    index = _index['index']
+    if index is None or _index['registries'] != registries:
+        _lock.acquire()
+        try:
+            if _index['index'] is None or _index['registries'] != registries:
+                _index['index'] = SearchIndex(_index_places(registries))
+                _index['registries'] = registries
+            index = _index['index']
+        finally:
+            _lock.release()
+    return index
+
+def reset():
+    _index['index'] = None
+    _index['registries'] = None
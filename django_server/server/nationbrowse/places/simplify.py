@@ -0,0 +1,96 @@
+# coding=utf-8
+"""
+Polygon simplification for map display.
+
+Our TIGER/Line polygons are far too detailed to send to a browser (~1 million
+chars of WKT for Missouri), so every PolyModel stores pre-simplified copies of
+its `poly` at a few tolerances -- one per map "zoom band" -- with coordinates
+truncated to the precision that band can actually display.
+
+ * SIMPLIFIED_LEVELS describes the bands (column name, tolerance, precision).
+ * simplify_poly() does the actual work for a single geometry and tolerance.
+ * field_for_zoom() maps a (Google/OpenLayers-style) map zoom level to a band,
+   and precision_for_zoom() to the precision its coordinates are kept at.
+
+The columns are filled by the `simplify_places` management command, which
+should be run after loading new geographic data.
+"""
+import re
+
+# (PolyModel column, simplification tolerance in degrees, decimal places kept)
+# Roughly: 0.001 deg ~ 100m, 0.01 deg ~ 1km, 0.05 deg ~ 5km. Each band keeps
+# about one more decimal place than its tolerance needs.
+SIMPLIFIED_LEVELS = (
+    ('wkt_low',     .05,    3),   # national/regional map (zoom 0-5)
+    ('wkt_medium',  .01,    4),   # state map (zoom 6-8)
+    ('wkt_high',    .001,   5),   # county/city map (zoom 9+)
+)
+SIMPLIFIED_FIELDS = [field for field, tolerance, precision in SIMPLIFIED_LEVELS]
+
+# Highest map zoom level served by each band, in SIMPLIFIED_LEVELS order.
+ZOOM_BANDS = (5, 8)
+
+_truncate_cache = {}
+
+def truncate_wkt(wkt, precision=6):
+    """
+    Uses a compiled regular expression to truncate WKT coordinates to at most
+    `precision` decimal places.
+    """
+    regex = _truncate_cache.get(precision)
+    if regex is None:
+        regex = re.compile(r'(-?\d{1,3}\.\d{%d})\d+' % precision)
+        _truncate_cache[precision] = regex
+    return regex.sub(r'\1', wkt)
+
+def simplify_poly(poly, tolerance=.01, precision=6):
+    """
+    Returns the simplified WKT for the given GEOS geometry.
+
+    Tries the given tolerance first. If that results in an empty polygon (the
+    algorithm gets rid of too many points), falls back to a topology-preserving
+    simplification, then to "dumb" simplifications, and finally to the full
+    polygon, so the result is never empty for a non-empty input.
+    """
+    attempts = (
+        {'tolerance':tolerance},
+        {'tolerance':tolerance, 'preserve_topology':True},
+        {},
+        {'preserve_topology':True},
+    )
+    for kwargs in attempts:
+        simple = poly.simplify(**kwargs)
+        if not simple.empty:
+            return truncate_wkt(simple.wkt, precision)
+    return truncate_wkt(poly.wkt, precision)
+
+def field_for_zoom(zoom):
+    """ Returns the PolyModel column holding the simplified WKT for a map zoom level. """
+    try:
+        zoom = int(zoom)
+    except (TypeError, ValueError):
+        zoom = 0
+    for i, max_zoom in enumerate(ZOOM_BANDS):
+        if zoom <= max_zoom:
+            return SIMPLIFIED_FIELDS[i]
+    return SIMPLIFIED_FIELDS[-1]
+
+def precision_for_zoom(zoom):
+    """ Returns the decimal places kept by the band for a map zoom level. """
+    field = field_for_zoom(zoom)
+    for level_field, tolerance, precision in SIMPLIFIED_LEVELS:
+        if level_field == field:
+            return precision
+
+def simplified_values(poly):
+    """
+    Returns a dict of {column: simplified WKT} for every band, suitable for
+    QuerySet.update(). Returns None for every column if there is no polygon.
+    """
+    values = {}
+    for field, tolerance, precision in SIMPLIFIED_LEVELS:
+        if poly and not poly.empty:
+            values[field] = simplify_poly(poly, tolerance, precision)
+        else:
+            values[field] = None
+    return values
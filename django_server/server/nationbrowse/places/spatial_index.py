@@ -0,0 +1,274 @@
+# coding=utf-8
+"""
+In-memory spatial index over the State, County and ZipCode polygons.
+
+Answering "which ZIP code, county and state contains this point?" through
+the ORM means a `poly__contains` query per place type (or, worse, calling
+PolyModel.contains_coordinate on every object). This module loads every
+polygon of a place type once, keeps a prepared GEOS geometry for each, and
+indexes their bounding boxes in a Sort-Tile-Recursive packed R-tree. After
+that, point and bounding box queries never touch the database.
+
+Usage:
+    from nationbrowse.places.spatial_index import get_place_index
+    index = get_place_index()
+    index.lookup(38.9425, -92.3264)
+    # {'state': 26, 'county': 1420, 'zipcode': 65201}
+
+Indexes are built lazily, one place type at a time, the first time a place
+type is queried. Call `warm()` to build everything up front (i.e. from a
+management command or at process startup).
+
+The STRtree itself is plain Python and works without GIS support; the
+PlaceIndex requires USE_GIS since it needs real geometries.
+"""
+from __future__ import division
+from django.conf import settings
+from math import ceil,sqrt
+from threading import Lock
+
+USE_GIS = getattr(settings,'USE_GIS',False)
+
+if USE_GIS:
+    from django.contrib.gis.geos import Point
+
+# Maximum number of children per R-tree node. 16 keeps the tree shallow
+# (three levels for ~33k ZCTAs) without making leaf scans expensive.
+NODE_CAPACITY = 16
+
+def bbox_intersects(a, b):
+    """ Whether two (xmin, ymin, xmax, ymax) boxes overlap (touching counts). """
+    return not (a[0] > b[2] or a[2] < b[0] or a[1] > b[3] or a[3] < b[1])
+
+def _union(entries):
+    """ The bounding box enclosing every (bbox, ...) tuple in entries. """
+    xmin, ymin, xmax, ymax = entries[0][0]
+    for entry in entries[1:]:
+        bbox = entry[0]
+        if bbox[0] < xmin: xmin = bbox[0]
+        if bbox[1] < ymin: ymin = bbox[1]
+        if bbox[2] > xmax: xmax = bbox[2]
+        if bbox[3] > ymax: ymax = bbox[3]
+    return (xmin, ymin, xmax, ymax)
+
+def _center_x(entry):
+    return entry[0][0] + entry[0][2]
+
+def _center_y(entry):
+    return entry[0][1] + entry[0][3]
+
+class STRtree(object):
+    """
+    A static (build once, query many) R-tree, bulk loaded with the
+    Sort-Tile-Recursive algorithm (Leutenegger et al., 1997).
+
+    `items` is an iterable of (bbox, payload) pairs, where bbox is a
+    (xmin, ymin, xmax, ymax) tuple. Queries return the payloads of every
+    item whose bbox intersects the query.
+
+    Internal nodes are (bbox, children, is_leaf) tuples; the children of a
+    leaf node are the original (bbox, payload) pairs.
+    """
+    def __init__(self, items, node_capacity=NODE_CAPACITY):
+        self.node_capacity = node_capacity
+        entries = [(tuple(bbox), payload) for bbox, payload in items]
+        self.size = len(entries)
+        self._root = self._build(entries)
+
+    def __len__(self):
+        return self.size
+
+    def _pack(self, entries, leaf):
+        """
+        Packs one level of the tree: sort by x into vertical slices of
+        S*capacity entries, sort each slice by y, and group runs of
+        `capacity` entries into a parent node.
+        """
+        cap = self.node_capacity
+        num_nodes = int(ceil(len(entries) / cap))
+        slice_size = int(ceil(sqrt(num_nodes))) * cap
+
+        entries.sort(key=_center_x)
+        parents = []
+        for i in xrange(0, len(entries), slice_size):
+            vslice = entries[i:i+slice_size]
+            vslice.sort(key=_center_y)
+            for j in xrange(0, len(vslice), cap):
+                children = vslice[j:j+cap]
+                parents.append((_union(children), children, leaf))
+        return parents
+
+    def _build(self, entries):
+        if not entries:
+            return None
+        level = self._pack(entries, True)
+        while len(level) > 1:
+            level = self._pack(level, False)
+        return level[0]
+
+    def query(self, bbox):
+        """ Returns the payloads of every item whose bbox intersects `bbox`. """
+        results = []
+        if self._root is None:
+            return results
+
+        xmin, ymin, xmax, ymax = bbox
+        stack = [self._root]
+        while stack:
+            nbox, children, leaf = stack.pop()
+            if nbox[0] > xmax or nbox[2] < xmin or nbox[1] > ymax or nbox[3] < ymin:
+                continue
+            if leaf:
+                for cbox, payload in children:
+                    if not (cbox[0] > xmax or cbox[2] < xmin or cbox[1] > ymax or cbox[3] < ymin):
+                        results.append(payload)
+            else:
+                stack.extend(children)
+        return results
+
+    def query_point(self, x, y):
+        """ Returns the payloads of every item whose bbox contains (x, y). """
+        return self.query((x, y, x, y))
+
+# --------------------------------------------------------------
+
+def prepare(geom):
+    """
+    Returns a PreparedGeometry for geom. GEOS prepared geometries point into
+    their base geometry without owning it, so keep the base geometry alive
+    for as long as the prepared one is.
+    """
+    prepared = geom.prepared
+    prepared.base_geom = geom
+    return prepared
+
+class PlaceIndex(object):
+    """
+    One STRtree per place type, whose payloads are (pk, prepared geometry)
+    pairs. All public methods take and return plain primary keys so that
+    callers decide if (and when) to hit the database.
+
+    Place types are the lowercase model names: 'state', 'county', 'zipcode'.
+    """
+    def __init__(self):
+        self._trees = {}
+        self._lock = Lock()
+
+    def _place_class(self, place_type):
+        from nationbrowse.places.models import State,County,ZipCode
+        return {
+            'state':State,
+            'county':County,
+            'zipcode':ZipCode,
+        }[place_type]
+
+    def _build_tree(self, place_type):
+        """
+        Pulls (pk, poly) for every object of this place type in a single query.
+        values_list() skips the caching iterator, so this does not flood memcached.
+        """
+        PlaceClass = self._place_class(place_type)
+        items = []
+        qs = PlaceClass.pobjects.exclude(poly=None).order_by().values_list('pk','poly')
+        for pk, poly in qs.iterator():
+            if poly.empty:
+                continue
+            items.append((poly.extent, (pk, prepare(poly))))
+        return STRtree(items)
+
+    def tree(self, place_type):
+        """ Returns the STRtree for this place type, building it if needed. """
+        tree = self._trees.get(place_type)
+        if tree is None:
+            self._lock.acquire()
+            try:
+                # Another thread may have finished building it while we waited.
+                tree = self._trees.get(place_type)
+                if tree is None:
+                    tree = self._build_tree(place_type)
+                    self._trees[place_type] = tree
+            finally:
+                self._lock.release()
+        return tree
+
+    def warm(self, place_types=('state','county','zipcode')):
+        """ Builds the trees for the given place types right now. """
+        for place_type in place_types:
+            self.tree(place_type)
+
+    def reset(self):
+        """ Drops all trees (they will be rebuilt on next use). """
+        self._lock.acquire()
+        try:
+            self._trees = {}
+        finally:
+            self._lock.release()
+
+    def containing(self, place_type, lat, lon):
+        """
+        Returns the list of pks of `place_type` objects whose polygon contains
+        the given point. (Usually one; more on shared borders or overlaps.)
+        """
+        candidates = self.tree(place_type).query_point(lon, lat)
+        if not candidates:
+            return []
+        point = Point(lon, lat)
+        return [pk for pk, prepared in candidates if prepared.covers(point)]
+
+    def first_containing(self, place_type, lat, lon):
+        """ Returns the pk of a containing place, or None. """
+        matches = self.containing(place_type, lat, lon)
+        if matches:
+            return matches[0]
+        return None
+
+    def lookup(self, lat, lon, place_types=('state','county','zipcode')):
+        """
+        Returns a dict mapping each place type to the pk of the place containing
+        the point (or None if the point isn't inside any of them).
+        """
+        result = {}
+        for place_type in place_types:
+            result[place_type] = self.first_containing(place_type, lat, lon)
+        return result
+
+    def candidates(self, place_type, bbox):
+        """
+        Returns (pk, prepared geometry) pairs for every `place_type` object
+        whose bounding box intersects the given (xmin, ymin, xmax, ymax) bbox.
+        """
+        return self.tree(place_type).query(bbox)
+
+    def intersecting_bbox(self, place_type, bbox, exact=False):
+        """
+        Returns pks of `place_type` objects whose bounding box intersects the
+        given (xmin, ymin, xmax, ymax) bbox. With exact=True, also verifies that
+        the polygon itself intersects the bbox.
+        """
+        candidates = self.candidates(place_type, bbox)
+        if not exact:
+            return [pk for pk, prepared in candidates]
+
+        from django.contrib.gis.geos import Polygon
+        box = Polygon.from_bbox(bbox)
+        return [pk for pk, prepared in candidates if prepared.intersects(box)]
+
+_place_index = None
+_place_index_lock = Lock()
+
+def get_place_index():
+    """
+    Returns the process-wide PlaceIndex, or None if this server is not
+    GIS-aware (same convention as PolyModel.contains_coordinate).
+    """
+    global _place_index
+    if not USE_GIS:
+        return None
+    if _place_index is None:
+        _place_index_lock.acquire()
+        try:
+            if _place_index is None:
+                _place_index = PlaceIndex()
+        finally:
+            _place_index_lock.release()
+    return _place_index
@@ -4,6 +4,42 @@ Unit tests for Places.
 """
 
 from django.test import TestCase
+from nationbrowse.places.spatial_index import STRtree
+from nationbrowse.places.simplify import truncate_wkt,field_for_zoom
+from nationbrowse.places.nearby import CentroidIndex
+from nationbrowse.places.encoding import parse_wkt_polygons,encode_ring,encode_polygons,decode_ring
+from nationbrowse.places import geohash
+from nationbrowse.places.registry import get_registry,normalize_name
+from nationbrowse.places.geocode import place_info
+from nationbrowse.places.search import SearchIndex
+from nationbrowse.places import random_pool
+from geopy.geohash import Geohash
+from nationbrowse.places.topology import snap_polygons,build_topology,simplify_arc,arc_values
+from nationbrowse.places import topology as topology_module
+from nationbrowse.places import nearby as nearby_module
+from nationbrowse.places import registry as registry_module
+from nationbrowse.places.management.commands.build_topology import save_topology
+from nationbrowse.places.models import PolyModel,State,County,ZipCode,ZipCodeCounty
+from nationbrowse.places.management.commands.simplify_places import invalidate_place
+from nationbrowse.places.management.commands.build_zipcode_crosswalk import replace_crosswalk
+from nationbrowse.places.management.commands import measure_places
+from django.core.cache import get_cache
+import cacheutil
+from nationbrowse.places.views import _batch_points
+from nationbrowse.demographics.export import csv_chunks
+from django.http import HttpRequest
+
+import csv
+import json
+import gzip
+import numpy
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+from datetime import date
+from django.contrib.contenttypes.models import ContentType
+from nationbrowse.demographics.models import DataSource,PlacePopulation
 
 # Make HTTP requests inside tests never time out.
 import socket
@@ -16,6 +52,468 @@ class PlacesTest(TestCase):
         """
         self.assert_(True)
 
+class STRtreeTest(TestCase):
+    def setUp(self):
+        # 40x40 grid of unit squares, payload = (col, row)
+        self.items = [((x, y, x+1, y+1), (x, y)) for x in range(40) for y in range(40)]
+        self.tree = STRtree(self.items)
+
+    def brute_force(self, bbox):
+        return sorted([p for b, p in self.items if not (
+            b[0] > bbox[2] or b[2] < bbox[0] or b[1] > bbox[3] or b[3] < bbox[1]
+        )])
+
+    def test_point_query(self):
+        self.assertEqual(sorted(self.tree.query_point(10.5, 20.5)), [(10, 20)])
+        # Shared corner touches four squares.
+        self.assertEqual(sorted(self.tree.query_point(5, 5)), [(4, 4), (4, 5), (5, 4), (5, 5)])
+        self.assertEqual(self.tree.query_point(-3, 100), [])
+
+    def test_bbox_query_matches_brute_force(self):
+        for bbox in [(0.5, 0.5, 3.5, 2.5), (12.2, 30.1, 19.9, 39.9), (-10, -10, 100, 100)]:
+            self.assertEqual(sorted(self.tree.query(bbox)), self.brute_force(bbox))
+
+    def test_empty(self):
+        tree = STRtree([])
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.query((0, 0, 1, 1)), [])
+
+class SimplifyTest(TestCase):
+    def test_truncate_wkt(self):
+        self.assertEqual(
+            truncate_wkt("POLYGON ((-92.3264408111 38.9425713189, -92.1 38.5, -92.3264408111 38.9425713189))", 4),
+            "POLYGON ((-92.3264 38.9425, -92.1 38.5, -92.3264 38.9425))"
+        )
+
+    def test_field_for_zoom(self):
+        self.assertEqual(field_for_zoom(3), 'wkt_low')
+        self.assertEqual(field_for_zoom('7'), 'wkt_medium')
+        self.assertEqual(field_for_zoom(12), 'wkt_high')
+        self.assertEqual(field_for_zoom(None), 'wkt_low')
+
+    def test_resimplify(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=mo,
+            wkt_medium="POLYGON ((0 0, 1 0, 1 1, 0 0))")
+        deferred = County.objects.defer(*PolyModel.deferred_fields)
+        # simple_wkt is only ever stale with a real cache.
+        old_cache = cacheutil.cache
+        cacheutil.cache = get_cache('locmem://')
+        try:
+            self.assertEqual(deferred.get(pk=boone.pk).simple_wkt, "POLYGON ((0 0, 1 0, 1 1, 0 0))")
+            # What simplify_places stores for a place.
+            County.objects.filter(pk=boone.pk).update(wkt_medium="POLYGON ((0 0, 2 0, 2 2, 0 0))")
+            invalidate_place(County, boone.pk)
+            self.assertEqual(deferred.get(pk=boone.pk).simple_wkt, "POLYGON ((0 0, 2 0, 2 2, 0 0))")
+        finally:
+            cacheutil.cache = old_cache
+
+class MeasureTest(TestCase):
+    def test_save_densities(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.",area_sq_mi=100)
+        source = DataSource.objects.create(source="Census",date=date(2000,1,1))
+        PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(State), place_id=mo.pk,
+            source=source, total=5000, avg_household_size=0, avg_family_size=0)
+        old_cache = measure_places.cache
+        measure_places.cache = get_cache('locmem://')
+        try:
+            # Both of the caching manager's copies are dropped.
+            keys = (State._cache_key(mo.pk), State._cache_key(mo.slug, 'slug'))
+            for key in keys:
+                measure_places.cache.set(key, mo)
+            self.assertEqual(measure_places.save_densities(State), 1)
+            self.assertEqual([measure_places.cache.get(key) for key in keys], [None, None])
+        finally:
+            measure_places.cache = old_cache
+        self.assertEqual(State.objects.get(pk=mo.pk).pop_density, 50)
+
+class EncodingTest(TestCase):
+    def test_google_example(self):
+        # From Google's "Encoded Polyline Algorithm Format" documentation.
+        points = [(-120.2, 38.5), (-120.95, 40.7), (-126.453, 43.252)]
+        self.assertEqual(encode_ring(points, 5), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(decode_ring("_p~iF~ps|U_ulLnnqC_mqNvxq`@", 5), points)
+
+    def test_parse_and_quantize(self):
+        wkt = "MULTIPOLYGON (((-92.31 38.91, -92.1 38.5, -91.9 38.9, -92.31 38.91)), ((1 1, 1.001 1.001, 1.002 1, 1 1)))"
+        polygons = parse_wkt_polygons(wkt)
+        self.assertEqual(len(polygons), 2)
+        self.assertEqual(polygons[0][0][0], (-92.31, 38.91))
+        self.assertEqual(parse_wkt_polygons("POLYGON EMPTY"), [])
+        # The second polygon collapses to a single point at 2 decimal places.
+        encoded = encode_polygons(polygons, 2)
+        self.assertEqual(len(encoded), 1)
+        self.assertEqual(decode_ring(encoded[0][0], 2), [(-92.31, 38.91), (-92.1, 38.5), (-91.9, 38.9)])
+
+    def test_geometry_view(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.",
+            wkt_low="POLYGON ((-95.774 40.578, -89.099 36.5, -95.774 36.5, -95.774 40.578))")
+        response = self.client.get('/places/geometry/state/%d/3/' % mo.pk)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['precision'], 3)
+        self.assertEqual(decode_ring(data['polygons'][0][0], 3), [(-95.774, 40.578), (-89.099, 36.5), (-95.774, 36.5)])
+        # No high-detail geometry yet (and no GIS to compute it).
+        self.assertEqual(self.client.get('/places/geometry/state/%d/12/' % mo.pk).status_code, 404)
+
+class CrosswalkTest(TestCase):
+    def setUp(self):
+        self.mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        self.boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=self.mo)
+        self.callaway = County.objects.create(name="Callaway",slug="callaway-mo",long_name="Callaway County",state=self.mo)
+        self.z65201 = ZipCode.objects.create(id=65201,name="65201",slug="65201",state=self.mo,county=self.boone)
+        self.z65203 = ZipCode.objects.create(id=65203,name="65203",slug="65203",state=self.mo,county=self.boone)
+        ZipCodeCounty.objects.create(zipcode=self.z65201,county=self.callaway,overlap_area=10,zipcode_fraction=.1,county_fraction=.01)
+        ZipCodeCounty.objects.create(zipcode=self.z65201,county=self.boone,overlap_area=90,zipcode_fraction=.9,county_fraction=.13)
+        ZipCodeCounty.objects.create(zipcode=self.z65203,county=self.boone,overlap_area=80,zipcode_fraction=1,county_fraction=.11)
+
+    def test_zipcode_counties(self):
+        self.assertEqual([c.pk for c in self.z65201.counties()], [self.boone.pk, self.callaway.pk])
+        self.assertEqual([s.pk for s in self.z65201.states()], [self.mo.pk])
+
+    def test_stored_measurements(self):
+        self.boone.center_lat, self.boone.center_lon = 38.99, -92.31
+        self.boone.area_sq_mi = 691.5
+        self.assertEqual((self.boone.latitude, self.boone.longitude), (38.99, -92.31))
+        self.assertAlmostEqual(self.boone.area.sq_mi, 691.5)
+        self.assertEqual(self.boone.bbox, None)
+
+    def test_county_zipcodes(self):
+        self.assertEqual([z.pk for z in self.boone.zipcodes()], [65201, 65203])
+        self.assertEqual([z.pk for z in self.callaway.zipcodes()], [65201])
+
+    def test_replace_crosswalk(self):
+        old_cache = cacheutil.cache
+        cacheutil.cache = get_cache('locmem://')
+        try:
+            self.assertEqual([z.pk for z in self.callaway.zipcodes()], [65201])
+            self.assertEqual([c.pk for c in self.z65201.counties()], [self.boone.pk, self.callaway.pk])
+            # 65201 no longer overlaps Callaway County.
+            replace_crosswalk([(65201, self.boone.pk, 100, 1, .14), (65203, self.boone.pk, 80, 1, .11)])
+            self.assertEqual([z.pk for z in self.callaway.zipcodes()], [])
+            self.assertEqual([c.pk for c in self.z65201.counties()], [self.boone.pk])
+            self.assertEqual([z.pk for z in self.boone.zipcodes()], [65201, 65203])
+        finally:
+            cacheutil.cache = old_cache
+
+class ReverseGeocodeTest(TestCase):
+    def test_invalid_coordinates(self):
+        response = self.client.get('/places/reverse_geocode/', {'lat':'north', 'lon':'-92.3'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/places/reverse_geocode/', {'lat':'95', 'lon':'-92.3'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_requires_post(self):
+        response = self.client.get('/places/reverse_geocode/batch/')
+        self.assertEqual(response.status_code, 405)
+
+    def test_batch_points(self):
+        def points(body, content_type='text/csv'):
+            request = HttpRequest()
+            request.raw_post_data = body
+            request.META['CONTENT_TYPE'] = content_type
+            return _batch_points(request)
+
+        self.assertEqual(points("lat,lon\n38.9,-92.3\nnorth,-92.3\n"), [(0, '38.9', '-92.3'), (1, 'north', '-92.3')])
+        self.assertEqual(points("a,38.9,-92.3\n"), [('a', '38.9', '-92.3')])
+        self.assertEqual(points('[[38.9, -92.3], {"id": "b", "lat": 39, "lon": -92}]', 'application/json'),
+            [(0, 38.9, -92.3), ('b', 39, -92)])
+        for body in ('[[38.9, -92.3', '{"lat": 39}', '[1, 2]', '[[38.9]]'):
+            self.assertRaises(ValueError, points, body, 'application/json')
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        self.ks = State.objects.create(name="Kansas",slug="ks",abbr="KS",ap_style="Kan.")
+        self.boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=self.mo,
+            wkt_low="POLYGON ((-92.5 39.2, -92.1 39.2, -92.1 38.7, -92.5 39.2))")
+        County.objects.create(name="Cole",slug="cole-mo",long_name="Cole County",state=self.mo)
+        County.objects.create(name="Douglas",slug="douglas-ks",long_name="Douglas County",state=self.ks)
+        source = DataSource.objects.create(source="Census",date=date(2000,1,1))
+        PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(County),
+            place_id=self.boone.pk,source=source,total=135454,avg_household_size="2.38",avg_family_size="2.91")
+
+    def test_export(self):
+        response = self.client.get('/places/export/county.geojson', {'state':'mo'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(len(data['features']), 2)
+        boone = data['features'][0]
+        self.assertEqual(boone['id'], self.boone.pk)
+        self.assertEqual(boone['properties']['total'], 135454)
+        self.assertAlmostEqual(boone['properties']['avg_family_size'], 2.91)
+        self.assertEqual(boone['geometry']['coordinates'][0][0][0], [-92.5, 39.2])
+        # No demographics or geometry for Cole County.
+        self.assertEqual(data['features'][1]['geometry'], None)
+        self.assertEqual(data['features'][1]['properties']['total'], None)
+
+    def test_export_without_sources(self):
+        # Only roll-up rows: those are exported (once per place).
+        census = DataSource.objects.get(source="Census")
+        DataSource.objects.filter(pk=census.pk).update(derived_from=DataSource.objects.create(source="Other",date=date(1990,1,1)))
+        response = self.client.get('/places/export/county.geojson')
+        features = json.loads(response.content)['features']
+        self.assertEqual([f['properties']['total'] for f in features], [135454, None, None])
+
+        # No population data, so no demographics (rather than every source's).
+        PlacePopulation.objects.all().delete()
+        response = self.client.get('/places/export/county.geojson')
+        features = json.loads(response.content)['features']
+        self.assertEqual([f['properties']['total'] for f in features], [None, None, None])
+
+    def test_export_newer_source(self):
+        # A newer source without population data (i.e. the crime data's).
+        DataSource.objects.create(source="FBI Uniform Crime Reporting Program",date=date(2008,1,1))
+        response = self.client.get('/places/export/county.geojson', {'state':'mo'})
+        features = json.loads(response.content)['features']
+        self.assertEqual([f['properties']['total'] for f in features], [135454, None])
+        rows = list(csv.reader(StringIO(''.join(csv_chunks('county')))))
+        self.assertEqual([(int(row[0]), int(row[rows[0].index('total')])) for row in rows[1:]], [(self.boone.pk, 135454)])
+
+    def test_gzip_export(self):
+        response = self.client.get('/places/export/county.geojson', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.GzipFile(fileobj=StringIO(response.content)).read())
+        self.assertEqual(len(data['features']), 3)
+
+class NearbyTest(TestCase):
+    def setUp(self):
+        # Columbia, Jefferson City, St. Louis, Kansas City, Chicago
+        self.index = CentroidIndex(
+            [1, 2, 3, 4, 5],
+            [38.9517, 38.5767, 38.6270, 39.0997, 41.8781],
+            [-92.3341, -92.1735, -90.1994, -94.5786, -87.6298]
+        )
+
+    def test_nearest(self):
+        self.assertEqual([pk for pk, miles in self.index.nearest(38.95, -92.33, k=3)], [1, 2, 3])
+        self.assertEqual([pk for pk, miles in self.index.nearest_to_place(1, k=2)], [2, 3])
+
+    def test_empty(self):
+        index = CentroidIndex([], [], [])
+        self.assertEqual(index.nearest(38.95, -92.33), [])
+        self.assertEqual(index.within(38.95, -92.33, 100), [])
+        self.assertEqual(index.nearest_to_place(1), [])
+        self.assertEqual(self.index.nearest(38.95, -92.33, k=-1), [])
+
+    def test_within(self):
+        results = self.index.within(38.9517, -92.3341, 130)
+        self.assertEqual([pk for pk, miles in results], [1, 2, 3, 4])
+        # Columbia to St. Louis is about 115 miles.
+        self.assert_(110 < results[2][1] < 120)
+
+    def test_data_version(self):
+        State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.",center_lat=38.5767,center_lon=-92.1735)
+        old_use_gis, old_data_version = nearby_module.USE_GIS, registry_module.data_version
+        nearby_module.USE_GIS = True
+        registry_module.data_version = lambda: "1"
+        registry_module._version['checked'] = 0
+        nearby_module.reset()
+        try:
+            index = nearby_module.get_centroid_index('state')
+            self.assertEqual(len(index), 1)
+            # What measure_places does: update() the centers, then bump the version.
+            State.objects.create(name="Kansas",slug="ks",abbr="KS",ap_style="Kan.")
+            State.objects.filter(slug="ks").update(center_lat=38.5, center_lon=-98.0)
+            self.assert_(nearby_module.get_centroid_index('state') is index)
+            registry_module.data_version = lambda: "2"
+            registry_module._version['checked'] = 0
+            self.assertEqual(len(nearby_module.get_centroid_index('state')), 2)
+        finally:
+            nearby_module.USE_GIS, registry_module.data_version = old_use_gis, old_data_version
+            registry_module._version['checked'] = 0
+            nearby_module.reset()
+
+class GeohashTest(TestCase):
+    def test_encode(self):
+        lats, lons = [38.9517, -33.8688, 89.9, 0], [-92.3341, 151.2093, -179.9, 0]
+        for precision in (1, 6, 9, 12):
+            geopy = Geohash(precision=precision)
+            expected = [geopy.encode(lat, lon) for lat, lon in zip(lats, lons)]
+            self.assertEqual(geohash.encode(lats, lons, precision).tolist(), expected)
+        self.assertRaises(ValueError, geohash.encode, [91], [0], 5)
+
+    def test_decode(self):
+        lats, lons = geohash.decode(geohash.encode([38.9517], [-92.3341], 9))
+        self.assert_(abs(lats[0] - 38.9517) < .0001 and abs(lons[0] + 92.3341) < .0001)
+        self.assertEqual([b.tolist() for b in geohash.bbox(['9yz'])], [[37.96875], [-91.40625], [39.375], [-90.0]])
+        self.assertRaises(ValueError, geohash.decode, ['9yz', 'a'])
+
+    def test_neighbors(self):
+        self.assertEqual(geohash.neighbors(['9yz'])[0].tolist(), ['9zp','dp0','dnb','dn8','9yx','9yw','9yy','9zn'])
+        # Wraps around the antimeridian, but not the poles.
+        self.assertEqual(geohash.neighbors(['zzz'])[0].tolist(), ['','','bpb','bp8','zzx','zzw','zzy',''])
+
+    def test_cover(self):
+        codes = geohash.cover(38.9, -92.4, 39.0, -92.2, 5)
+        self.assertEqual(len(codes), 15)
+        self.assert_(geohash.encode([38.95], [-92.3], 5)[0] in codes)
+        self.assertEqual(geohash.cover(0, 179.9, .1, -179.9, 4).tolist(), ['xbpb', '8000'])
+
+class RegistryTest(TestCase):
+    def setUp(self):
+        self.mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.",fips_code=29)
+        self.stl = County.objects.create(name="St. Louis",slug="st-louis-mo",long_name="St. Louis County",state=self.mo,fips_code=189)
+
+    def test_resolve(self):
+        self.assertEqual(normalize_name(u" St.  Louis "), u"st louis")
+        states, counties = get_registry('state'), get_registry('county')
+        self.assertEqual(states.pk_for_name("MISSOURI"), self.mo.pk)
+        self.assertEqual(states.pk_for_fips("29"), self.mo.pk)
+        self.assertEqual(counties.pk_for_name("st louis", "mo"), self.stl.pk)
+        self.assertEqual(counties.pk_for_name("St. Louis County", "MO"), self.stl.pk)
+        self.assertEqual(counties.pk_for_name("St. Louis", "KS"), None)
+        self.assertEqual(counties.pk_for_fips(189, 29), self.stl.pk)
+        self.assertEqual(counties.info(self.stl.pk)['state'], "MO")
+
+    def test_refresh_on_save(self):
+        self.assertEqual(get_registry('county').pk_for_slug("boone-mo"), None)
+        boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=self.mo)
+        self.assertEqual(get_registry('county').pk_for_slug("Boone-MO"), boone.pk)
+
+    def test_place_info(self):
+        boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=self.mo)
+        self.assertEqual(place_info('county', boone.pk), {'id':boone.pk, 'name':u"Boone County, Missouri", 'url':'/places/county/mo/boone/'})
+        self.assertEqual(place_info('county', 99999), None)
+        # Changes show up in place_info (and so in search, geocoding, etc.).
+        self.mo.name = "Misery"
+        self.mo.save()
+        self.assertEqual(place_info('county', boone.pk)['name'], u"Boone County, Misery")
+
+    def test_county_detail(self):
+        self.assertEqual(self.client.get('/places/county/MO/st louis/').status_code, 200)
+        self.assertEqual(self.client.get('/places/county/mo/boone/').status_code, 404)
+
+class SearchTest(TestCase):
+    def test_index(self):
+        index = SearchIndex([
+            ('state', 1, 5988927, [u"missouri", u"mo"], [u"missouri"]),
+            ('county', 2, 162642, [u"boone", u"boone county"], [u"boone"]),
+            ('county', 3, 1000, [u"boone", u"boone county"], [u"boone"]),
+            ('county', 4, 998954, [u"st louis", u"st louis county"], [u"st louis"]),
+            ('zipcode', 5, 30000, [u"65201"], []),
+        ])
+        # Exact matches, then by population.
+        self.assertEqual(index.search("Boone"), [('county', 2), ('county', 3)])
+        self.assertEqual(index.search("mo"), [('state', 1)])
+        self.assertEqual(index.search("louis"), [('county', 4)])
+        self.assertEqual(index.search("652"), [('zipcode', 5)])
+        # Typos.
+        self.assertEqual(index.search("misouri"), [('state', 1)])
+        self.assertEqual(index.search("boone", place_type='state'), [])
+        self.assertEqual(index.search("boone", limit=1), [('county', 2)])
+
+    def test_search_view(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=mo)
+        response = self.client.get('/places/search/', {'q':'boone co'})
+        self.assertEqual(response.status_code, 200)
+        self.assert_('max-age' in response['Cache-Control'])
+        results = json.loads(response.content)['results']
+        self.assertEqual([(r['type'], r['id']) for r in results], [('county', boone.pk)])
+        self.assertEqual(self.client.get('/places/search/').status_code, 400)
+        self.assertEqual(self.client.get('/places/search/', {'q':'mo', 'type':'city'}).status_code, 400)
+
+class RandomPlaceTest(TestCase):
+    def test_pool(self):
+        random_pool.reset()
+        self.assertEqual(self.client.get('/places/').status_code, 404)
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        county = County.objects.create(name="St. Louis",slug="st-louis-mo",long_name="St. Louis County",state=mo)
+        for i in range(2):
+            ZipCode.objects.create(name="6520%d" % i,slug="6520%d" % i,state=mo)
+
+        # Distinct places, as long as the pool has them.
+        urls = [self.client.get('/places/')['Location'] for i in range(4)]
+        self.assertEqual(len(set(urls)), 4)
+        # Places' own URLs, so their cached pages are the ones pre-rendered.
+        self.assertEqual(county.get_absolute_url(), '/places/county/mo/st%20louis/')
+        self.assert_('http://testserver%s' % county.get_absolute_url() in urls)
+        self.assertEqual(self.client.get(county.get_absolute_url()).status_code, 200)
+        # What the background refill does with a cache.
+        random_pool.prerender(county.get_absolute_url())
+
+class TopologyTest(TestCase):
+    # Two counties sharing an edge, and a city enclosed by the second one.
+    WKT = (
+        "POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))",
+        "POLYGON ((1 0, 2 0, 2 1, 1 1, 1 0), (1.2 0.2, 1.2 0.8, 1.8 0.8, 1.8 0.2, 1.2 0.2))",
+        "POLYGON ((1.2 0.2, 1.8 0.2, 1.8 0.8, 1.2 0.8, 1.2 0.2))",
+    )
+
+    def build(self):
+        return build_topology([(pk, snap_polygons(parse_wkt_polygons(wkt))) for pk, wkt in enumerate(self.WKT)])
+
+    def test_shared_arcs(self):
+        arcs, place_arcs = self.build()
+        # The shared edge, the rest of each square, and the enclave's border.
+        self.assertEqual(len(arcs), 4)
+        shared = [a for a in place_arcs[0][0][0] if (a if a >= 0 else ~a) in [b if b >= 0 else ~b for b in place_arcs[1][0][0]]]
+        self.assertEqual(len(shared), 1)
+        self.assertEqual(place_arcs[1][0][1], [~place_arcs[2][0][0][0]])
+
+    def test_simplify_arc(self):
+        points = numpy.array([[0, 0], [1, .001], [2, 0], [3, 5], [7, 9]])
+        self.assertEqual(simplify_arc(points, .1).tolist(), [[0, 0], [2, 0], [3, 5], [7, 9]])
+        # Tiny rings keep enough vertices not to collapse.
+        ring = numpy.array([[0, 0], [.001, 0], [.001, .001], [0, .0011], [0, 0]])
+        self.assertEqual(len(simplify_arc(ring, 1)), 4)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_dir = topology_module.TOPOLOGY_DIR
+        topology_module.TOPOLOGY_DIR = self.root
+        # Background writes are run by the test (a thread wouldn't see the test database).
+        self.background = []
+        self.old_call_in_bg = topology_module.call_in_bg
+        topology_module.call_in_bg = lambda function, args=[], kwargs={}: self.background.append((function, args))
+
+    def tearDown(self):
+        topology_module.TOPOLOGY_DIR = self.old_dir
+        topology_module.call_in_bg = self.old_call_in_bg
+        shutil.rmtree(self.root)
+
+    def test_topology_view(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        pks = [County.objects.create(name="C%d" % i,slug="c%d" % i,long_name="C%d" % i,state=mo).pk for i in range(3)]
+        arcs, place_arcs = self.build()
+        save_topology(County, [arc_values(arc) for arc in arcs], dict([(pks[i], a) for i, a in place_arcs.items()]))
+
+        # Until the state's file is written (in the background), the national one stands in, briefly cached.
+        response = self.client.get('/places/topology/county/9.json', {'state':'mo'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'county')), ['arc_high-all.json.gz'])
+        self.assertEqual(len(self.background), 1)
+        self.client.get('/places/topology/county/9.json', {'state':'mo'})
+        self.assertEqual(len(self.background), 1)
+        for function, args in self.background:
+            function(*args)
+
+        response = self.client.get('/places/topology/county/9.json', {'state':'mo'})
+        self.assertEqual(response['Cache-Control'], 'public, max-age=604800')
+        topology = json.loads(response.content)
+        self.assertEqual(topology['type'], 'Topology')
+        self.assertEqual(len(topology['arcs']), 4)
+        self.assertEqual([g['id'] for g in topology['objects']['county']['geometries']], pks)
+        # Arcs are delta-encoded on the band's grid, and end at junctions.
+        scale = topology['transform']['scale'][0]
+        points = numpy.cumsum(topology['arcs'][0], axis=0) * scale
+        self.assertEqual(sorted([points[0].round(6).tolist(), points[-1].round(6).tolist()]), [[1, 0], [1, 1]])
+        self.assertEqual(self.client.get('/places/topology/county/9.json', {'state':'zz'}).status_code, 404)
+
+        # Served from a file per (place type, band, state), until the topology is rebuilt.
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'county'))), ['arc_high-%d.json.gz' % mo.pk, 'arc_high-all.json.gz'])
+        response = self.client.get('/places/topology/county/9.json', {'state':'mo'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(json.loads(gzip.GzipFile(fileobj=StringIO(response.content)).read()), topology)
+        topology_module.invalidate_topology('county')
+        self.assertEqual(os.path.exists(os.path.join(self.root, 'county')), False)
+
+        # build_topology writes every file: national and per state, for each band.
+        files = topology_module.topology_files('county')
+        self.assertEqual(len(files), len(topology_module.band_zooms()) * 2)
+        self.assertEqual(set([state for place_type, zoom, state in files]), set([None, mo.pk]))
+
 """
 from nationbrowse.places.models import ZipCode,County
 from django.contrib.gis.geos import fromstr
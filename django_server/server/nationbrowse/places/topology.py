@@ -0,0 +1,426 @@
+# coding=utf-8
+"""
+Shared-border ("topological") geometry, in the style of TopoJSON.
+
+simplify.py simplifies every polygon on its own, so two neighboring counties
+simplify their common border differently (leaving gaps and overlaps on the
+map), and every shared border is stored, simplified and sent twice. Here the
+polygons of a place type are broken into *arcs* instead:
+
+ * coordinates are quantized to SNAP_PRECISION decimal places, so vertices
+   shared by neighbors compare equal;
+ * a vertex is a *junction* where the rings passing through it part ways,
+   i.e. it has different neighboring vertices in different rings;
+ * every ring is cut at its junctions, and identical arcs (in either
+   direction) are kept once. A ring without junctions (an island, or a
+   place enclosed by a single other place) is one closed arc.
+
+Each place stores its geometry as arc indexes in `PolyModel.arcs`, and each
+arc is simplified once per zoom band (see SIMPLIFIED_LEVELS) with its
+endpoints fixed, so neighbors' borders stay identical at every zoom level.
+TopologyArc stores every band's arcs as delta-encoded integers on the band's
+grid, ready to be concatenated into a TopoJSON "Topology":
+
+    {"type":"Topology",
+     "transform":{"scale":[0.001,0.001],"translate":[0,0]},
+     "objects":{"county":{"type":"GeometryCollection","geometries":[
+        {"type":"MultiPolygon","id":1,"properties":{"name":"Boone"},"arcs":[[[0,~1]]]}, ...]}},
+     "arcs":[[[-92345,38917],[12,-3],...], ...]}
+
+As in TopoJSON, arc index ~i (-i-1) means arc i reversed.
+
+The topology is built by the `build_topology` management command, and
+served by the places:topology view. A whole place type's Topology is many
+MB (far over memcached's item limit), so payloads are kept gzip'd on disk
+under TOPOLOGY_DIR, one file per (place type, zoom band, state or all of
+them), all written by the command. One that's missing anyway (say, for a
+State added since) is written in the background, and the national file
+is served in its place meanwhile.
+"""
+from __future__ import division
+from django.conf import settings
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+from streamutil import gzip_string
+from threadutil import call_in_bg
+from threading import Lock
+import numpy
+import json
+import os
+import shutil
+import tempfile
+
+from nationbrowse.places.simplify import SIMPLIFIED_LEVELS,ZOOM_BANDS,field_for_zoom,precision_for_zoom
+
+TOPOLOGY_DIR = getattr(settings,"PLACES_TOPOLOGY_DIR",
+    os.path.join(settings.DJANGO_SERVER_DIR, 'server', 'nationbrowse', 'places', 'topology_cache'))
+
+# Decimal places that vertices are snapped to before matching them up
+# (about 10cm; TIGER/Line coordinates have 6).
+SNAP_PRECISION = 6
+
+# Points are matched as single int64 keys: x and y on the snapped grid,
+# offset to be non-negative, in 30 bits each.
+_KEY_OFFSET = 1 << 29
+_KEY_SHIFT = 30
+
+# TopologyArc column for each simplified band column.
+ARC_FIELDS = dict([(field, field.replace('wkt_', 'arc_')) for field, tolerance, precision in SIMPLIFIED_LEVELS])
+
+# Size of the `pk__in` lists used to look up places and arcs.
+QUERY_BLOCK_SIZE = 500
+
+def arc_field_for_zoom(zoom):
+    """ Returns the TopologyArc column holding the arcs for a map zoom level. """
+    return ARC_FIELDS[field_for_zoom(zoom)]
+
+# ----- Building -----
+
+def snap_ring(ring, precision=SNAP_PRECISION):
+    """
+    Quantizes a ring of (x, y) floats to an open (n, 2) int64 array on the
+    10^-precision grid, without repeated (or closing) vertices. Returns None
+    for rings that collapse to fewer than three vertices.
+    """
+    points = numpy.round(numpy.asarray(ring, dtype=float) * 10 ** precision).astype(numpy.int64)
+    if len(points) < 3:
+        return None
+    keep = numpy.ones(len(points), dtype=bool)
+    keep[1:] = (numpy.diff(points, axis=0) != 0).any(axis=1)
+    points = points[keep]
+    if len(points) > 1 and (points[0] == points[-1]).all():
+        points = points[:-1]
+    if len(points) < 3:
+        return None
+    return points
+
+def point_keys(points):
+    """ One int64 key per vertex of an (n, 2) snapped array. """
+    return ((points[:, 0] + _KEY_OFFSET) << _KEY_SHIFT) | (points[:, 1] + _KEY_OFFSET)
+
+def find_junctions(rings):
+    """
+    Returns the sorted keys of the junction vertices of a list of snapped
+    rings: those whose (unordered) pair of neighbors isn't the same in every
+    ring that passes through them.
+    """
+    if not rings:
+        return numpy.zeros(0, dtype=numpy.int64)
+    keys, before, after = [], [], []
+    for ring in rings:
+        k = point_keys(ring)
+        keys.append(k)
+        before.append(numpy.roll(k, 1))
+        after.append(numpy.roll(k, -1))
+    keys, before, after = numpy.concatenate(keys), numpy.concatenate(before), numpy.concatenate(after)
+    low, high = numpy.minimum(before, after), numpy.maximum(before, after)
+
+    order = numpy.lexsort((high, low, keys))
+    keys, low, high = keys[order], low[order], high[order]
+    new_key = numpy.ones(len(keys), dtype=bool)
+    new_key[1:] = keys[1:] != keys[:-1]
+    new_pair = new_key.copy()
+    new_pair[1:] |= (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+    starts = numpy.nonzero(new_key)[0]
+    pairs = numpy.add.reduceat(new_pair.astype(numpy.int64), starts)
+    return keys[starts[pairs > 1]]
+
+class ArcSet(object):
+    """ Distinct arcs, matched by their vertices in either direction. """
+    def __init__(self):
+        self.arcs = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.arcs)
+
+    def add(self, points, closed=False):
+        """
+        Returns the index of the arc (or ~index if it is stored reversed),
+        adding it if it's new. Closed arcs (first vertex == last) match
+        whatever vertex they start at.
+        """
+        if closed:
+            # Start at the lowest vertex, so the same ring always gives the same arc.
+            ring = points[:-1]
+            start = numpy.lexsort((ring[:, 1], ring[:, 0]))[0]
+            ring = numpy.roll(ring, -start, axis=0)
+            points = numpy.vstack((ring, ring[:1]))
+            backward = numpy.vstack((ring[:1], ring[:0:-1], ring[:1]))
+        else:
+            backward = points[::-1]
+        forward_key = points.tostring()
+        if forward_key in self._index:
+            return self._index[forward_key]
+        backward_key = backward.tostring()
+        if backward_key in self._index:
+            return ~self._index[backward_key]
+        i = self._index[forward_key] = len(self.arcs)
+        self.arcs.append(points)
+        return i
+
+def cut_ring(ring, is_junction, arc_set):
+    """ Cuts a snapped ring at its junctions; returns its arc indexes. """
+    positions = numpy.nonzero(is_junction)[0]
+    if not len(positions):
+        return [arc_set.add(numpy.vstack((ring, ring[:1])), closed=True)]
+    ring = numpy.roll(ring, -positions[0], axis=0)
+    ring = numpy.vstack((ring, ring[:1]))
+    positions = numpy.append(positions - positions[0], len(ring) - 1)
+    return [arc_set.add(ring[start:end + 1]) for start, end in zip(positions[:-1], positions[1:])]
+
+def snap_polygons(polygons):
+    """
+    Snaps polygons as returned by parse_wkt_polygons() (see snap_ring).
+    Polygons whose outer ring collapses are dropped, with their holes.
+    """
+    snapped = []
+    for polygon in polygons:
+        rings = [snap_ring(ring) for ring in polygon]
+        if rings and rings[0] is not None:
+            snapped.append([r for r in rings if r is not None])
+    return snapped
+
+def build_topology(snapped):
+    """
+    Builds the topology of a set of places. `snapped` is a sequence of
+    (pk, polygons), with polygons as returned by snap_polygons().
+
+    Returns (arcs, place_arcs): a list of (n, 2) snapped int64 arrays, and
+    {pk: [[[arc index, ...] for each ring] for each polygon]}.
+    """
+    junctions = find_junctions([ring for pk, place in snapped for polygon in place for ring in polygon])
+    arc_set = ArcSet()
+    place_arcs = {}
+    for pk, place in snapped:
+        place_arcs[pk] = [
+            [cut_ring(ring, numpy.in1d(point_keys(ring), junctions), arc_set) for ring in polygon]
+            for polygon in place
+        ]
+    return arc_set.arcs, place_arcs
+
+# ----- Simplification -----
+
+def douglas_peucker(points, tolerance):
+    """
+    Returns a boolean mask of the vertices of an open line that Douglas-
+    Peucker simplification keeps (always including both ends).
+    """
+    n = len(points)
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        between = points[first + 1:last] - points[first]
+        length = numpy.hypot(segment[0], segment[1])
+        if length:
+            distances = numpy.abs(segment[0] * between[:, 1] - segment[1] * between[:, 0]) / length
+        else:
+            distances = numpy.hypot(between[:, 0], between[:, 1])
+        i = numpy.argmax(distances)
+        if distances[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            stack.append((first, i))
+            stack.append((i, last))
+    return keep
+
+def simplify_arc(points, tolerance):
+    """
+    Simplifies one arc of float coordinates, keeping its endpoints. A closed
+    arc is split at its farthest vertex from the start, and keeps at least
+    four vertices, so a ring never collapses to a line.
+    """
+    if len(points) < 3:
+        return points
+    if not (points[0] == points[-1]).all():
+        return points[douglas_peucker(points, tolerance)]
+
+    offsets = points - points[0]
+    far = numpy.argmax(numpy.hypot(offsets[:, 0], offsets[:, 1]))
+    if far == 0:
+        return points
+    keep = numpy.concatenate((douglas_peucker(points[:far + 1], tolerance)[:-1], douglas_peucker(points[far:], tolerance)))
+    if keep.sum() < 4 and len(points) > 4:
+        segment = points[far] - points[0]
+        distances = numpy.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0])
+        distances[keep] = -1
+        keep[numpy.argmax(distances)] = True
+    return points[keep]
+
+def encode_arc(points, precision):
+    """
+    Quantizes an arc to the 10^-precision grid, dropping repeated vertices,
+    and returns it as TopoJSON's delta-encoded JSON: the first vertex, then
+    each vertex's offset from the previous one.
+    """
+    grid = numpy.round(points * 10 ** precision).astype(numpy.int64)
+    keep = numpy.ones(len(grid), dtype=bool)
+    keep[1:] = (numpy.diff(grid, axis=0) != 0).any(axis=1)
+    keep[-1] = True
+    grid = grid[keep]
+    if len(grid) > 1 and (grid[-1] == grid[-2]).all():
+        grid = numpy.delete(grid, -2, axis=0)
+    if len(grid) < 2:
+        grid = numpy.vstack((grid, grid))
+    deltas = numpy.vstack((grid[:1], numpy.diff(grid, axis=0)))
+    return json.dumps(deltas.tolist(), separators=(',',':'))
+
+def arc_values(arc):
+    """
+    Returns {TopologyArc column: encoded arc} for every zoom band, for one
+    snapped arc.
+    """
+    points = arc / 10 ** SNAP_PRECISION
+    values = {}
+    for field, tolerance, precision in SIMPLIFIED_LEVELS:
+        values[ARC_FIELDS[field]] = encode_arc(simplify_arc(points, tolerance), precision)
+    return values
+
+# ----- Serving -----
+
+def band_zooms():
+    """ One map zoom level in each zoom band. """
+    return [0] + [max_zoom + 1 for max_zoom in ZOOM_BANDS]
+
+def _blocks(items, size=QUERY_BLOCK_SIZE):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def topology_json(place_type, zoom, state=None):
+    """
+    Returns the TopoJSON Topology (as a string) of every `place_type` object
+    with stored arcs -- or only those in a State (given by pk) -- for a map
+    zoom level. Arcs are renumbered to just the ones used.
+    """
+    PlaceClass = get_model('places', place_type)
+    arc_field = arc_field_for_zoom(zoom)
+    precision = precision_for_zoom(zoom)
+
+    qs = PlaceClass.objects.exclude(arcs=None).order_by('pk')
+    if state is not None:
+        qs = qs.filter(**{('pk' if place_type == 'state' else 'state'):state})
+
+    renumber = {}
+    geometries = []
+    for pk, name, arcs in qs.values_list('pk', 'name', 'arcs').iterator():
+        polygons = json.loads(arcs)
+        for polygon in polygons:
+            for ring in polygon:
+                for i, arc in enumerate(ring):
+                    stored = arc if arc >= 0 else ~arc
+                    if stored not in renumber:
+                        renumber[stored] = len(renumber)
+                    ring[i] = renumber[stored] if arc >= 0 else ~renumber[stored]
+        geometries.append({'type':'MultiPolygon', 'id':pk, 'properties':{'name':name}, 'arcs':polygons})
+
+    TopologyArc = get_model('places', 'topologyarc')
+    arcs = TopologyArc.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass))
+    encoded = [None] * len(renumber)
+    if state is None:
+        rows = arcs.values_list('index', arc_field).iterator()
+    else:
+        rows = (row for block in _blocks(sorted(renumber)) for row in arcs.filter(index__in=block).values_list('index', arc_field))
+    for index, arc in rows:
+        if index in renumber:
+            encoded[renumber[index]] = arc
+
+    scale = 10 ** -precision
+    header = json.dumps({
+        'type':'Topology',
+        'transform':{'scale':[scale, scale], 'translate':[0, 0]},
+        'objects':{place_type:{'type':'GeometryCollection', 'geometries':geometries}},
+    }, separators=(',',':'))
+    return "%s,\"arcs\":[%s]}" % (header[:-1], ",".join([arc or "[]" for arc in encoded]))
+
+def topology_path(place_type, zoom, state=None):
+    """ Where the gzip'd topology_json() of a place type (in a State, by pk, or all of them) for a zoom level is kept. """
+    return os.path.join(TOPOLOGY_DIR, place_type, "%s-%s.json.gz" % (arc_field_for_zoom(zoom), state or 'all'))
+
+def write_topology(place_type, zoom, state=None):
+    """ (Re)writes the gzip'd topology_json() file for a place type, zoom band and state. Returns its path. """
+    path = topology_path(place_type, zoom, state)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # It already exists.
+        pass
+    # Written aside and renamed into place, so it's never read half-written.
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(gzip_string(topology_json(place_type, zoom, state)))
+    finally:
+        f.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+    return path
+
+def topology_files(place_type):
+    """ The (place type, zoom, state) of every topology file of a place type: national and per State, for each zoom band. """
+    State = get_model('places', 'state')
+    states = [None] + list(State.objects.order_by('pk').values_list('pk', flat=True))
+    return [(place_type, zoom, state) for zoom in band_zooms() for state in states]
+
+# Topology files this process is writing in the background, and how many
+# times they've been invalidated (a write that saw an invalidation may
+# have read the old arcs, so it's dropped).
+_writing = set()
+_invalidations = {'count':0}
+_lock = Lock()
+
+def _write_in_bg(place_type, zoom, state, invalidations):
+    key = (place_type, arc_field_for_zoom(zoom), state)
+    try:
+        try:
+            path = write_topology(place_type, zoom, state)
+            if _invalidations['count'] != invalidations:
+                os.remove(path)
+        except Exception:
+            from traceback import print_exc
+            print_exc()
+    finally:
+        _lock.acquire()
+        try:
+            _writing.discard(key)
+        finally:
+            _lock.release()
+
+def request_topology(place_type, zoom, state=None):
+    """ Starts writing a topology file in the background, unless that's running. """
+    key = (place_type, arc_field_for_zoom(zoom), state)
+    _lock.acquire()
+    try:
+        if key in _writing:
+            return
+        _writing.add(key)
+    finally:
+        _lock.release()
+    call_in_bg(_write_in_bg, [place_type, zoom, state, _invalidations['count']])
+
+def topology_file(place_type, zoom, state=None):
+    """
+    The path of the gzip'd topology_json() file for a place type, zoom band
+    and state. If a state's file is missing, it's written in the background
+    and the national file's path is returned (if that exists); a missing
+    national file is written on the spot.
+    """
+    path = topology_path(place_type, zoom, state)
+    if os.path.exists(path):
+        return path
+    if state is not None:
+        request_topology(place_type, zoom, state)
+        path = topology_path(place_type, zoom)
+        if os.path.exists(path):
+            return path
+    return write_topology(place_type, zoom)
+
+def invalidate_topology(place_type):
+    """ Removes the topology files of a place type, for every band and state. """
+    _invalidations['count'] += 1
+    shutil.rmtree(os.path.join(TOPOLOGY_DIR, place_type), ignore_errors=True)
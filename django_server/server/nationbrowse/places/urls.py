@@ -23,4 +23,39 @@ urlpatterns = patterns('',
         view    = views.county_detail,
         name    = 'county_detail',
     ),
+    url(
+        regex   = '^reverse_geocode/$',
+        view    = views.reverse_geocode,
+        name    = 'reverse_geocode',
+    ),
+    url(
+        regex   = '^reverse_geocode/batch/$',
+        view    = views.reverse_geocode_batch,
+        name    = 'reverse_geocode_batch',
+    ),
+    url(
+        regex   = '^search/$',
+        view    = views.search,
+        name    = 'search',
+    ),
+    url(
+        regex   = '^nearby/(?P<place_type>state|county|zipcode)/$',
+        view    = views.nearby,
+        name    = 'nearby',
+    ),
+    url(
+        regex   = '^geometry/(?P<place_type>state|county|zipcode)/(?P<pk>\d+)/(?P<zoom>\d+)/$',
+        view    = views.geometry,
+        name    = 'geometry',
+    ),
+    url(
+        regex   = '^topology/(?P<place_type>state|county|zipcode)/(?P<zoom>\d+)\.json$',
+        view    = views.topology,
+        name    = 'topology',
+    ),
+    url(
+        regex   = '^export/(?P<place_type>state|county|zipcode)\.geojson$',
+        view    = views.export,
+        name    = 'export',
+    ),
 )
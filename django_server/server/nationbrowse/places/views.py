@@ -4,82 +4,44 @@ from django.http import HttpResponse
 from cacheutil import safe_get_cache,safe_set_cache,USING_DUMMY_CACHE
 from django.shortcuts import get_object_or_404,render_to_response
 from django.http import HttpResponseRedirect,HttpResponsePermanentRedirect,Http404
-from django.core.urlresolvers import reverse
-from random import choice as rand_choice
+from django.http import HttpResponseBadRequest,HttpResponseNotAllowed
 from django.template import RequestContext
-from django.template.defaultfilters import urlencode
 from django.views.decorators.cache import cache_control,never_cache
+from django.utils.cache import patch_cache_control
 
 from nationbrowse.places.models import State,ZipCode,County
+from nationbrowse.places.geocode import reverse_geocode as geocode_point, reverse_geocode_many, place_info, PLACE_TYPES
+from nationbrowse.places.spatial_index import get_place_index
+from nationbrowse.places.registry import get_registry
+from nationbrowse.places.random_pool import next_random_url
+from nationbrowse.places.search import get_search_index,MAX_LIMIT as MAX_SEARCH_LIMIT
+from nationbrowse.places.nearby import get_centroid_index,nearby_places,with_place_info
+from nationbrowse.places.simplify import field_for_zoom,precision_for_zoom,simplify_poly,SIMPLIFIED_LEVELS
+from nationbrowse.places.encoding import parse_wkt_polygons,encode_polygons
+from nationbrowse.places.export import geojson_features
+from nationbrowse.places.topology import topology_file,topology_path
+from nationbrowse.demographics.ranking import place_ranks
+from nationbrowse.demographics.similar import similar_places
+from django.db.models.loading import get_model
+from streamutil import gzip_stream,gzip_string,gunzip_string,read_stream
 
-from threadutil import call_in_bg
+import csv
+import gzip
+import json
+from cStringIO import StringIO
 
-def seed_next_random():
-    """
-    Generates a redirect view to a random Place object (State, ZipCode, or County)
-    and caches it. Picking a random place is expensive on the DB and CPU since there
-    are over 40000 objects that it picks from, which strains the DB (since it causes
-    an iteration over the objects to select the ID).
-    
-    See random_place() below, for notes on usage.
-    """
-    response = None
-    while not response:
-        try:
-            PlaceClass = rand_choice([State,ZipCode,County])
-            
-            # Cached list of all of the ID numbers for this place type.
-            cache_key = "all_ids: %s" % (PlaceClass.__name__)
-            all_ids = safe_get_cache(cache_key)
-            if not all_ids:
-                all_ids = PlaceClass.objects.only('id').order_by().values_list('pk') # [(0,),(1,),...]
-                all_ids = map(lambda x: x[0], all_ids) # pull ID out of tuples for a "regular" list
-                safe_set_cache(cache_key,all_ids,604800)
-            
-            rand_id = rand_choice(all_ids)
-            
-            if PlaceClass.__name__ == "County":
-                place = PlaceClass.objects.get(pk=rand_id)
-                url = reverse("places:county_detail",args=(place.state.abbr.lower(),urlencode(place.name.lower())),current_app="places")
-                call_in_bg(county_detail, (None, place.state.abbr.lower(),urlencode(place.name.lower())))
-            elif PlaceClass.__name__ == "State":
-                place = PlaceClass.objects.only('slug').get(pk=rand_id)
-                url = reverse("places:state_detail",args=(place.slug,),current_app="places")
-                call_in_bg(state_detail, (None, place.slug))
-            else:
-                place = PlaceClass.objects.only('slug').get(pk=rand_id)
-                url = reverse("places:zipcode_detail",args=(place.slug,),current_app="places")
-                call_in_bg(zipcode_detail, (None, place.slug))
-            response = HttpResponseRedirect(url)
-        except:
-            from traceback import print_exc
-            print_exc()
-            response = None
-    safe_set_cache("random_place",response,604800)
-    
-    return response
+from threadutil import call_in_bg
 
 @never_cache
 def random_place(request):
     """
-    If a random place is in the cache, use it and return that to the user.
-    If not, generate one right now.
-    
-    Before returning to the user, queue up a background task that generates
-    the next random place, to save DB/CPU usage when responding to user. (Prevents
-    this view from locking up while Django picks a suitable random object.)
+    Redirects to a random State, County or ZipCode, taken from this
+    process's pool of pre-rendered random places (see random_pool.py).
     """
-    cache_key = "random_place"
-    response = safe_get_cache(cache_key)
-    
-    if not response:
-        response = seed_next_random()
-    
-    # Pre-generate the next random location.
-    if not USING_DUMMY_CACHE:
-        call_in_bg(seed_next_random)
-    
-    return response
+    url = next_random_url()
+    if url is None:
+        raise Http404
+    return HttpResponseRedirect(url)
 
 @cache_control(public=True,max_age=604800)
 def state_detail(request,slug):
@@ -87,7 +49,10 @@ def state_detail(request,slug):
     response = safe_get_cache(cache_key)
     
     if not response:
-        place = get_object_or_404(State,slug=slug)
+        pk = get_registry('state').pk_for_slug(slug)
+        if pk is None:
+            raise Http404
+        place = get_object_or_404(State,pk=pk)
         
         response=render_to_response("places/state_detail.html",{
             'title':str(place.name),
@@ -118,6 +83,9 @@ def zipcode_detail(request,slug):
             'title':title,
             'place':place,
             'demographics':getattr(place.population_demographics,'__dict__',{}),
+            'nearby':nearby_places('zipcode',place.pk),
+            'ranks':place_ranks('zipcode',place.pk),
+            'similar':similar_places('zipcode',place.pk),
             'place_type':"zipcode"
         },context_instance=RequestContext(request))
         
@@ -136,7 +104,10 @@ def county_detail(request,state_abbr,name):
     response = safe_get_cache(cache_key)
     
     if not response:
-        place = get_object_or_404(County,state__abbr__iexact=state_abbr,name__iexact=name)
+        pk = get_registry('county').pk_for_name(name,state_abbr)
+        if pk is None:
+            raise Http404
+        place = get_object_or_404(County,pk=pk)
         
         title = u"%s, %s" % (place.long_name, place.state)
         
@@ -144,6 +115,9 @@ def county_detail(request,state_abbr,name):
             'title':title,
             'place':place,
             'demographics':getattr(place.population_demographics,'__dict__',{}),
+            'nearby':nearby_places('county',place.pk),
+            'ranks':place_ranks('county',place.pk),
+            'similar':similar_places('county',place.pk),
             'place_type':'county'
         },context_instance=RequestContext(request))
         
@@ -153,3 +127,355 @@ def county_detail(request,state_abbr,name):
             call_in_bg(state_detail,(None,place.state.slug))
 
     return response
+
+def _parse_coordinate(lat, lon):
+    """ Returns (lat, lon) as floats, or raises ValueError. """
+    lat, lon = float(lat), float(lon)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("coordinate out of range")
+    return lat, lon
+
+@cache_control(public=True,max_age=604800)
+def reverse_geocode(request):
+    """
+    Returns the State, County and ZipCode containing ?lat=...&lon=... as JSON:
+        {"lat": 38.94, "lon": -92.33,
+         "state": {"id": 26, "name": "Missouri", "url": "/places/state/mo/"},
+         "county": {...}, "zipcode": {...}}
+    Places that don't contain the point are null.
+    """
+    try:
+        lat, lon = _parse_coordinate(request.GET.get('lat'), request.GET.get('lon'))
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("lat and lon are required and must be valid coordinates.")
+
+    result = geocode_point(lat, lon)
+    if result is None:
+        # Not a GIS-aware server.
+        raise Http404
+
+    data = {'lat':lat, 'lon':lon}
+    data.update(result)
+    return HttpResponse(json.dumps(data), mimetype="application/json")
+
+def _batch_points(request):
+    """
+    Returns a list of (id, lat, lon) tuples from a batch request body. Accepts either
+     * a JSON list of [lat, lon] pairs or {"id":..., "lat":..., "lon":...} objects, or
+     * CSV with lat,lon or id,lat,lon columns (a non-numeric header row is skipped).
+    Without an id, the point's (zero-based) position in the input is used.
+    Raises ValueError if the body isn't in one of those formats. (Coordinates
+    themselves aren't checked here; bad ones get an error row in the results.)
+    """
+    body = request.raw_post_data
+    points = []
+    if _wants_json(request):
+        data = json.loads(body)
+        if not isinstance(data, list):
+            raise ValueError("the body must be a JSON list of points")
+        for i, point in enumerate(data):
+            if isinstance(point, dict):
+                points.append((point.get('id', i), point.get('lat'), point.get('lon')))
+            elif isinstance(point, list) and len(point) >= 2:
+                points.append((i, point[0], point[1]))
+            else:
+                raise ValueError("point %d isn't a [lat, lon] pair or a {\"lat\":..., \"lon\":...} object" % i)
+    else:
+        try:
+            rows = list(csv.reader(StringIO(body)))
+        except csv.Error, e:
+            raise ValueError(str(e))
+        for i, row in enumerate(rows):
+            if len(row) >= 3:
+                point = (row[0], row[1], row[2])
+            elif len(row) == 2:
+                point = (len(points), row[0], row[1])
+            else:
+                continue
+            if i == 0:
+                try:
+                    _parse_coordinate(point[1], point[2])
+                except ValueError:
+                    # A header row.
+                    continue
+            points.append(point)
+    return points
+
+def _wants_json(request):
+    return request.GET.get('format') == 'json' or 'json' in request.META.get('CONTENT_TYPE','')
+
+# Points geocoded (and geohashed) together in a batch request.
+BATCH_CHUNK_SIZE = 1000
+
+def _geocode_chunk(chunk):
+    valid = [(lat, lon) for point_id, lat, lon, ok in chunk if ok]
+    results = iter(reverse_geocode_many([lat for lat, lon in valid], [lon for lat, lon in valid]) or [])
+    for point_id, lat, lon, ok in chunk:
+        yield point_id, lat, lon, (results.next() if ok else None)
+
+def _batch_results(points):
+    """
+    Yields (id, lat, lon, result) for each point; result is None for bad
+    input. Points are geocoded BATCH_CHUNK_SIZE at a time.
+    """
+    chunk = []
+    for point_id, lat, lon in points:
+        try:
+            lat, lon = _parse_coordinate(lat, lon)
+            chunk.append((point_id, lat, lon, True))
+        except (TypeError, ValueError):
+            chunk.append((point_id, lat, lon, False))
+        if len(chunk) >= BATCH_CHUNK_SIZE:
+            for result in _geocode_chunk(chunk):
+                yield result
+            chunk = []
+    for result in _geocode_chunk(chunk):
+        yield result
+
+def _batch_csv(results):
+    columns = ['id','lat','lon']
+    for place_type in PLACE_TYPES:
+        columns += [place_type+'_id', place_type+'_name', place_type+'_url']
+    yield ",".join(columns) + "\n"
+
+    for point_id, lat, lon, result in results:
+        row = [point_id, lat, lon]
+        for place_type in PLACE_TYPES:
+            info = result and result[place_type]
+            if info:
+                row += [info['id'], info['name'].encode('utf-8'), info['url']]
+            else:
+                row += ['','','']
+        buf = StringIO()
+        csv.writer(buf).writerow(row)
+        yield buf.getvalue()
+
+def _batch_json(results):
+    yield "["
+    first = True
+    for point_id, lat, lon, result in results:
+        data = {'id':point_id, 'lat':lat, 'lon':lon}
+        if result is None:
+            data['error'] = "invalid coordinate"
+        else:
+            data.update(result)
+        if first:
+            yield "\n" + json.dumps(data)
+            first = False
+        else:
+            yield ",\n" + json.dumps(data)
+    yield "\n]\n"
+
+@never_cache
+def reverse_geocode_batch(request):
+    """
+    Reverse geocodes every point POSTed in the request body (see _batch_points
+    for the accepted CSV and JSON formats). Results are streamed back, one
+    row/object per input point, in the same format as the input.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+    if get_place_index() is None:
+        # Not a GIS-aware server.
+        raise Http404
+
+    # Parsed up front: once the response starts streaming it's too late for a 400.
+    try:
+        points = _batch_points(request)
+    except ValueError, e:
+        return HttpResponseBadRequest("Invalid batch: %s" % e)
+
+    results = _batch_results(points)
+    if _wants_json(request):
+        return HttpResponse(_batch_json(results), mimetype="application/json")
+    else:
+        return HttpResponse(_batch_csv(results), mimetype="text/csv")
+
+# Upper bounds for the nearby API, to keep responses (and work) sane.
+MAX_NEARBY_K = 100
+MAX_NEARBY_MILES = 250
+
+@cache_control(public=True,max_age=604800)
+def nearby(request,place_type):
+    """
+    Places of `place_type` near a point or near another place, as JSON.
+
+    The origin is either ?lat=...&lon=... or ?id=<pk of a place_type object>.
+    Returns the ?k= (default 10) nearest places, or with ?miles=N every place
+    whose center is within N miles. Distances are in miles between centroids.
+    """
+    index = get_centroid_index(place_type)
+    if index is None:
+        # Not a GIS-aware server.
+        raise Http404
+
+    exclude = None
+    try:
+        if 'id' in request.GET:
+            exclude = int(request.GET['id'])
+            center = index.centroid(exclude)
+            if center is None:
+                raise Http404
+            lat, lon = center
+        else:
+            lat, lon = _parse_coordinate(request.GET.get('lat'), request.GET.get('lon'))
+        k = min(int(request.GET.get('k', 10)), MAX_NEARBY_K)
+        miles = request.GET.get('miles')
+        if miles is not None:
+            miles = min(float(miles), MAX_NEARBY_MILES)
+        if k < 1 or (miles is not None and miles < 0):
+            raise ValueError("k must be positive")
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Give either id, or lat and lon; k must be a positive number and miles a non-negative one.")
+
+    if miles is not None:
+        results = index.within(lat, lon, miles, exclude=exclude)
+    else:
+        results = index.nearest(lat, lon, k, exclude=exclude)
+
+    return HttpResponse(json.dumps({
+        'lat':float(lat),
+        'lon':float(lon),
+        'places':with_place_info(place_type, results)
+    }), mimetype="application/json")
+
+def _band_wkt(PlaceClass, pk, field):
+    """
+    The simplified WKT of a place for a zoom band: the materialized column if
+    it has been filled in, else simplified on the fly from `poly` (GIS only).
+    """
+    try:
+        wkt = PlaceClass.objects.filter(pk=pk).values_list(field, flat=True)[0]
+    except IndexError:
+        raise Http404
+    if wkt is None and hasattr(PlaceClass,'pobjects'):
+        poly = PlaceClass.pobjects.filter(pk=pk).values_list('poly', flat=True)[0]
+        if poly and not poly.empty:
+            for level_field, tolerance, precision in SIMPLIFIED_LEVELS:
+                if level_field == field:
+                    wkt = simplify_poly(poly, tolerance, precision)
+    return wkt
+
+@cache_control(public=True,max_age=604800)
+def geometry(request,place_type,pk,zoom):
+    """
+    A place's polygons for a map zoom level, as compact JSON:
+    
+        {"id":..., "precision":5, "polygons":[["<ring>","<ring>"],...]}
+    
+    Each ring is an encoded polyline with coordinates quantized to the zoom
+    band's precision (see encoding.py). The gzip'd bytes are cached per place
+    and zoom band, and sent as-is to clients that accept gzip.
+    """
+    PlaceClass = get_model('places', place_type)
+    field = field_for_zoom(zoom)
+    cache_key = "place_geometry type=%s pk=%s field=%s" % (place_type, pk, field)
+    payload = safe_get_cache(cache_key)
+
+    if not payload:
+        precision = precision_for_zoom(zoom)
+        wkt = _band_wkt(PlaceClass, pk, field)
+        if not wkt:
+            raise Http404
+        payload = gzip_string(json.dumps({
+            'id':int(pk),
+            'precision':precision,
+            'polygons':encode_polygons(parse_wkt_polygons(wkt), precision)
+        }, separators=(',',':')))
+        safe_set_cache(cache_key,payload,604800)
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING',''):
+        response = HttpResponse(payload, mimetype="application/json")
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gunzip_string(payload), mimetype="application/json")
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+@cache_control(public=True,max_age=86400)
+def search(request):
+    """
+    Place name autocomplete/search, as JSON (see search.py):
+        {"q": "colum", "results": [{"type": "county", "id": 1234,
+            "name": "Columbia County, New York", "url": "/places/county/ny/columbia/"}, ...]}
+    Parameters: q, and optionally type (state, county or zipcode) and limit
+    (default 10). Responses are public and long-lived, so the nginx
+    memcached layer can serve repeated queries.
+    """
+    query = request.GET.get('q','').strip()
+    place_type = request.GET.get('type') or None
+    try:
+        limit = min(int(request.GET.get('limit', 10)), MAX_SEARCH_LIMIT)
+    except ValueError:
+        limit = 0
+    if not query or limit < 1 or place_type not in (None,) + PLACE_TYPES:
+        return HttpResponseBadRequest("q is required; type must be state, county or zipcode; limit a positive number.")
+
+    results = []
+    for result_type, pk in get_search_index().search(query, limit, place_type):
+        info = place_info(result_type, pk)
+        if info:
+            result = {'type':result_type}
+            result.update(info)
+            results.append(result)
+    return HttpResponse(json.dumps({'q':query, 'results':results}), mimetype="application/json")
+
+def topology(request,place_type,zoom):
+    """
+    Every `place_type` polygon for a map zoom level, as a TopoJSON Topology
+    of shared borders (see topology.py): each border is sent once, and
+    neighbors line up at every zoom level. With ?state=<abbreviation>, only
+    places in that state -- or, briefly, every place, while that state's
+    file is being written. Served from gzip'd files (see topology.py).
+    """
+    state = request.GET.get('state')
+    if state:
+        state = get_object_or_404(State,abbr__iexact=state).pk
+    else:
+        state = None
+    path = topology_file(place_type, zoom, state)
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING',''):
+        response = HttpResponse(read_stream(open(path, 'rb')), mimetype="application/json")
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(read_stream(gzip.GzipFile(path, 'rb')), mimetype="application/json")
+    response['Vary'] = 'Accept-Encoding'
+    if path == topology_path(place_type, zoom, state):
+        patch_cache_control(response, public=True, max_age=604800)
+    else:
+        # The national file stands in for the state's; don't keep it long.
+        patch_cache_control(response, public=True, max_age=300)
+    return response
+
+@cache_control(public=True,max_age=86400)
+def export(request,place_type):
+    """
+    Streams every `place_type` object, with its demographics, as a GeoJSON
+    FeatureCollection (see export.py). Optional parameters:
+     * state: State abbreviation; only places in that state
+     * zoom: map zoom level, which picks the simplified geometry
+     * source: DataSource id of the demographics (default: the latest)
+    Output is gzip'd on the fly for clients that accept it.
+    """
+    state = request.GET.get('state')
+    if state:
+        state = get_object_or_404(State,abbr__iexact=state).pk
+    try:
+        source = request.GET.get('source')
+        if source:
+            source = int(source)
+        else:
+            source = None
+    except ValueError:
+        return HttpResponseBadRequest("source must be a DataSource id.")
+
+    chunks = geojson_features(place_type, zoom=request.GET.get('zoom'), state=state, source=source)
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING',''):
+        response = HttpResponse(gzip_stream(chunks), mimetype="application/json")
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(chunks, mimetype="application/json")
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename=%s.geojson' % place_type
+    return response
@@ -47,6 +47,7 @@ INSTALLED_APPS = (
     'nationbrowse.places',
     'nationbrowse.demographics',
     'nationbrowse.graphs',
+    'nationbrowse.tiles',
 )
 ROOT_URLCONF = 'nationbrowse.urls'
 
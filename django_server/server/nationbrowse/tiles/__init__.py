@@ -0,0 +1,44 @@
+# coding=utf-8
+"""
+This app serves map tiles generated directly from the Places models (instead
+of from TileCache+Mapnik mapfiles).
+
+Vector tiles (Mapbox Vector Tile protobufs) carry clipped State, County and
+ZipCode polygons along with their demographics, so a client can style any
+field itself: one tile set stands in for a raster layer per field.
+
+Raster (PNG) choropleth tiles of any demographic field are also rendered
+here, with numpy, from the same simplified polygons (no Mapnik mapfiles).
+"""
+from django.conf import settings
+from nationbrowse.demographics.classify import DEFAULT_COLORS
+
+# Some default settings for this app. Can be overridden in settings.py.
+
+# Tile coordinate space (MVT "extent") and the clipping buffer around it.
+EXTENT = getattr(settings,"TILES_EXTENT",4096)
+BUFFER = getattr(settings,"TILES_BUFFER",64)
+
+# Zoom levels below which a place type isn't served (too many features per tile).
+MIN_ZOOM = getattr(settings,"TILES_MIN_ZOOM",{
+    'state':0,
+    'county':3,
+    'zipcode':7,
+})
+MAX_ZOOM = getattr(settings,"TILES_MAX_ZOOM",18)
+
+# PlacePopulation fields attached to features unless ?fields= is given.
+DEFAULT_FIELDS = getattr(settings,"TILES_DEFAULT_FIELDS",(
+    'total','urban','rural',
+    'white','black','amerindian','asian','pacislander','other',
+    'male','female',
+    'num_households','avg_household_size','num_families','avg_family_size',
+))
+
+# Choropleth color ramp for raster tiles, lowest class first (spread over
+# however many classes a map has), and the color of places with no data.
+RASTER_COLORS = getattr(settings,"TILES_RASTER_COLORS",DEFAULT_COLORS)
+NODATA_COLOR = getattr(settings,"TILES_NODATA_COLOR",'#DDDDDD')
+
+# Seconds to cache generated tiles.
+CACHE_SECONDS = getattr(settings,"TILES_CACHE_SECONDS",604800)
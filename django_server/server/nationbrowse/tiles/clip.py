@@ -0,0 +1,83 @@
+# coding=utf-8
+"""
+Polygon clipping and cleanup in tile coordinates.
+"""
+from __future__ import division
+
+def _clip_edge(points, inside, intersect):
+    output = []
+    if not points:
+        return output
+    prev = points[-1]
+    prev_in = inside(prev)
+    for point in points:
+        point_in = inside(point)
+        if point_in:
+            if not prev_in:
+                output.append(intersect(prev, point))
+            output.append(point)
+        elif prev_in:
+            output.append(intersect(prev, point))
+        prev, prev_in = point, point_in
+    return output
+
+def clip_ring(ring, xmin, ymin, xmax, ymax):
+    """
+    Sutherland-Hodgman clipping of an (open) ring of (x, y) points to a box.
+    Parts of a concave ring outside the box collapse onto its edges, which
+    is harmless for filled polygons.
+    """
+    def x_at(a, b, x):
+        return (x, a[1] + (b[1] - a[1]) * (x - a[0]) / (b[0] - a[0]))
+    def y_at(a, b, y):
+        return (a[0] + (b[0] - a[0]) * (y - a[1]) / (b[1] - a[1]), y)
+
+    points = list(ring)
+    points = _clip_edge(points, lambda p: p[0] >= xmin, lambda a, b: x_at(a, b, xmin))
+    points = _clip_edge(points, lambda p: p[0] <= xmax, lambda a, b: x_at(a, b, xmax))
+    points = _clip_edge(points, lambda p: p[1] >= ymin, lambda a, b: y_at(a, b, ymin))
+    points = _clip_edge(points, lambda p: p[1] <= ymax, lambda a, b: y_at(a, b, ymax))
+    return points
+
+def ring_area(points):
+    """ Signed area (shoelace formula); positive is clockwise with y pointing down. """
+    area = 0
+    n = len(points)
+    for i in xrange(n):
+        x1, y1 = points[i]
+        x2, y2 = points[(i + 1) % n]
+        area += x1 * y2 - x2 * y1
+    return area / 2.0
+
+def snap_ring(points):
+    """ Rounds to integer coordinates, dropping repeated points and the closing point. """
+    snapped = []
+    last = None
+    for x, y in points:
+        point = (int(round(x)), int(round(y)))
+        if point != last:
+            snapped.append(point)
+            last = point
+    if len(snapped) > 1 and snapped[0] == snapped[-1]:
+        snapped.pop()
+    return snapped
+
+def tile_polygon(polygon, project, xmin, ymin, xmax, ymax):
+    """
+    Projects, clips and snaps one polygon (a list of lon/lat rings; the
+    first is the exterior). Returns a list of integer rings with MVT winding
+    (exterior clockwise, holes counter-clockwise in tile space), or [] if
+    nothing of the polygon is left in the tile.
+    """
+    rings = []
+    for i, ring in enumerate(polygon):
+        points = snap_ring(clip_ring([project(lon, lat) for lon, lat in ring], xmin, ymin, xmax, ymax))
+        area = len(points) >= 3 and ring_area(points) or 0
+        if not area:
+            if i == 0:
+                return []
+            continue
+        if (i == 0) != (area > 0):
+            points.reverse()
+        rings.append(points)
+    return rings
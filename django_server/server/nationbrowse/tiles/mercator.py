@@ -0,0 +1,57 @@
+# coding=utf-8
+"""
+Spherical (Google) Mercator tile math: z/x/y tile bounds, and projecting
+WGS84 lon/lat into a tile's local coordinate space (or, in bulk with numpy,
+into "world" coordinates: the whole map is the unit square, y down).
+"""
+from __future__ import division
+from math import atan,degrees,log,pi,radians,sinh,tan,cos
+import numpy
+
+# Latitudes beyond this aren't on the (square) Mercator map.
+MAX_LATITUDE = 85.0511287798
+
+def num_tiles(z):
+    return 2 ** z
+
+def valid_tile(z, x, y):
+    n = num_tiles(z)
+    return 0 <= x < n and 0 <= y < n
+
+def tile_lon(x, z):
+    """ Longitude of the west edge of tile column x. """
+    return x / num_tiles(z) * 360.0 - 180.0
+
+def tile_lat(y, z):
+    """ Latitude of the north edge of tile row y. """
+    return degrees(atan(sinh(pi * (1 - 2 * y / num_tiles(z)))))
+
+def tile_bounds(z, x, y):
+    """ Returns (west, south, east, north) of a tile, in degrees. """
+    return (tile_lon(x, z), tile_lat(y + 1, z), tile_lon(x + 1, z), tile_lat(y, z))
+
+def tile_projector(z, x, y, extent):
+    """
+    Returns a function mapping (lon, lat) to (px, py) floats in the tile's
+    coordinate space: (0, 0) is the top-left corner and (extent, extent) the
+    bottom-right.
+    """
+    n = num_tiles(z)
+    def project(lon, lat):
+        lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+        phi = radians(lat)
+        px = ((lon + 180.0) / 360.0 * n - x) * extent
+        py = ((1 - log(tan(phi) + 1 / cos(phi)) / pi) / 2 * n - y) * extent
+        return px, py
+    return project
+
+def world_xy(lons, lats):
+    """
+    Projects arrays of lon/lat to world coordinates: (0, 0) is the top-left
+    corner of the z0 tile, (1, 1) the bottom-right.
+    """
+    lats = numpy.clip(numpy.asarray(lats, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    phi = numpy.radians(lats)
+    x = (numpy.asarray(lons, dtype=float) + 180.0) / 360.0
+    y = (1 - numpy.log(numpy.tan(phi) + 1 / numpy.cos(phi)) / pi) / 2
+    return x, y
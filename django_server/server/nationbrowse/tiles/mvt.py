@@ -0,0 +1,164 @@
+# coding=utf-8
+"""
+A small encoder for Mapbox Vector Tiles (version 2 of the spec), written
+against the protobuf wire format directly so we don't need the protobuf
+library or generated code.
+
+    layer = Layer("county", extent=4096)
+    layer.add_polygons(feature_id, [[ring, ring, ...], ...], {'name':u"Boone", 'total':135454})
+    data = encode_tile([layer])
+
+Rings are lists of integer (x, y) tile coordinates, open (no closing point),
+with MVT winding; see clip.tile_polygon.
+"""
+from decimal import Decimal
+import struct
+
+# Wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+# Geometry types and commands
+POLYGON = 3
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+def varint(value, out):
+    """ Appends the protobuf varint encoding of a non-negative integer. """
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def field_key(field, wire_type, out):
+    varint((field << 3) | wire_type, out)
+
+def length_delimited(field, data, out):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    field_key(field, LENGTH_DELIMITED, out)
+    varint(len(data), out)
+    out.append(data)
+
+def packed(field, values, out):
+    data = []
+    for value in values:
+        varint(value, data)
+    length_delimited(field, ''.join(data), out)
+
+def command(cmd, count):
+    return (cmd & 0x7) | (count << 3)
+
+def encode_value(value):
+    """ Encodes a feature property as a Layer.Value message. """
+    out = []
+    if isinstance(value, bool):
+        field_key(7, VARINT, out)
+        varint(int(value), out)
+    elif isinstance(value, (int, long)):
+        if value >= 0:
+            field_key(5, VARINT, out)
+            varint(value, out)
+        else:
+            field_key(6, VARINT, out)
+            varint(zigzag(value), out)
+    elif isinstance(value, (float, Decimal)):
+        field_key(3, FIXED64, out)
+        out.append(struct.pack('<d', float(value)))
+    else:
+        if not isinstance(value, unicode):
+            value = str(value)
+        length_delimited(1, value, out)
+    return ''.join(out)
+
+def polygon_geometry(polygons):
+    """ The command/parameter integers for a (multi)polygon's rings. """
+    geometry = []
+    cx = cy = 0
+    for rings in polygons:
+        for ring in rings:
+            x, y = ring[0]
+            geometry.append(command(MOVE_TO, 1))
+            geometry.append(zigzag(x - cx))
+            geometry.append(zigzag(y - cy))
+            cx, cy = x, y
+            geometry.append(command(LINE_TO, len(ring) - 1))
+            for x, y in ring[1:]:
+                geometry.append(zigzag(x - cx))
+                geometry.append(zigzag(y - cy))
+                cx, cy = x, y
+            geometry.append(command(CLOSE_PATH, 1))
+    return geometry
+
+class Layer(object):
+    """
+    Collects features for one tile layer. Property keys and values are
+    de-duplicated across the layer's features, as the spec intends.
+    """
+    def __init__(self, name, extent=4096):
+        self.name = name
+        self.extent = extent
+        self.keys = []
+        self.key_index = {}
+        self.values = []
+        self.value_index = {}
+        self.features = []
+
+    def __len__(self):
+        return len(self.features)
+
+    def _tag(self, index, table, item):
+        i = index.get(item)
+        if i is None:
+            i = index[item] = len(table)
+            table.append(item)
+        return i
+
+    def add_polygons(self, feature_id, polygons, properties=None):
+        """ Adds a (multi)polygon feature. Properties that are None are left out. """
+        tags = []
+        for key, value in sorted((properties or {}).items()):
+            if value is None:
+                continue
+            tags.append(self._tag(self.key_index, self.keys, key))
+            # Keyed by type too, so 1 and 1.0 (and True) stay distinct values.
+            tags.append(self._tag(self.value_index, self.values, (type(value), value)))
+
+        out = []
+        if feature_id is not None:
+            field_key(1, VARINT, out)
+            varint(feature_id, out)
+        if tags:
+            packed(2, tags, out)
+        field_key(3, VARINT, out)
+        varint(POLYGON, out)
+        packed(4, polygon_geometry(polygons), out)
+        self.features.append(''.join(out))
+
+    def encode(self):
+        out = []
+        field_key(15, VARINT, out)
+        varint(2, out)
+        length_delimited(1, self.name, out)
+        for feature in self.features:
+            length_delimited(2, feature, out)
+        for key in self.keys:
+            length_delimited(3, key, out)
+        for value_type, value in self.values:
+            length_delimited(4, encode_value(value), out)
+        field_key(5, VARINT, out)
+        varint(self.extent, out)
+        return ''.join(out)
+
+def encode_tile(layers):
+    """ Encodes a Tile message from Layers; empty layers are left out. """
+    out = []
+    for layer in layers:
+        if len(layer):
+            length_delimited(3, layer.encode(), out)
+    return ''.join(out)
@@ -0,0 +1,46 @@
+# coding=utf-8
+"""
+Writes paletted (8-bit, color type 3) PNGs straight from numpy arrays, with
+nothing but zlib: small files for flat-colored map tiles, and no PIL needed.
+"""
+import numpy
+import struct
+import zlib
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+def _chunk(chunk_type, data):
+    return ''.join([
+        struct.pack('>I', len(data)),
+        chunk_type,
+        data,
+        struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff),
+    ])
+
+def parse_color(color):
+    """ '#RRGGBB' (or '#RGB') to an (r, g, b) tuple. """
+    color = color.lstrip('#')
+    if len(color) == 3:
+        color = ''.join([c * 2 for c in color])
+    return tuple([int(color[i:i+2], 16) for i in (0, 2, 4)])
+
+def write_png(pixels, palette, alpha=None, compresslevel=6):
+    """
+    Encodes a 2-d uint8 array of palette indexes as a PNG string. `palette`
+    is a list of (r, g, b) tuples; `alpha` an optional list of opacities
+    (0-255) for the first len(alpha) palette entries.
+    """
+    height, width = pixels.shape
+    # Every row gets a leading filter byte (0, "None").
+    rows = numpy.zeros((height, width + 1), dtype=numpy.uint8)
+    rows[:, 1:] = pixels
+    parts = [
+        PNG_SIGNATURE,
+        _chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        _chunk('PLTE', ''.join([struct.pack('BBB', *color) for color in palette])),
+    ]
+    if alpha:
+        parts.append(_chunk('tRNS', ''.join([chr(a) for a in alpha])))
+    parts.append(_chunk('IDAT', zlib.compress(rows.tostring(), compresslevel)))
+    parts.append(_chunk('IEND', ''))
+    return ''.join(parts)
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""
+Choropleth raster tiles, rendered with numpy instead of Mapnik.
+
+For each place type and zoom band, the simplified polygons (see
+places/simplify.py) are loaded once per process and kept as flat numpy
+arrays of polygon edges in world coordinates (see mercator.world_xy), along
+with each place's bounding box. Values of the mapped field are loaded once
+per place type and field, and classified with demographics/classify.py.
+Rendering a tile is then pure numpy -- no queries:
+
+ * places whose bbox touches the tile are selected, and their edges gathered;
+ * every (edge, pixel row) crossing is expanded and its x intersection with
+   the row's center line computed;
+ * crossings are sorted by (place, row, x) and paired up into spans (the
+   even-odd rule, which handles holes and multipolygons), and the spans'
+   pixels are set to the place's color class;
+ * the class image is written as a paletted PNG (see png.py).
+"""
+from __future__ import division
+from django.db.models.loading import get_model
+from threading import Lock
+import numpy
+
+from nationbrowse.places.simplify import field_for_zoom
+from nationbrowse.places.encoding import parse_wkt_polygons
+from nationbrowse.tiles import MIN_ZOOM,RASTER_COLORS,NODATA_COLOR
+from nationbrowse.tiles.mercator import world_xy
+from nationbrowse.demographics.classify import get_breaks,load_values,interpolate_colors
+from nationbrowse.tiles.png import write_png,parse_color
+
+TILE_SIZE = 256
+
+# Palette indexes: 0 is transparent (no place), 1 is "no data", then classes.
+TRANSPARENT = 0
+NODATA = 1
+FIRST_CLASS = 2
+
+def _expand(starts, counts):
+    """ numpy equivalent of concatenating range(start, start+count) for each pair. """
+    total = counts.sum()
+    offsets = numpy.cumsum(counts) - counts
+    return numpy.arange(total) - numpy.repeat(offsets, counts) + numpy.repeat(starts, counts)
+
+class RasterLayer(object):
+    """ The polygon edges of every place of one type, for one zoom band. """
+    def __init__(self, pks, wkts):
+        x0, y0, x1, y1 = [], [], [], []
+        edge_start, edge_count = [], []
+        bbox = []
+        total = 0
+        for wkt in wkts:
+            edge_start.append(total)
+            count = 0
+            minx = miny = numpy.inf
+            maxx = maxy = -numpy.inf
+            for polygon in parse_wkt_polygons(wkt):
+                for ring in polygon:
+                    if len(ring) < 3:
+                        continue
+                    lons, lats = zip(*ring)
+                    xs, ys = world_xy(lons, lats)
+                    if xs[0] != xs[-1] or ys[0] != ys[-1]:
+                        xs, ys = numpy.append(xs, xs[0]), numpy.append(ys, ys[0])
+                    x0.append(xs[:-1]); y0.append(ys[:-1])
+                    x1.append(xs[1:]); y1.append(ys[1:])
+                    count += len(xs) - 1
+                    minx, maxx = min(minx, xs.min()), max(maxx, xs.max())
+                    miny, maxy = min(miny, ys.min()), max(maxy, ys.max())
+            edge_count.append(count)
+            total += count
+            bbox.append((minx, miny, maxx, maxy))
+
+        self.pks = numpy.asarray(pks)
+        self.row_for_pk = dict(zip(self.pks.tolist(), xrange(len(self.pks))))
+        def concat(parts):
+            if parts:
+                return numpy.concatenate(parts)
+            return numpy.zeros(0)
+        self.x0, self.y0, self.x1, self.y1 = concat(x0), concat(y0), concat(x1), concat(y1)
+        self.edge_start = numpy.asarray(edge_start, dtype=numpy.int64)
+        self.edge_count = numpy.asarray(edge_count, dtype=numpy.int64)
+        self.bbox = numpy.asarray(bbox, dtype=float).reshape((len(bbox), 4))
+        self.class_cache = {}
+
+    def __len__(self):
+        return len(self.pks)
+
+    def render(self, z, x, y, place_classes, size=TILE_SIZE):
+        """
+        Returns a (size, size) uint8 image of palette indexes for tile z/x/y,
+        where each place's pixels get its entry in `place_classes` (an array
+        aligned with self.pks).
+        """
+        pixels = numpy.zeros((size, size), dtype=numpy.uint8)
+        if not len(self):
+            return pixels
+        scale = (2 ** z) * size
+        ox, oy = x * size, y * size
+
+        # Places touching the tile, and their edges (in pixels).
+        b = self.bbox * scale
+        places = numpy.nonzero(
+            (b[:,0] - ox < size) & (b[:,2] - ox > 0) & (b[:,1] - oy < size) & (b[:,3] - oy > 0)
+        )[0]
+        if not len(places):
+            return pixels
+        counts = self.edge_count[places]
+        edges = _expand(self.edge_start[places], counts)
+        edge_place = numpy.repeat(places, counts)
+        ex0 = self.x0[edges] * scale - ox
+        ey0 = self.y0[edges] * scale - oy
+        ex1 = self.x1[edges] * scale - ox
+        ey1 = self.y1[edges] * scale - oy
+
+        # Pixel rows whose center line each edge crosses (half-open in y, so a
+        # closed ring always crosses a row an even number of times).
+        ymin = numpy.minimum(ey0, ey1)
+        ymax = numpy.maximum(ey0, ey1)
+        row_start = numpy.clip(numpy.ceil(ymin - .5), 0, size).astype(numpy.int64)
+        row_end = numpy.clip(numpy.ceil(ymax - .5), 0, size).astype(numpy.int64)
+        num_rows = numpy.maximum(row_end - row_start, 0)
+        crossing_edge = numpy.repeat(numpy.arange(len(edges)), num_rows)
+        if not len(crossing_edge):
+            return pixels
+        rows = _expand(row_start, num_rows)
+        t = (rows + .5 - ey0[crossing_edge]) / (ey1 - ey0)[crossing_edge]
+        xs = ex0[crossing_edge] + t * (ex1 - ex0)[crossing_edge]
+        crossing_place = edge_place[crossing_edge]
+
+        # Pair up crossings into spans, per place and row.
+        order = numpy.lexsort((xs, rows, crossing_place))
+        xs, rows, crossing_place = xs[order], rows[order], crossing_place[order]
+        span_start = numpy.clip(numpy.ceil(xs[0::2] - .5), 0, size).astype(numpy.int64)
+        span_end = numpy.clip(numpy.ceil(xs[1::2] - .5), 0, size).astype(numpy.int64)
+        span_len = numpy.maximum(span_end - span_start, 0)
+
+        filled = _expand(rows[0::2] * size + span_start, span_len)
+        pixels.flat[filled] = numpy.repeat(place_classes[crossing_place[0::2]], span_len)
+        return pixels
+
+# ----- Field values and classes -----
+
+def classify(values, breaks):
+    """
+    Palette index for each value: FIRST_CLASS + the index of the first break
+    it doesn't exceed, or NODATA for missing values.
+    """
+    classes = numpy.empty(len(values), dtype=numpy.uint8)
+    finite = numpy.isfinite(values)
+    classes[~finite] = NODATA
+    if breaks:
+        classes[finite] = FIRST_CLASS + numpy.minimum(
+            numpy.searchsorted(breaks, values[finite], side='left'), len(breaks) - 1
+        )
+    else:
+        classes[finite] = NODATA
+    return classes
+
+def values_array(values, pks):
+    """ Values (as floats, NaN where missing) aligned with an array of pks. """
+    array = numpy.empty(len(pks), dtype=float)
+    for i, pk in enumerate(pks.tolist()):
+        value = values.get(pk)
+        if value is None:
+            array[i] = numpy.nan
+        else:
+            array[i] = float(value)
+    return array
+
+# ----- Per-process caches -----
+
+_layers = {}
+_values = {}
+_lock = Lock()
+
+def get_raster_layer(place_type, band_field):
+    """ The RasterLayer for a place type and simplified geometry column (built on first use). """
+    key = (place_type, band_field)
+    layer = _layers.get(key)
+    if layer is None:
+        _lock.acquire()
+        try:
+            layer = _layers.get(key)
+            if layer is None:
+                PlaceClass = get_model('places', place_type)
+                rows = PlaceClass.objects.exclude(**{"%s__isnull" % band_field:True}).order_by('pk').values_list('pk', band_field)
+                pks, wkts = [], []
+                for pk, wkt in rows.iterator():
+                    pks.append(pk)
+                    wkts.append(wkt)
+                layer = _layers[key] = RasterLayer(pks, wkts)
+        finally:
+            _lock.release()
+    return layer
+
+def get_values(place_type, field):
+    """ {pk: value} for a place type and field (loaded on first use). """
+    key = (place_type, field)
+    values = _values.get(key)
+    if values is None:
+        values = _values[key] = load_values(place_type, field)
+    return values
+
+def reset():
+    """ Drop loaded geometry and values (i.e. after an import). """
+    _layers.clear()
+    _values.clear()
+
+def palette(colors):
+    """ The PNG palette and transparency for our palette indexes. """
+    entries = [(0, 0, 0), parse_color(NODATA_COLOR)] + [parse_color(c) for c in colors]
+    return entries, [0]
+
+def render_tile(place_type, field, z, x, y, method='quantile', k=5, colors=RASTER_COLORS):
+    """
+    Renders a choropleth PNG of `field` for the places of `place_type` in
+    tile z/x/y, with k classes by the given classification method (see
+    demographics/classify.py) spread over the color ramp.
+    """
+    if z < MIN_ZOOM.get(place_type, 0):
+        entries, alpha = palette([])
+        return write_png(numpy.zeros((TILE_SIZE, TILE_SIZE), dtype=numpy.uint8), entries, alpha)
+
+    breaks, minimum = get_breaks(place_type, field, method, k)
+    entries, alpha = palette(interpolate_colors(colors, len(breaks)))
+    layer = get_raster_layer(place_type, field_for_zoom(z))
+    classes = layer.class_cache.get((field, method, k))
+    if classes is None:
+        values = values_array(get_values(place_type, field), layer.pks)
+        classes = layer.class_cache[(field, method, k)] = classify(values, breaks)
+    return write_png(layer.render(z, x, y, classes), entries, alpha)
@@ -0,0 +1,159 @@
+# coding=utf-8
+"""
+Unit tests for Tiles.
+"""
+
+from django.test import TestCase
+from nationbrowse.places.models import State,County
+from nationbrowse.tiles.mercator import tile_bounds,tile_projector
+from nationbrowse.tiles.clip import clip_ring,ring_area,tile_polygon
+from nationbrowse.tiles.mvt import Layer,encode_tile
+from nationbrowse.tiles.vector import demographics_for
+from nationbrowse.tiles.raster import RasterLayer,classify,NODATA,FIRST_CLASS
+from nationbrowse.demographics.classify import quantile_breaks
+from nationbrowse.tiles.png import write_png
+from nationbrowse.tiles import raster
+from nationbrowse.demographics.models import DataSource,PlacePopulation
+from django.contrib.contenttypes.models import ContentType
+from datetime import date
+from decimal import Decimal
+import numpy
+import zlib
+
+# Make HTTP requests inside tests never time out.
+import socket
+socket.setdefaulttimeout(1000)
+
+def read_message(data):
+    """
+    Minimal protobuf reader for checking our output: returns a list of
+    (field, value) pairs, where length-delimited values are left as bytes.
+    """
+    fields = []
+    i = 0
+    def read_varint(i):
+        shift = value = 0
+        while True:
+            byte = ord(data[i])
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            i += 1
+            if byte < 0x80:
+                return value, i
+    while i < len(data):
+        key, i = read_varint(i)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, i = read_varint(i)
+        elif wire_type == 1:
+            value, i = data[i:i+8], i + 8
+        else:
+            length, i = read_varint(i)
+            value, i = data[i:i+length], i + length
+        fields.append((field, value))
+    return fields
+
+class MercatorTest(TestCase):
+    def test_tile_bounds(self):
+        west, south, east, north = tile_bounds(0, 0, 0)
+        self.assertEqual((west, east), (-180, 180))
+        self.assertAlmostEqual(north, 85.0511287798, 6)
+        self.assertAlmostEqual(south, -85.0511287798, 6)
+        self.assertEqual(tile_bounds(1, 1, 0)[:2], (0, 0))
+
+    def test_projector(self):
+        project = tile_projector(0, 0, 0, 4096)
+        px, py = project(0, 0)
+        self.assertAlmostEqual(px, 2048)
+        self.assertAlmostEqual(py, 2048)
+        px, py = tile_projector(1, 0, 0, 4096)(-180, 85.0511287798)
+        self.assertAlmostEqual(px, 0)
+        self.assertAlmostEqual(py, 0, 3)
+
+class ClipTest(TestCase):
+    def test_clip_ring(self):
+        ring = [(-10, -10), (10, -10), (10, 10), (-10, 10)]
+        clipped = clip_ring(ring, 0, 0, 20, 20)
+        self.assertEqual(abs(ring_area(clipped)), 100)
+        self.assertEqual(clip_ring(ring, 50, 50, 60, 60), [])
+
+    def test_winding(self):
+        identity = lambda x, y: (x, y)
+        # Counter-clockwise (in y-down tile space) exterior gets reversed.
+        rings = tile_polygon([[(0, 0), (0, 100), (100, 100), (100, 0), (0, 0)]], identity, -10, -10, 200, 200)
+        self.assert_(ring_area(rings[0]) > 0)
+        self.assertEqual(tile_polygon([[(300, 300), (310, 300), (310, 310)]], identity, -10, -10, 200, 200), [])
+
+class VectorTileTest(TestCase):
+    def test_encode(self):
+        layer = Layer("county")
+        layer.add_polygons(7, [[[(0, 0), (10, 0), (10, 10)]]], {'name':u"Boone", 'total':135454, 'empty':None})
+        tile = read_message(encode_tile([layer, Layer("empty")]))
+        self.assertEqual(len(tile), 1)
+        layer_fields = read_message(tile[0][1])
+        self.assert_((15, 2) in layer_fields)
+        self.assert_((1, "county") in layer_fields)
+        self.assertEqual([v for f, v in layer_fields if f == 3], ["name", "total"])
+        feature = read_message([v for f, v in layer_fields if f == 2][0])
+        self.assertEqual(feature[0], (1, 7))
+        # MoveTo(1) 0,0  LineTo(2) +10,0 0,+10  ClosePath
+        self.assertEqual(dict(feature)[4], "".join(map(chr, [9, 0, 0, 18, 20, 0, 0, 20, 15])))
+
+    def test_tile_view(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=mo,
+            bbox_west=-92.6, bbox_south=38.6, bbox_east=-92.0, bbox_north=39.3,
+            wkt_low="POLYGON ((-92.6 39.3, -92.0 39.3, -92.0 38.6, -92.6 38.6, -92.6 39.3))")
+        # z4 tile containing central Missouri, and one far away.
+        response = self.client.get('/tiles/county/4/3/6.mvt')
+        self.assertEqual(response.status_code, 200)
+        layer_fields = read_message(read_message(response.content)[0][1])
+        self.assertEqual(len([v for f, v in layer_fields if f == 2]), 1)
+        self.assertEqual(self.client.get('/tiles/county/4/12/2.mvt').content, "")
+        self.assertEqual(self.client.get('/tiles/county/4/16/0.mvt').status_code, 404)
+        self.assertEqual(self.client.get('/tiles/county/4/3/6.mvt', {'fields':'bogus'}).status_code, 400)
+
+    def test_demographics(self):
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.")
+        boone = County.objects.create(name="Boone",slug="boone-mo",long_name="Boone County",state=mo)
+        census = DataSource.objects.create(source="Census",date=date(2000,1,1))
+        PlacePopulation.objects.create(place_type=ContentType.objects.get_for_model(County), place_id=boone.pk,
+            source=census, total=135454, avg_household_size=Decimal("2.38"), avg_family_size=Decimal("2.91"))
+        # A newer source without population data (i.e. the crime data's).
+        DataSource.objects.create(source="FBI Uniform Crime Reporting Program",date=date(2008,1,1))
+        self.assertEqual(demographics_for(County, [boone.pk], ['total']), {boone.pk:{'total':135454}})
+
+class RasterTest(TestCase):
+    def test_render(self):
+        # A square with a square hole, filling the middle of the z0 tile.
+        layer = RasterLayer([1], ["POLYGON ((-90 45, 90 45, 90 -45, -90 -45, -90 45), (-45 20, 45 20, 45 -20, -45 -20, -45 20))"])
+        pixels = layer.render(0, 0, 0, numpy.array([5], dtype=numpy.uint8))
+        self.assertEqual(pixels[128, 70], 5)
+        self.assertEqual(pixels[128, 128], 0)
+        self.assertEqual(pixels[128, 10], 0)
+        self.assertEqual(pixels[10, 128], 0)
+        # Pixels whose centers are between x=64 (lon -90) and x=192 (lon 90).
+        self.assertEqual(list(numpy.nonzero(pixels[100])[0][[0, -1]]), [64, 191])
+
+    def test_classify(self):
+        values = numpy.array([1, 2, 3, 4, numpy.nan, 100], dtype=float)
+        breaks = quantile_breaks(values, 2)
+        self.assertEqual(list(classify(values, breaks)), [FIRST_CLASS]*3 + [FIRST_CLASS+1, NODATA, FIRST_CLASS+1])
+
+    def test_png(self):
+        png = write_png(numpy.array([[0, 1], [1, 0]], dtype=numpy.uint8), [(0, 0, 0), (255, 0, 0)], [0])
+        self.assertEqual(png[:8], '\x89PNG\r\n\x1a\n')
+        idat = png.index('IDAT')
+        length = int(png[idat-4:idat].encode('hex'), 16)
+        self.assertEqual(zlib.decompress(png[idat+4:idat+4+length]), '\x00\x00\x01\x00\x01\x00')
+
+    def test_tile_view(self):
+        raster.reset()
+        mo = State.objects.create(name="Missouri",slug="mo",abbr="MO",ap_style="Mo.",pop_density=81.2,
+            wkt_low="POLYGON ((-95.774 40.578, -89.099 36.5, -95.774 36.5, -95.774 40.578))")
+        response = self.client.get('/tiles/state/pop_density/4/3/6.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(self.client.get('/tiles/state/pop_density/4/3/6.png', {'method':'jenks','k':3}).status_code, 200)
+        self.assertEqual(self.client.get('/tiles/state/pop_density/4/3/6.png', {'method':'bogus'}).status_code, 400)
+        self.assertEqual(self.client.get('/tiles/state/bogus/4/3/6.png').status_code, 404)
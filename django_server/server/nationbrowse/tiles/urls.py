@@ -0,0 +1,16 @@
+# coding=utf-8
+from django.conf.urls.defaults import *
+import views
+
+urlpatterns = patterns('',
+    url(
+        regex   = '^(?P<place_type>state|county|zipcode)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        view    = views.vector_tile,
+        name    = 'vector_tile',
+    ),
+    url(
+        regex   = '^(?P<place_type>state|county|zipcode)/(?P<field>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$',
+        view    = views.raster_tile,
+        name    = 'raster_tile',
+    ),
+)
@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+Builds vector tiles from the Places models.
+
+Candidate places for a tile are found with the stored bounding box columns
+(see places/measure.py), so this is a plain indexed SQL query -- no PostGIS
+needed. Geometry comes from the simplified WKT column for the tile's zoom
+band (see places/simplify.py), and is then projected, clipped to the tile
+(plus a small buffer, so strokes don't show seams at tile edges) and
+snapped to the tile grid, which simplifies it further for free.
+"""
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+
+from nationbrowse.demographics.models import PlacePopulation
+from nationbrowse.places.simplify import field_for_zoom
+from nationbrowse.places.encoding import parse_wkt_polygons
+from nationbrowse.places.export import population_source
+from nationbrowse.tiles import EXTENT,BUFFER,MIN_ZOOM
+from nationbrowse.tiles.mercator import tile_bounds,tile_projector
+from nationbrowse.tiles.clip import tile_polygon
+from nationbrowse.tiles.mvt import Layer,encode_tile
+
+def demographics_for(PlaceClass, pks, fields):
+    """
+    Returns {place pk: {field: value}} from the place type's PlacePopulation
+    source (see population_source()), for the given place pks (or every
+    place, if pks is None).
+    """
+    if pks is not None and not pks or not fields:
+        return {}
+    qs = PlacePopulation.objects.filter(place_type=ContentType.objects.get_for_model(PlaceClass))
+    if pks is not None:
+        qs = qs.filter(place_id__in=pks)
+    source = population_source(PlaceClass._meta.object_name.lower())
+    if source is not None:
+        qs = qs.filter(source=source)
+    data = {}
+    for row in qs.order_by().values_list('place_id', *fields):
+        data[row[0]] = dict(zip(fields, row[1:]))
+    return data
+
+def build_tile(place_type, z, x, y, fields):
+    """
+    Returns the encoded vector tile (one layer, named after the place type)
+    with every place of `place_type` that shows up in tile z/x/y. Features
+    carry the place's name, area, population density and `fields` of its
+    demographics as properties.
+    """
+    layer = Layer(place_type, extent=EXTENT)
+    if z < MIN_ZOOM.get(place_type, 0):
+        return encode_tile([layer])
+
+    PlaceClass = get_model('places', place_type)
+    west, south, east, north = tile_bounds(z, x, y)
+    # Pad the query by the clip buffer (in degrees, close enough at any latitude).
+    pad_x = (east - west) * BUFFER / EXTENT
+    pad_y = (north - south) * BUFFER / EXTENT
+    field = field_for_zoom(z)
+    rows = list(PlaceClass.objects.filter(
+        bbox_west__lte=east + pad_x,
+        bbox_east__gte=west - pad_x,
+        bbox_south__lte=north + pad_y,
+        bbox_north__gte=south - pad_y,
+    ).exclude(**{"%s__isnull" % field:True}).order_by().values_list('pk','name','area_sq_mi','pop_density',field))
+
+    demographics = demographics_for(PlaceClass, [row[0] for row in rows], fields)
+    project = tile_projector(z, x, y, EXTENT)
+    for pk, name, area_sq_mi, pop_density, wkt in rows:
+        polygons = []
+        for polygon in parse_wkt_polygons(wkt):
+            rings = tile_polygon(polygon, project, -BUFFER, -BUFFER, EXTENT + BUFFER, EXTENT + BUFFER)
+            if rings:
+                polygons.append(rings)
+        if not polygons:
+            continue
+        properties = {'name':name, 'area_sq_mi':area_sq_mi, 'pop_density':pop_density}
+        properties.update(demographics.get(pk, {}))
+        layer.add_polygons(pk, polygons, properties)
+    return encode_tile([layer])
@@ -0,0 +1,82 @@
+# coding=utf-8
+from django.http import HttpResponse,Http404,HttpResponseBadRequest
+from django.views.decorators.cache import cache_control
+from cacheutil import safe_get_cache,safe_set_cache
+from streamutil import gzip_string,gunzip_string
+
+from nationbrowse.tiles import DEFAULT_FIELDS,MAX_ZOOM,CACHE_SECONDS
+from nationbrowse.tiles.mercator import valid_tile
+from nationbrowse.tiles.vector import build_tile
+from nationbrowse.tiles.raster import render_tile
+from nationbrowse.demographics.classify import is_classifiable,METHODS,MAX_CLASSES
+from nationbrowse.places.export import demographic_fields
+
+def _tile_fields(request):
+    """ The demographic fields asked for with ?fields=a,b,c (or the defaults). """
+    if 'fields' not in request.GET:
+        return list(DEFAULT_FIELDS)
+    allowed = set([f.name for f in demographic_fields()])
+    fields = sorted(set([f.strip() for f in request.GET['fields'].split(',') if f.strip()]))
+    for field in fields:
+        if field not in allowed:
+            raise ValueError(field)
+    return fields
+
+@cache_control(public=True,max_age=604800)
+def vector_tile(request,place_type,z,x,y):
+    """
+    A Mapbox Vector Tile with the `place_type` polygons in tile z/x/y, in
+    one layer named after the place type (see vector.py). Demographics to
+    attach can be picked with ?fields=total,white,... The gzip'd tile is
+    cached per tile and field list.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if z > MAX_ZOOM or not valid_tile(z, x, y):
+        raise Http404
+    try:
+        fields = _tile_fields(request)
+    except ValueError, e:
+        return HttpResponseBadRequest("Unknown field: %s" % e)
+
+    cache_key = "vector_tile %s/%d/%d/%d fields=%s" % (place_type, z, x, y, ",".join(fields))
+    payload = safe_get_cache(cache_key)
+    if not payload:
+        payload = gzip_string(build_tile(place_type, z, x, y, fields))
+        safe_set_cache(cache_key,payload,CACHE_SECONDS)
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING',''):
+        response = HttpResponse(payload, mimetype="application/x-protobuf")
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gunzip_string(payload), mimetype="application/x-protobuf")
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+@cache_control(public=True,max_age=604800)
+def raster_tile(request,place_type,field,z,x,y):
+    """
+    A 256px PNG choropleth of one demographic or crime `field` (or
+    pop_density or area_sq_mi) for the `place_type` polygons in tile z/x/y
+    (see raster.py). Classes are picked with ?method= (quantile,
+    equal_interval or jenks) and ?k=, as for demographics:class_breaks.
+    Cached per tile, field and classification.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if z > MAX_ZOOM or not valid_tile(z, x, y):
+        raise Http404
+    if not is_classifiable(field):
+        raise Http404
+    method = request.GET.get('method','quantile')
+    try:
+        k = int(request.GET.get('k',5))
+    except ValueError:
+        k = 0
+    if method not in METHODS or not 1 <= k <= MAX_CLASSES:
+        return HttpResponseBadRequest("method must be one of %s; k from 1 to %d." % (", ".join(METHODS), MAX_CLASSES))
+
+    cache_key = "raster_tile %s/%s/%d/%d/%d %s k=%d" % (place_type, field, z, x, y, method, k)
+    png = safe_get_cache(cache_key)
+    if not png:
+        png = render_tile(place_type, field, z, x, y, method, k)
+        safe_set_cache(cache_key,png,CACHE_SECONDS)
+    return HttpResponse(png, mimetype="image/png")
@@ -11,6 +11,8 @@ urlpatterns = patterns('',
 	}),
     (r'^graphs/', include('nationbrowse.graphs.urls',namespace="graphs")),
     (r'^places/', include('nationbrowse.places.urls',namespace="places")),
+    (r'^demographics/', include('nationbrowse.demographics.urls',namespace="demographics")),
+    (r'^tiles/', include('nationbrowse.tiles.urls',namespace="tiles")),
     (r'^querybuilder/', include('nationbrowse.querybuilder.urls',namespace="querybuilder")),
     (r'^admin/', include(admin.site.urls)),
 )
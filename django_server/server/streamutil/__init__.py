@@ -0,0 +1,71 @@
+# coding=utf-8
+"""
+Helpers for generator-based ("streaming") output: large exports are built
+as iterators of string chunks, which can be handed straight to an
+HttpResponse or written to a file, without holding the whole output in
+memory. Also has small helpers for gzip'd (cached) payloads.
+"""
+from cStringIO import StringIO
+import gzip
+import zlib
+
+# Don't hand out tiny pieces of compressed output; collect at least this
+# many bytes before yielding.
+MIN_CHUNK_SIZE = 64 * 1024
+
+def gzip_stream(chunks, compresslevel=6):
+    """
+    Compresses an iterable of strings on the fly, yielding the pieces of a
+    single gzip stream (readable by gunzip, or browsers with
+    Content-Encoding: gzip).
+    """
+    # wbits = 16 + MAX_WBITS: zlib writes the gzip header and trailer.
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= MIN_CHUNK_SIZE:
+                yield ''.join(pending)
+                pending = []
+                pending_size = 0
+    pending.append(compressor.flush())
+    yield ''.join(pending)
+
+def gzip_string(data, compresslevel=9):
+    """ Gzips a whole string at once (i.e. for caching compressed payloads). """
+    buf = StringIO()
+    f = gzip.GzipFile(mode='wb', compresslevel=compresslevel, fileobj=buf)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def gunzip_string(data):
+    """ The inverse of gzip_string. """
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+def write_stream(chunks, f):
+    """ Writes every chunk to the file-like object `f`. Returns the number of bytes written. """
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        f.write(chunk)
+        size += len(chunk)
+    return size
+
+def read_stream(f, chunk_size=MIN_CHUNK_SIZE):
+    """ Yields the contents of the file-like object `f` in chunks, then closes it. """
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
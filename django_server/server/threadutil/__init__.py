@@ -26,6 +26,18 @@ def db_threadsafe(func):
     
     return wrapped_func
 
+def close_db_connection():
+    """
+    Closes the Django DB connection inherited from a parent process. Use
+    as a multiprocessing.Pool initializer so each worker opens its own
+    connection instead of sharing the parent's socket.
+    """
+    from django.db import connection
+    try:
+        connection.close()
+    except:
+        pass
+
 def call_in_bg(function,args=[],kwargs={}):
     """
     Similar API to Python's threading.Thread.
@@ -9,10 +9,10 @@ def _cache_key(model, value, field=None, module_name=None):
     if not module_name:
         module_name = model._meta.module_name
         
-    # It's safe to hot-swap a "deferred_poly" version of a PolyModel
-    # for the non-deffered version. Django will just have to query again
-    # for the poly.
-    module_name = module_name.replace('_deferred_poly','')
+    # It's safe to hot-swap a "deferred_poly" (or any other deferred) version
+    # of a PolyModel for the non-deffered version. Django will just have to
+    # query again for the deferred fields.
+    module_name = module_name.split('_deferred_')[0]
     
     if field:
         return "%s:%s.%s:%s" % (model._meta.app_label, module_name, field, value)
@@ -153,11 +153,12 @@ if ('django.contrib.gis' in settings.INSTALLED_APPS):
 
     class PolyDeferGeoManager(GeoCachingManager):
         """
-        Same as above, but defers 'poly' fields. Split off
+        Same as above, but defers 'poly' fields (or the model's
+        `deferred_fields`, if it has them). Split off
         because the .defer() method MUST only be called on the parent class.
         """
         def get_query_set(self):
-			return GeoCachingQuerySet(self.model).defer('poly',)
+			return GeoCachingQuerySet(self.model).defer(*getattr(self.model,'deferred_fields',('poly',)))
 
     class GeoCachingQuerySet(geo_models.query.GeoQuerySet):
         def iterator(self):
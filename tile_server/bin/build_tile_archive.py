@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""
+Packs a layer's tiles into its archive for the TileArchive cache (see
+lib/tilearchive.py): the tiles of the current archive, plus every tile in the
+Disk spool (which take precedence), go into a new archive that atomically
+replaces the old one.
+
+    build_tile_archive.py state_pop_2000
+    build_tile_archive.py state_pop_2000 --clean    # also empty the spool
+
+To sync tile hosts, build once and copy the single .tiles file around
+(copy to a temporary name next to the old one, then mv it into place).
+"""
+from optparse import OptionParser
+from time import time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from TileCache.Service import Service
+from tilearchive import ArchiveReader,TileArchive,write_archive
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc', 'tilecache.cfg')
+
+def spool_tiles(layer_dir, extension):
+    """
+    Yields (z, x, y, path) for every tile in a TileCache Disk cache layer
+    directory (laid out as zz/xxx/xxx/xxx/yyy/yyy/yyy.ext).
+    """
+    suffix = "." + extension
+    for dirpath, dirnames, filenames in os.walk(layer_dir):
+        parts = os.path.relpath(dirpath, layer_dir).split(os.sep)
+        if len(parts) != 6:
+            continue
+        z = int(parts[0])
+        x = int(parts[1]) * 1000000 + int(parts[2]) * 1000 + int(parts[3])
+        y_high = int(parts[4]) * 1000000 + int(parts[5]) * 1000
+        for filename in filenames:
+            if filename.endswith(suffix):
+                yield z, x, y_high + int(filename[:-len(suffix)]), os.path.join(dirpath, filename)
+
+def main():
+    parser = OptionParser(usage="%prog [options] layer")
+    parser.add_option('-c', '--config', dest='config', default=DEFAULT_CONFIG,
+        help='TileCache config file (default: %default)')
+    parser.add_option('--clean', dest='clean', action='store_true', default=False,
+        help='Delete the spooled tile files once they are in the archive')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give a layer name.")
+    layer_name = args[0]
+
+    service = Service.load(options.config)
+    cache = service.cache
+    if not isinstance(cache, TileArchive):
+        parser.error("The [cache] in %s isn't a TileArchive." % options.config)
+    if layer_name not in service.layers:
+        parser.error("Unknown layer: %s" % layer_name)
+    layer = service.layers[layer_name]
+
+    start = time()
+    path = cache.archive_path(layer_name)
+    layer_dir = os.path.join(cache.basedir, layer_name)
+    spooled = list(spool_tiles(layer_dir, layer.extension))
+
+    old = None
+    if os.path.exists(path):
+        old = ArchiveReader(path)
+
+    def tiles():
+        if old is not None:
+            for tile in old.items():
+                yield tile
+        for z, x, y, tile_path in spooled:
+            yield z, x, y, open(tile_path, 'rb').read()
+
+    print "Packing %d archived and %d spooled %s tiles..." % (old and len(old) or 0, len(spooled), layer_name)
+    count, distinct = write_archive(path, tiles())
+    if old is not None:
+        old.close()
+    print "Wrote %s: %d tiles, %d distinct images (%.1f sec)." % (path, count, distinct, time() - start)
+
+    if options.clean:
+        for z, x, y, tile_path in spooled:
+            os.unlink(tile_path)
+        print "Removed %d spooled tiles." % len(spooled)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+"""
+Pre-renders ("seeds") the TileCache cache for a layer, so cold zoom levels
+don't have to be rendered by tilecache.fcgi on first request.
+
+Tiles are rendered a metatile at a time (see `metatile`/`metasize` in
+tilecache.cfg: Mapnik draws one big image, which is cut into tiles and all of
+them are saved), with one metatile per job in a process pool.
+
+Progress is appended to a file as metatiles finish, so an interrupted run
+picks up where it left off. Work can be split between hosts with --shard;
+i.e. to warm a layer overnight across tile, tile2 and tile3:
+
+    tile$  seed_tiles.py state_pop_2000 0 10 --shard 0/3
+    tile2$ seed_tiles.py state_pop_2000 0 10 --shard 1/3
+    tile3$ seed_tiles.py state_pop_2000 0 10 --shard 2/3
+"""
+from optparse import OptionParser
+from multiprocessing import Pool, cpu_count
+from time import time
+import os
+import sys
+
+# For the TileArchive cache (lib/tilearchive.py).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from TileCache.Service import Service
+from TileCache.Layer import Tile
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc', 'tilecache.cfg')
+
+# The 50 states (including the Aleutians, Hawaii and the Florida Keys).
+US_BBOX = (-179.2, 18.9, -66.9, 71.4)
+
+_service = None
+
+def init_worker(config):
+    """ Pool initializer: every worker loads its own TileCache Service. """
+    global _service
+    _service = Service.load(config)
+
+def render_metatile(args):
+    """
+    Worker: renders the metatile whose lower-left tile is (x, y, z). Returns
+    the job, so the parent can record it as done.
+    """
+    layer_name, z, x, y, force = args
+    layer = _service.layers[layer_name]
+    _service.renderTile(Tile(layer, x, y, z), force=force)
+    return layer_name, z, x, y
+
+def metatiles(layer, zoom_levels, bbox):
+    """ Yields (z, x, y, number of tiles) for every metatile covering the bbox. """
+    for z in zoom_levels:
+        bottomleft = layer.getClosestCell(z, bbox[0:2])
+        topright = layer.getClosestCell(z, bbox[2:4])
+        if getattr(layer, 'metaTile', False):
+            meta_x, meta_y = layer.getMetaSize(z)
+        else:
+            meta_x, meta_y = 1, 1
+        # TileCache's metatiles are aligned to multiples of the metatile size.
+        start_x = bottomleft[0] - bottomleft[0] % meta_x
+        start_y = bottomleft[1] - bottomleft[1] % meta_y
+        for y in xrange(start_y, topright[1] + 1, meta_y):
+            for x in xrange(start_x, topright[0] + 1, meta_x):
+                tiles = (min(x + meta_x, topright[0] + 1) - max(x, bottomleft[0])) * \
+                    (min(y + meta_y, topright[1] + 1) - max(y, bottomleft[1]))
+                yield z, x, y, tiles
+
+def read_progress(filename):
+    """ The set of (z, x, y) metatiles already recorded as done. """
+    done = set()
+    if os.path.exists(filename):
+        for line in open(filename):
+            parts = line.split()
+            if len(parts) == 3:
+                done.add(tuple([int(p) for p in parts]))
+    return done
+
+def main():
+    parser = OptionParser(usage="%prog [options] layer min_zoom max_zoom")
+    parser.add_option('-c', '--config', dest='config', default=DEFAULT_CONFIG,
+        help='TileCache config file (default: %default)')
+    parser.add_option('-b', '--bbox', dest='bbox', default=",".join([str(c) for c in US_BBOX]),
+        help='Area to seed, as minx,miny,maxx,maxy in the layer\'s SRS (default: the US)')
+    parser.add_option('-p', '--processes', dest='processes', type='int', default=cpu_count(),
+        help='Number of rendering processes (default: number of CPUs)')
+    parser.add_option('-s', '--shard', dest='shard', default='0/1',
+        help='Only seed every n-th metatile, starting at the i-th, as i/n (default: %default)')
+    parser.add_option('--progress', dest='progress', default=None,
+        help='Progress file, for resuming (default: seed_<layer>_<i>of<n>.progress)')
+    parser.add_option('-f', '--force', dest='force', action='store_true', default=False,
+        help='Re-render tiles that are already in the cache')
+    options, args = parser.parse_args()
+
+    if len(args) != 3:
+        parser.error("Give a layer name and a zoom range.")
+    layer_name = args[0]
+    zoom_levels = range(int(args[1]), int(args[2]) + 1)
+    bbox = tuple([float(c) for c in options.bbox.split(',')])
+    shard, num_shards = [int(n) for n in options.shard.split('/')]
+    if not 0 <= shard < num_shards:
+        parser.error("--shard must be i/n with 0 <= i < n")
+
+    service = Service.load(options.config)
+    if layer_name not in service.layers:
+        parser.error("Unknown layer: %s (have: %s)" % (layer_name, ", ".join(service.layers.keys())))
+    layer = service.layers[layer_name]
+
+    progress = options.progress or "seed_%s_%dof%d.progress" % (layer_name, shard, num_shards)
+    done = read_progress(progress)
+
+    jobs = []
+    tiles_for = {}
+    skipped = 0
+    for i, (z, x, y, tiles) in enumerate(metatiles(layer, zoom_levels, bbox)):
+        if i % num_shards != shard:
+            continue
+        if (z, x, y) in done:
+            skipped += tiles
+            continue
+        jobs.append((layer_name, z, x, y, options.force))
+        tiles_for[(z, x, y)] = tiles
+    total = sum(tiles_for.values())
+
+    print "Seeding %s, zoom %d-%d, shard %d/%d: %d tiles in %d metatiles (%d tiles already done)" % (
+        layer_name, zoom_levels[0], zoom_levels[-1], shard, num_shards, total, len(jobs), skipped
+    )
+
+    start = time()
+    rendered = 0
+    progress_file = open(progress, 'a')
+    pool = Pool(processes=options.processes, initializer=init_worker, initargs=(options.config,))
+    try:
+        for layer_name, z, x, y in pool.imap_unordered(render_metatile, jobs):
+            progress_file.write("%d %d %d\n" % (z, x, y))
+            progress_file.flush()
+            rendered += tiles_for[(z, x, y)]
+            elapsed = max(time() - start, .001)
+            rate = rendered / elapsed
+            print "  z%d %d,%d  %d/%d tiles (%.1f tiles/sec, ~%d min left)" % (
+                z, x, y, rendered, total, rate, (total - rendered) / max(rate, .001) / 60
+            )
+    finally:
+        pool.close()
+        pool.join()
+        progress_file.close()
+
+    print "Done: %d tiles in %.1f sec (%.1f tiles/sec)." % (rendered, time() - start, rendered / max(time() - start, .001))
+
+if __name__ == '__main__':
+    main()
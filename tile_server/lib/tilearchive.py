@@ -0,0 +1,190 @@
+"""
+A TileCache cache that serves tiles out of one packed archive file per
+layer, read through mmap.
+
+Archive format (all little-endian):
+
+    header  "NBTA", version (uint32), tile count (uint32), index offset (uint64)
+    data    tile images, back to back; identical images are stored once
+    index   one (key uint64, offset uint64, length uint32) record per tile,
+            sorted by key, where key = z << 58 | x << 29 | y
+
+A lookup is a binary search of the index followed by a slice of the map --
+no per-tile open() or stat(), and no inode per tile. Archives are built
+(from the Disk "spool" this cache also writes to, plus the previous archive)
+by bin/build_tile_archive.py, which writes to a temporary file and renames
+it over the old one, so readers switch to a new archive atomically; readers
+notice the swap with an occasional stat() of the archive path.
+
+Configuration, in tilecache.cfg (lib/ must be on the PYTHONPATH):
+
+    [cache]
+    type=TileArchive
+    module=tilearchive
+    archive=/var/cache/nationbrowse/tiles      ; <layer>.tiles files live here
+    base=/var/cache/nationbrowse/tilespool     ; new tiles, until the next build
+
+Tiles missing from the archive are looked up in (and newly rendered tiles
+are saved to) the spool, which is an ordinary TileCache Disk cache.
+"""
+from TileCache.Caches.Disk import Disk
+from hashlib import sha1
+from threading import Lock
+from time import time
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = "NBTA"
+VERSION = 1
+HEADER = struct.Struct("<4sIIQ")
+RECORD = struct.Struct("<QQI")
+
+# Seconds between checks for a newly swapped-in archive.
+CHECK_INTERVAL = 30
+
+def tile_key(z, x, y):
+    return (z << 58) | (x << 29) | y
+
+def key_tile(key):
+    return key >> 58, (key >> 29) & 0x1fffffff, key & 0x1fffffff
+
+class ArchiveReader(object):
+    """ Read-only, memory-mapped view of one archive file. """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The map stays valid after the file is closed (or replaced).
+            f.close()
+        magic, version, self.count, self.index_offset = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d tile archive" % (path, VERSION))
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, i):
+        return RECORD.unpack_from(self.map, self.index_offset + i * RECORD.size)
+
+    def get(self, z, x, y):
+        """ Returns the tile's bytes, or None. """
+        key = tile_key(z, x, y)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, offset, length = self._record(mid)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self.map[offset:offset + length]
+        return None
+
+    def items(self):
+        """ Yields (z, x, y, data) for every tile, in key order. """
+        for i in xrange(self.count):
+            key, offset, length = self._record(i)
+            z, x, y = key_tile(key)
+            yield z, x, y, self.map[offset:offset + length]
+
+    def is_current(self):
+        """ False once the archive path has been replaced (or removed). """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_dev, st.st_mtime) == (self.stat.st_ino, self.stat.st_dev, self.stat.st_mtime)
+
+    def close(self):
+        self.map.close()
+
+def write_archive(path, tiles):
+    """
+    Writes (z, x, y, data) tiles to a new archive at `path`, storing
+    identical images once (later duplicates of a tile key win). The archive
+    is built in a temporary file and renamed into place. Returns (number of
+    tiles, number of distinct images).
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".tiles", dir=directory)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        offset = HEADER.size
+        blobs = {}
+        index = {}
+        for z, x, y, data in tiles:
+            digest = sha1(data).digest()
+            blob = blobs.get(digest)
+            if blob is None:
+                f.write(data)
+                blob = blobs[digest] = (offset, len(data))
+                offset += len(data)
+            index[tile_key(z, x, y)] = blob
+        for key in sorted(index):
+            blob_offset, length = index[key]
+            f.write(RECORD.pack(key, blob_offset, length))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(index), offset))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        f.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return len(index), len(blobs)
+
+class TileArchive(Disk):
+    """
+    TileCache cache backed by per-layer archives, with a Disk cache spool
+    for tiles that aren't in the archive yet.
+    """
+    def __init__(self, archive=None, **kwargs):
+        Disk.__init__(self, **kwargs)
+        self.archive_dir = archive or self.basedir
+        self.readers = {}
+        self.checked = {}
+        self.lock_readers = Lock()
+
+    def archive_path(self, layer_name):
+        return os.path.join(self.archive_dir, "%s.tiles" % layer_name)
+
+    def reader(self, layer_name):
+        """ The current ArchiveReader for a layer, or None if it has no archive. """
+        now = time()
+        reader = self.readers.get(layer_name)
+        if reader is not None and now - self.checked.get(layer_name, 0) < CHECK_INTERVAL:
+            return reader
+        self.lock_readers.acquire()
+        try:
+            self.checked[layer_name] = now
+            reader = self.readers.get(layer_name)
+            if reader is None or not reader.is_current():
+                path = self.archive_path(layer_name)
+                if os.path.exists(path):
+                    # The old map (if any) is left for the garbage collector,
+                    # since another thread may still be reading from it.
+                    reader = self.readers[layer_name] = ArchiveReader(path)
+                else:
+                    reader = self.readers[layer_name] = None
+            return reader
+        finally:
+            self.lock_readers.release()
+
+    def get(self, tile):
+        reader = self.reader(tile.layer.name)
+        if reader is not None:
+            data = reader.get(tile.z, tile.x, tile.y)
+            if data is not None:
+                return data
+        return Disk.get(self, tile)